@@ -0,0 +1,442 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test for the resource server using ScorpionClient workers.
+
+Builds a throwaway configuration (a self-signed server.pem, a users file,
+a permissions table and a set of resources) in a temporary directory,
+starts the server on a local port in a child process and drives it with
+concurrent clients for a fixed time. For example:
+
+  python benchmarks/run_benchmark.py --mode threaded --clients 16 \\
+      --duration 20 --write-ratio 0.1 --output results.json
+
+  python benchmarks/run_benchmark.py --compare results.json --output new.json
+
+Requires pyOpenSSL, which the server already needs, to make the
+certificate. Results are printed and, with --output, written as JSON so
+that runs can be compared. With --compare the run fails if throughput
+drops or p99 latency grows by more than --tolerance.
+"""
+
+import json
+import optparse
+import os
+import random
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from scorpion_server.client import ConnectionPool
+from scorpion_server.client import ScorpionClient
+
+
+BENCHMARK_USER = 'bench'
+BENCHMARK_PASSWORD = 'bench-password'
+
+
+def _ParseOptions(argv):
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--mode', default='threaded',
+                    help='Server concurrency mode: single, threaded, event '
+                         'or prefork. [%default]')
+  parser.add_option('--backend', default='filesystem',
+                    help='Server storage backend. [%default]')
+  parser.add_option('--journal', metavar='POLICY',
+                    help='Journal writes with this fsync policy: always, '
+                         'group, periodic or none. Writes are not '
+                         'journaled by default.')
+  parser.add_option('--clients', type='int', default=8,
+                    help='Concurrent client threads. [%default]')
+  parser.add_option('--duration', type='float', default=10.0,
+                    help='Seconds to measure for. [%default]')
+  parser.add_option('--warmup', type='float', default=2.0,
+                    help='Seconds to run before measuring. [%default]')
+  parser.add_option('--write-ratio', type='float', default=0.1,
+                    help='Fraction of requests which are POSTs. [%default]')
+  parser.add_option('--anonymous-ratio', type='float', default=0.5,
+                    help='Fraction of clients which do not log in. '
+                         '[%default]')
+  parser.add_option('--sizes', default='512,16384,262144',
+                    help='Comma separated resource sizes in bytes. '
+                         '[%default]')
+  parser.add_option('--resources', type='int', default=50,
+                    help='Resources of each size. [%default]')
+  parser.add_option('--acl-entries', type='int', default=1000,
+                    help='Extra permission lines for other users. '
+                         '[%default]')
+  parser.add_option('--users', type='int', default=100,
+                    help='Extra users in the users file. [%default]')
+  parser.add_option('--seed', type='int', default=1,
+                    help='Random seed for the workload. [%default]')
+  parser.add_option('--output', help='Write the results here as JSON.')
+  parser.add_option('--compare',
+                    help='A previous results file to check against.')
+  parser.add_option('--tolerance', type='float', default=0.1,
+                    help='Allowed fractional regression for --compare. '
+                         '[%default]')
+  parser.add_option('--serve', action='store_true',
+                    help=optparse.SUPPRESS_HELP)
+  parser.add_option('--directory', help=optparse.SUPPRESS_HELP)
+  parser.add_option('--port', type='int', help=optparse.SUPPRESS_HELP)
+  return parser.parse_args(argv[1:])[0]
+
+
+def WriteSelfSignedPem(file_name):
+  """Writes a new private key and self-signed certificate to one file."""
+  from OpenSSL import crypto
+  key = crypto.PKey()
+  key.generate_key(crypto.TYPE_RSA, 2048)
+  certificate = crypto.X509()
+  certificate.get_subject().CN = 'localhost'
+  certificate.set_serial_number(random.getrandbits(64))
+  certificate.gmtime_adj_notBefore(0)
+  certificate.gmtime_adj_notAfter(24 * 60 * 60)
+  certificate.set_issuer(certificate.get_subject())
+  certificate.set_pubkey(key)
+  certificate.sign(key, 'sha256')
+  pem_file = open(file_name, 'w')
+  try:
+    pem_file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    pem_file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, certificate))
+  finally:
+    pem_file.close()
+
+
+def BuildConfiguration(directory, options, rand):
+  """Creates the config and resource directories for a run.
+
+  Returns:
+    A dict mapping each resource size to the list of resource paths.
+  """
+  config_directory = os.path.join(directory, 'config')
+  resource_directory = os.path.join(directory, 'hosted')
+  os.makedirs(config_directory)
+  os.makedirs(resource_directory)
+  WriteSelfSignedPem(os.path.join(config_directory, 'server.pem'))
+  users = ['%s\t%s' % (BENCHMARK_USER, BENCHMARK_PASSWORD)]
+  for i in xrange(options.users):
+    users.append('user%d\tpassword%d' % (i, i))
+  users_file = open(os.path.join(config_directory, 'users'), 'w')
+  users_file.write('\n'.join(users))
+  users_file.close()
+  permissions = ['r\t\t/public', 'w\t%s\t/public' % BENCHMARK_USER,
+                 'w\t%s\t/private' % BENCHMARK_USER]
+  for i in xrange(options.acl_entries):
+    permissions.append('%s\tuser%d\t/private/other%d' % (
+        rand.choice('rw'), rand.randrange(max(options.users, 1)), i))
+  permissions_file = open(os.path.join(config_directory, 'permissions'), 'w')
+  permissions_file.write('\n'.join(permissions))
+  permissions_file.close()
+  resources = {}
+  for size in options.sizes:
+    resources[size] = []
+    for i in xrange(options.resources):
+      resources[size].append('%d-%d' % (size, i))
+  for area in ('public', 'private'):
+    os.makedirs(os.path.join(resource_directory, area))
+  if options.backend == 'filesystem':
+    # Other backends have their own layout, so they start empty and the
+    # resources are written over HTTP once the server is up.
+    for size, names in resources.iteritems():
+      for name in names:
+        for area in ('public', 'private'):
+          resource_file = open(os.path.join(resource_directory, area, name),
+                               'wb')
+          resource_file.write(os.urandom(size))
+          resource_file.close()
+  return resources
+
+
+def Serve(options):
+  """Runs the server in this process with the generated configuration."""
+  from scorpion_server.server import ServerConfig
+  from scorpion_server.server import StartServer
+  directory = options.directory
+  config = ServerConfig(
+      configuration_directory=os.path.join(directory, 'config'),
+      resource_directory=os.path.join(directory, 'hosted'),
+      log_file_name=os.path.join(directory, 'log'),
+      server_port=options.port,
+      storage_backend=options.backend)
+  if options.journal:
+    config.journal_directory = os.path.join(directory, 'journal')
+    config.journal_fsync_policy = options.journal
+  StartServer(mode=options.mode, config=config)
+
+
+def _FindFreePort():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+def _WaitForServer(port, process, timeout=30):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    if process.poll() is not None:
+      raise RuntimeError('The server exited with status %s' %
+                         process.returncode)
+    try:
+      socket.create_connection(('127.0.0.1', port), 1).close()
+      return
+    except socket.error:
+      time.sleep(0.1)
+  raise RuntimeError('The server did not start within %d seconds' % timeout)
+
+
+def _ProcessMemory(pid):
+  """Returns the (current, peak) resident set size of a process in KB."""
+  memory = {}
+  try:
+    status_file = open('/proc/%d/status' % pid)
+  except IOError:
+    return None, None
+  try:
+    for line in status_file:
+      name, _, value = line.partition(':')
+      if name in ('VmRSS', 'VmHWM'):
+        memory[name] = int(value.split()[0])
+  finally:
+    status_file.close()
+  return memory.get('VmRSS'), memory.get('VmHWM')
+
+
+def _ChildPids(pid):
+  """Finds the workers of a preforked server, where /proc is available."""
+  try:
+    children = open('/proc/%d/task/%d/children' % (pid, pid)).read()
+  except IOError:
+    return []
+  return [int(child) for child in children.split()]
+
+
+class Worker(threading.Thread):
+  """Sends requests in a loop and records the latency of each."""
+
+  def __init__(self, base_url, resources, options, authenticated, seed,
+               ssl_context):
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self.base_url = base_url
+    self.resources = resources
+    self.options = options
+    self.authenticated = authenticated
+    self.rand = random.Random(seed)
+    self.measuring = False
+    self.stopped = False
+    self.latencies = []
+    self.errors = 0
+    self.reads = 0
+    self.writes = 0
+    pool = ConnectionPool(max_idle_per_host=1, ssl_context=ssl_context)
+    if authenticated:
+      self.client = ScorpionClient(BENCHMARK_USER, BENCHMARK_PASSWORD,
+                                   pool=pool)
+    else:
+      self.client = ScorpionClient(pool=pool)
+    self.payloads = dict([(size, os.urandom(size))
+                          for size in options.sizes])
+
+  def run(self):
+    while not self.stopped:
+      size = self.rand.choice(self.options.sizes)
+      name = self.rand.choice(self.resources[size])
+      write = (self.authenticated and
+               self.rand.random() < self.options.write_ratio)
+      if self.authenticated:
+        url = '%s/private/%s' % (self.base_url, name)
+      else:
+        url = '%s/public/%s' % (self.base_url, name)
+      started = time.time()
+      try:
+        if write:
+          self.client.Write(url, self.payloads[size])
+        else:
+          self.client.Read(url)
+      except (urllib2.HTTPError, IOError, socket.error):
+        if self.measuring:
+          self.errors += 1
+        continue
+      if self.measuring:
+        self.latencies.append(time.time() - started)
+        if write:
+          self.writes += 1
+        else:
+          self.reads += 1
+
+
+def _Percentile(sorted_values, fraction):
+  if not sorted_values:
+    return None
+  index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+  return sorted_values[index]
+
+
+def RunBenchmark(options):
+  rand = random.Random(options.seed)
+  directory = tempfile.mkdtemp(prefix='scorpion-benchmark-')
+  process = None
+  try:
+    resources = BuildConfiguration(directory, options, rand)
+    port = _FindFreePort()
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve',
+         '--directory', directory, '--port', str(port),
+         '--mode', options.mode, '--backend', options.backend] +
+        (options.journal and ['--journal', options.journal] or []),
+        stdout=open(os.devnull, 'w'))
+    _WaitForServer(port, process)
+    base_url = 'https://127.0.0.1:%d' % port
+    # The certificate is self-signed, so it can not be verified.
+    ssl_context = ssl._create_unverified_context()
+    if options.backend != 'filesystem':
+      loader = ScorpionClient(BENCHMARK_USER, BENCHMARK_PASSWORD,
+                              ssl_context=ssl_context, max_workers=8)
+      loader.WriteMany([('%s/%s/%s' % (base_url, area, name), os.urandom(size))
+                        for size, names in resources.iteritems()
+                        for name in names for area in ('public', 'private')])
+    workers = []
+    anonymous = int(round(options.clients * options.anonymous_ratio))
+    for i in xrange(options.clients):
+      workers.append(Worker(base_url, resources, options, i >= anonymous,
+                            rand.getrandbits(32), ssl_context))
+    for worker in workers:
+      worker.start()
+    time.sleep(options.warmup)
+    for worker in workers:
+      worker.measuring = True
+    started = time.time()
+    time.sleep(options.duration)
+    for worker in workers:
+      worker.measuring = False
+    elapsed = time.time() - started
+    rss, peak_rss = 0, 0
+    for pid in [process.pid] + _ChildPids(process.pid):
+      current, peak = _ProcessMemory(pid)
+      rss += current or 0
+      peak_rss += peak or 0
+    for worker in workers:
+      worker.stopped = True
+    for worker in workers:
+      worker.join(5)
+  finally:
+    if process is not None and process.poll() is None:
+      process.terminate()
+      process.wait()
+    shutil.rmtree(directory, ignore_errors=True)
+  latencies = sorted([latency for worker in workers
+                      for latency in worker.latencies])
+  completed = len(latencies)
+  return {'settings': {'mode': options.mode,
+                       'backend': options.backend,
+                       'journal': options.journal,
+                       'clients': options.clients,
+                       'duration': options.duration,
+                       'write_ratio': options.write_ratio,
+                       'anonymous_ratio': options.anonymous_ratio,
+                       'sizes': options.sizes,
+                       'resources': options.resources,
+                       'acl_entries': options.acl_entries,
+                       'users': options.users,
+                       'seed': options.seed},
+          'time': time.time(),
+          'requests': completed,
+          'reads': sum([worker.reads for worker in workers]),
+          'writes': sum([worker.writes for worker in workers]),
+          'errors': sum([worker.errors for worker in workers]),
+          'requests_per_second': completed / elapsed,
+          'p50_ms': (_Percentile(latencies, 0.5) or 0) * 1000,
+          'p99_ms': (_Percentile(latencies, 0.99) or 0) * 1000,
+          'server_rss_kb': rss,
+          'server_peak_rss_kb': peak_rss}
+
+
+def PrintResults(results):
+  print 'requests:      %d (%d reads, %d writes, %d errors)' % (
+      results['requests'], results['reads'], results['writes'],
+      results['errors'])
+  print 'throughput:    %.1f req/s' % results['requests_per_second']
+  print 'latency:       p50 %.2f ms, p99 %.2f ms' % (results['p50_ms'],
+                                                     results['p99_ms'])
+  print 'server memory: %d KB RSS, %d KB peak' % (
+      results['server_rss_kb'], results['server_peak_rss_kb'])
+
+
+def CompareResults(baseline, results, tolerance):
+  """Prints the change from a baseline run.
+
+  Returns:
+    A list of the measurements which regressed by more than tolerance.
+  """
+  regressions = []
+  for name, higher_is_better in (('requests_per_second', True),
+                                 ('p50_ms', False),
+                                 ('p99_ms', False),
+                                 ('server_peak_rss_kb', False)):
+    old, new = baseline.get(name), results.get(name)
+    if not old or new is None:
+      continue
+    change = (new - old) / float(old)
+    print '%-20s %12.2f -> %12.2f (%+.1f%%)' % (name, old, new, change * 100)
+    if name == 'p50_ms':
+      # The median is reported but is too noisy to fail a run on.
+      continue
+    if (higher_is_better and change < -tolerance or
+        not higher_is_better and change > tolerance):
+      regressions.append(name)
+  old_settings = baseline.get('settings') or {}
+  new_settings = results.get('settings') or {}
+  changed = sorted([name for name in set(old_settings) | set(new_settings)
+                    if old_settings.get(name) != new_settings.get(name)])
+  if changed:
+    print 'Warning: the runs used different settings: %s' % ', '.join(changed)
+  return regressions
+
+
+def main(argv):
+  options = _ParseOptions(argv)
+  options.sizes = [int(size) for size in options.sizes.split(',')]
+  if options.serve:
+    Serve(options)
+    return 0
+  results = RunBenchmark(options)
+  PrintResults(results)
+  if options.output:
+    output_file = open(options.output, 'w')
+    try:
+      json.dump(results, output_file, indent=2, sort_keys=True)
+    finally:
+      output_file.close()
+  if options.compare:
+    baseline = json.load(open(options.compare))
+    regressions = CompareResults(baseline, results, options.tolerance)
+    if regressions:
+      print 'Regressed: %s' % ', '.join(regressions)
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -139,6 +139,56 @@ scorpion_server.Client.prototype.post = function(data, url) {
 };
 
 
+/**
+ * Reads several resources with a single request to the server's batch
+ * resource.
+ *
+ * The callbackFunction receives the status and body of the batch response.
+ * Use scorpion_server.parseBatchResponse to split the body into the result
+ * for each resource.
+ *
+ * @param urls {Array} The paths of the resources to read, such as
+ *     '/public/_index'.
+ */
+scorpion_server.Client.prototype.getMany = function(urls) {
+  var items = [];
+  for (var i = 0; i < urls.length; i++) {
+    // Resource names are percent-encoded, since they may contain spaces.
+    items.push(['GET ', encodeURIComponent(urls[i]), '\n'].join(''));
+  }
+  this.post(items.join(''), '/_batch');
+};
+
+/**
+ * Splits the body of a batch response into one result per resource.
+ *
+ * Frame lengths count bytes, so the contents must be ASCII for the lengths
+ * to match the characters in responseText.
+ *
+ * @param body {String} The body of the response to getMany.
+ * @return {Array} Objects with status, resource and data properties, in
+ *     the order the resources were requested.
+ */
+scorpion_server.parseBatchResponse = function(body) {
+  var frames = [];
+  var position = 0;
+  while (position < body.length) {
+    var lineEnd = body.indexOf('\n', position);
+    if (lineEnd == -1) {
+      break;
+    }
+    var fields = body.substring(position, lineEnd).split(' ');
+    var length = parseInt(fields[2], 10);
+    position = lineEnd + 1;
+    frames.push({status: parseInt(fields[0], 10),
+                 resource: decodeURIComponent(fields[1]),
+                 data: body.substr(position, length)});
+    // Skip the newline which follows each frame's data.
+    position += length + 1;
+  }
+  return frames;
+};
+
 // This code was written by Tyler Akins and has been placed in the
 // public domain.  It would be nice if you left this header intact.
 // Base64 code from Tyler Akins -- http://rumkin.com
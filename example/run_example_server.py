@@ -14,13 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import scorpion_server.server
+import sys
 
-scorpion_server.server.CONFIGURATION_DIRECTORY = 'config'
-scorpion_server.server.USER_DATA_FILENAME = 'users'
-scorpion_server.server.PERMISSIONS_DATA_FILENAME = 'permissions'
-scorpion_server.server.SSL_PEM_FILENAME = 'server.pem'
-scorpion_server.server.RESOURCE_DIRECTORY = 'resources'
-scorpion_server.server.DEFAULT_RESOURCE_FILENAME = '_index'
+from scorpion_server.server import ServerConfig
+from scorpion_server.server import StartServer
 
-scorpion_server.server.StartServer()
\ No newline at end of file
+config = ServerConfig(configuration_directory='config',
+                      user_data_filename='users',
+                      permissions_data_filename='permissions',
+                      ssl_pem_filename='server.pem',
+                      resource_directory='resources',
+                      default_resource_filename='_index')
+# Any setting can also be changed on the command line, for example
+# --server-port 8443 or --config example.cfg.
+config.ParseArgs(sys.argv[1:])
+
+StartServer(config=config)
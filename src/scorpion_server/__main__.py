@@ -0,0 +1,25 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the server: python -m scorpion_server [--config FILE] [options]"""
+
+import sys
+
+from scorpion_server.server import main
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
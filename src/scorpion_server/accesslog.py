@@ -0,0 +1,256 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import time
+import Queue
+
+
+# Queued by the size check thread to have the writer check the file's size.
+_CHECK_SIZE = object()
+
+
+class Logger(object):
+  """Writes log lines from a background thread.
+
+  Callers only put lines on a bounded queue, so logging never waits on the
+  disk. A writer thread takes whatever lines are waiting, writes them in a
+  single batch and flushes. If the queue is full the line is dropped and
+  counted in self.dropped rather than slowing down the request. The log
+  file is appended to, and rotated once it grows past max_bytes.
+
+  Prefork children inherit the logger and append to the same file, so only
+  the process which opened the log rotates it, going by the size of the
+  file rather than by what it wrote itself. The other processes reopen the
+  file when they find that it has been moved.
+  """
+
+  def __init__(self, queue_size=10000, batch_size=500):
+    self.log_file = None
+    self.file_name = None
+    self.max_bytes = 0
+    self.backup_count = 0
+    self.queue_size = queue_size
+    self.batch_size = batch_size
+    self.dropped = 0
+    # How often, in seconds, the process which opened the log checks its
+    # size when it is not writing to it.
+    self.rotate_check_interval = 1.0
+    self._queue = None
+    self._pid = None
+    self._owner_pid = None
+
+  def openLog(self, file_name, max_bytes=0, backup_count=0):
+    """Opens the log file for appending and starts the writer thread.
+
+    Args:
+      file_name: str The log file.
+      max_bytes: int (optional) Rotate the file once it is this large. The
+          log is never rotated if this is 0.
+      backup_count: int (optional) The number of rotated files to keep,
+          named file_name.1 (the newest) to file_name.<backup_count>.
+    """
+    self.file_name = file_name
+    self.max_bytes = max_bytes
+    self.backup_count = backup_count
+    self.log_file = open(file_name, 'a')
+    self._owner_pid = os.getpid()
+    self._StartWriter()
+    if max_bytes:
+      # Like the writer, this thread does not survive a fork, so children
+      # never check the size themselves.
+      checker = threading.Thread(target=self._SizeCheckLoop,
+                                 name='scorpion-log-rotation')
+      checker.setDaemon(True)
+      checker.start()
+
+  def _StartWriter(self):
+    self._queue = Queue.Queue(self.queue_size)
+    # Threads do not survive a fork, so each process starts its own writer.
+    self._pid = os.getpid()
+    writer = threading.Thread(target=self._WriterLoop, name='scorpion-log')
+    writer.setDaemon(True)
+    writer.start()
+
+  def writeln(self, text):
+    if self.log_file is None:
+      return
+    if self._pid != os.getpid():
+      self._StartWriter()
+    try:
+      self._queue.put_nowait('%s\n' % text)
+    except Queue.Full:
+      self.dropped += 1
+
+  def LogRequest(self, method, path, user, status, bytes_sent, latency,
+                 client=None, messages=None):
+    """Writes one structured line describing a finished request.
+
+    Args:
+      method: str The HTTP method.
+      path: str The requested path.
+      user: str or None The authenticated user, '' for anonymous requests
+          and None if the credentials were never checked.
+      status: int or None The response status code.
+      bytes_sent: int The number of body bytes sent to the client.
+      latency: float Seconds taken to handle the request.
+      client: str (optional) The client's address.
+      messages: list of str (optional) Errors and notes from handling the
+          request, such as why it was refused. They are only included in
+          the record if given.
+    """
+    if self.log_file is None:
+      return
+    record = {'time': round(time.time(), 3),
+              'client': client,
+              'method': method,
+              'path': path,
+              'user': user,
+              'status': status,
+              'bytes': bytes_sent,
+              'ms': round(latency * 1000, 3)}
+    if messages:
+      record['messages'] = messages
+    self.writeln(json.dumps(record, sort_keys=True))
+
+  def Flush(self, timeout=None):
+    """Waits until every line queued so far has been written."""
+    if self._queue is None:
+      return
+    written = threading.Event()
+    self._queue.put(written)
+    written.wait(timeout)
+
+  def _SizeCheckLoop(self):
+    # Children may fill the file while this process has nothing to write,
+    # so the writer is asked to check its size now and then.
+    while True:
+      time.sleep(self.rotate_check_interval)
+      try:
+        self._queue.put_nowait(_CHECK_SIZE)
+      except Queue.Full:
+        pass
+
+  def _WriterLoop(self):
+    log_queue = self._queue
+    while True:
+      batch = [log_queue.get()]
+      while len(batch) < self.batch_size:
+        try:
+          batch.append(log_queue.get_nowait())
+        except Queue.Empty:
+          break
+      lines = [item for item in batch if isinstance(item, str)]
+      if lines:
+        self._WriteLines(''.join(lines))
+      for item in batch:
+        if item is _CHECK_SIZE:
+          self._RotateIfFull()
+        elif not isinstance(item, str):
+          item.set()
+
+  def _WriteLines(self, text):
+    if self._pid != self._owner_pid:
+      self._ReopenIfMoved()
+    try:
+      self.log_file.write(text)
+      self.log_file.flush()
+    except (IOError, ValueError):
+      return
+    self._RotateIfFull()
+
+  def _RotateIfFull(self):
+    if not self.max_bytes or os.getpid() != self._owner_pid:
+      return
+    try:
+      size = os.fstat(self.log_file.fileno()).st_size
+    except (OSError, ValueError):
+      return
+    if size >= self.max_bytes:
+      self._Rotate()
+
+  def _ReopenIfMoved(self):
+    """Reopens the log if the process which owns it has rotated it."""
+    try:
+      opened = os.fstat(self.log_file.fileno())
+      current = os.stat(self.file_name)
+      if (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino):
+        return
+    except (OSError, ValueError):
+      pass
+    try:
+      log_file = open(self.file_name, 'a')
+    except IOError:
+      return
+    self.log_file.close()
+    self.log_file = log_file
+
+  def _Rotate(self):
+    self.log_file.close()
+    if self.backup_count:
+      for index in xrange(self.backup_count - 1, 0, -1):
+        source = '%s.%d' % (self.file_name, index)
+        if os.path.exists(source):
+          os.rename(source, '%s.%d' % (self.file_name, index + 1))
+      os.rename(self.file_name, '%s.1' % self.file_name)
+    else:
+      os.remove(self.file_name)
+    self.log_file = open(self.file_name, 'a')
+
+
+def ReadHotPaths(file_name, count, max_bytes=1024 * 1024):
+  """Returns the paths most often read successfully, according to a log.
+
+  Only the last max_bytes of the log are read, so the result reflects
+  recent traffic and reading it stays quick however large the log is.
+  Lines which are not request records, such as one cut in half by the
+  seek, are skipped.
+
+  Args:
+    file_name: str The log file written by Logger.LogRequest.
+    count: int The most paths to return.
+    max_bytes: int (optional) How much of the end of the log to read.
+
+  Returns:
+    A list of paths, without URL parameters, most requested first. The
+    list is empty if the log can not be read.
+  """
+  if count <= 0:
+    return []
+  try:
+    log_file = open(file_name, 'rb')
+  except IOError:
+    return []
+  try:
+    log_file.seek(0, os.SEEK_END)
+    log_file.seek(max(log_file.tell() - max_bytes, 0))
+    lines = log_file.read().splitlines()
+  finally:
+    log_file.close()
+  hits = {}
+  for line in lines:
+    try:
+      record = json.loads(line)
+      if record.get('method') != 'GET' or record.get('status') != 200:
+        continue
+      path = record['path'].split('?', 1)[0]
+    except (ValueError, KeyError, TypeError, AttributeError):
+      continue
+    hits[path] = hits.get(path, 0) + 1
+  ranked = sorted(hits.items(), key=lambda item: (-item[1], item[0]))
+  return [str(path) for path, unused in ranked[:count]]
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The framing used by the batch endpoint.
+
+A batch request body is a list of items. A read is a single line naming
+the resource, and a write gives the length of its data, which follows on
+the next line:
+
+  GET /public/a
+  GET /public/b
+  POST /user/c%20d 5
+  hello
+
+The response holds one frame per item, in the same order, each with the
+item's status code, its resource and the length of its body:
+
+  200 /public/a 3
+  abc
+  404 /public/b 9
+  Not Found
+  200 /user/c%20d 35
+  {"etag": "\"5-4a1b\"", "size": 5}
+
+Every body is followed by a newline which is not counted in its length.
+Resource names may contain spaces, so they are percent-encoded in both
+directions, as they would be in a URL. A request which turns out to be
+malformed part of the way through ends its response with a frame for the
+resource '*' holding the error.
+"""
+
+import urllib
+
+
+# The longest item line which is accepted, not counting data.
+MAX_LINE_BYTES = 64 * 1024
+
+
+class BatchFormatError(ValueError):
+  pass
+
+
+def FormatBatchRequest(items):
+  """Encodes a list of (method, resource, data) items as a request body.
+
+  The data of a GET item is ignored.
+  """
+  parts = []
+  for method, resource, data in items:
+    if method == 'GET':
+      parts.append('GET %s\n' % urllib.quote(resource))
+    else:
+      parts.append('%s %s %d\n%s\n' % (method, urllib.quote(resource),
+                                        len(data), data))
+  return ''.join(parts)
+
+
+class _ChunkReader(object):
+  """Reads lines and blocks of data from an iterable of strings."""
+
+  def __init__(self, chunks):
+    self._chunks = iter(chunks)
+    self._buffer = ''
+
+  def _Fill(self):
+    for chunk in self._chunks:
+      if chunk:
+        self._buffer += chunk
+        return True
+    return False
+
+  def ReadLine(self):
+    """Returns the next line without its newline, or None at the end."""
+    while True:
+      line_end = self._buffer.find('\n')
+      if line_end != -1:
+        line = self._buffer[:line_end]
+        self._buffer = self._buffer[line_end + 1:]
+        return line
+      if len(self._buffer) > MAX_LINE_BYTES:
+        raise BatchFormatError('Item line is too long')
+      if not self._Fill():
+        line = self._buffer
+        self._buffer = ''
+        return line or None
+
+  def Read(self, length):
+    """Returns up to length bytes, fewer only if the chunks run out."""
+    parts = [self._buffer[:length]]
+    remaining = length - len(parts[0])
+    self._buffer = self._buffer[length:]
+    while remaining > 0:
+      if not self._Fill():
+        break
+      parts.append(self._buffer[:remaining])
+      remaining -= len(parts[-1])
+      self._buffer = self._buffer[len(parts[-1]):]
+    return ''.join(parts)
+
+  def SkipNewline(self):
+    if not self._buffer:
+      self._Fill()
+    if self._buffer[:1] == '\n':
+      self._buffer = self._buffer[1:]
+
+
+def ReadBatchRequest(chunks, max_items=None):
+  """Yields the (method, resource, data) items of a request body in order.
+
+  Items are yielded as soon as they have been read, so only the item being
+  read is held in memory.
+
+  Args:
+    chunks: An iterable of str which together make up the request body.
+    max_items: int (optional) The most items to accept.
+
+  Raises:
+    BatchFormatError if the body is malformed or has too many items. This
+    is raised when the bad item is reached, after the items before it have
+    been yielded.
+  """
+  reader = _ChunkReader(chunks)
+  item_count = 0
+  while True:
+    line = reader.ReadLine()
+    if line is None:
+      return
+    fields = line.split()
+    if not fields:
+      continue
+    if max_items is not None and item_count >= max_items:
+      raise BatchFormatError('More than %d items in the batch' % max_items)
+    item_count += 1
+    if fields[0] == 'GET' and len(fields) == 2:
+      yield ('GET', urllib.unquote(fields[1]), None)
+    elif fields[0] == 'POST' and len(fields) == 3:
+      try:
+        data_length = int(fields[2])
+      except ValueError:
+        raise BatchFormatError('Invalid length: %s' % fields[2])
+      if data_length < 0:
+        raise BatchFormatError('Invalid length: %s' % fields[2])
+      data = reader.Read(data_length)
+      if len(data) < data_length:
+        raise BatchFormatError('Invalid length: %s' % fields[2])
+      reader.SkipNewline()
+      yield ('POST', urllib.unquote(fields[1]), data)
+    else:
+      raise BatchFormatError('Invalid item: %s' % ' '.join(fields))
+
+
+def ParseBatchRequest(body, max_items=None):
+  """Decodes a request body into a list of (method, resource, data) items.
+
+  Args:
+    body: str The request body.
+    max_items: int (optional) The most items to accept.
+
+  Raises:
+    BatchFormatError if the body is malformed or has too many items.
+  """
+  return list(ReadBatchRequest([body], max_items))
+
+
+def FormatBatchFrameHeader(status, resource, data_length):
+  """Returns the line which starts a frame, for data sent after it."""
+  return '%d %s %d\n' % (status, urllib.quote(resource), data_length)
+
+
+def FormatBatchFrame(status, resource, data):
+  return '%s%s\n' % (FormatBatchFrameHeader(status, resource, len(data)),
+                     data)
+
+
+def ParseBatchResponse(body):
+  """Decodes a batch response into a list of (status, resource, data)."""
+  frames = []
+  position = 0
+  while position < len(body):
+    line_end = body.find('\n', position)
+    if line_end == -1:
+      raise BatchFormatError('Incomplete frame header')
+    fields = body[position:line_end].split()
+    if len(fields) != 3:
+      raise BatchFormatError('Invalid frame header')
+    try:
+      status, data_length = int(fields[0]), int(fields[2])
+    except ValueError:
+      raise BatchFormatError('Invalid frame header')
+    position = line_end + 1
+    if position + data_length > len(body):
+      raise BatchFormatError('Incomplete frame')
+    frames.append((status, urllib.unquote(fields[1]),
+                   body[position:position + data_length]))
+    position += data_length + 1
+  return frames
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LruCache(object):
+  """A thread safe least recently used cache bounded by total size in bytes.
+
+  Each entry is stored with the size it was given when added. When the
+  total size would exceed max_bytes the least recently used entries are
+  evicted. Entries larger than max_entry_bytes are never stored.
+  """
+
+  def __init__(self, max_bytes, max_entry_bytes=None):
+    self.max_bytes = max_bytes
+    if max_entry_bytes is None:
+      max_entry_bytes = max_bytes
+    self.max_entry_bytes = max_entry_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.current_bytes = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, key, is_valid=None):
+    """Returns the value stored for key, or None if it is not cached.
+
+    Args:
+      key: The key the value was stored under.
+      is_valid: function (optional) Called with the cached value. If it
+          returns False the entry is stale, so it is removed and the
+          lookup counts as a miss.
+    """
+    self._lock.acquire()
+    try:
+      entry = self._entries.get(key)
+    finally:
+      self._lock.release()
+    # Validation may touch the disk, so it runs without holding the lock.
+    valid = entry is not None and (is_valid is None or is_valid(entry[0]))
+    self._lock.acquire()
+    try:
+      if valid:
+        self.hits += 1
+        if key in self._entries:
+          # Move the entry to the end to mark it as most recently used.
+          self._entries[key] = self._entries.pop(key)
+        return entry[0]
+      self.misses += 1
+      if entry is not None and self._entries.get(key) is entry:
+        del self._entries[key]
+        self.current_bytes -= entry[1]
+      return None
+    finally:
+      self._lock.release()
+
+  def Put(self, key, value, size):
+    """Stores value under key if it fits, evicting old entries as needed."""
+    if size > self.max_entry_bytes or size > self.max_bytes:
+      self.Remove(key)
+      return False
+    self._lock.acquire()
+    try:
+      old_entry = self._entries.pop(key, None)
+      if old_entry is not None:
+        self.current_bytes -= old_entry[1]
+      while self._entries and self.current_bytes + size > self.max_bytes:
+        evicted_size = self._entries.popitem(last=False)[1][1]
+        self.current_bytes -= evicted_size
+        self.evictions += 1
+      self._entries[key] = (value, size)
+      self.current_bytes += size
+      return True
+    finally:
+      self._lock.release()
+
+  def Remove(self, key):
+    self._lock.acquire()
+    try:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self.current_bytes -= entry[1]
+    finally:
+      self._lock.release()
+
+  def Clear(self):
+    self._lock.acquire()
+    try:
+      self._entries.clear()
+      self.current_bytes = 0
+    finally:
+      self._lock.release()
+
+  def Stats(self):
+    """Returns a dict of the cache's counters and current size."""
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.current_bytes}
+
+
+class ExpiringCache(object):
+  """A thread safe least recently used cache whose entries expire.
+
+  At most max_entries values are kept, and each is forgotten ttl seconds
+  after it was added.
+  """
+
+  def __init__(self, max_entries, ttl):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, key):
+    self._lock.acquire()
+    try:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        return None
+      if entry[1] < time.time():
+        return None
+      self._entries[key] = entry
+      return entry[0]
+    finally:
+      self._lock.release()
+
+  def Put(self, key, value):
+    if self.max_entries <= 0:
+      return
+    self._lock.acquire()
+    try:
+      self._entries.pop(key, None)
+      self._entries[key] = (value, time.time() + self.ttl)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+    finally:
+      self._lock.release()
+
+  def Clear(self):
+    self._lock.acquire()
+    try:
+      self._entries.clear()
+    finally:
+      self._lock.release()
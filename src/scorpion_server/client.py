@@ -14,16 +14,142 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import urllib2
 import base64
+import httplib
+import json
+import select
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from cStringIO import StringIO
+from collections import OrderedDict
+from scorpion_server.batch import FormatBatchRequest
+from scorpion_server.batch import ParseBatchResponse
+
+
+# Requests which may be sent again when a pooled connection turns out to
+# have been closed. The server may have acted on a POST before the
+# connection broke, so writes are never repeated.
+RETRY_METHODS = ('GET', 'HEAD')
+
+
+class ConnectionPool(object):
+  """Keeps idle keep-alive connections to each host so they can be reused.
+
+  Reusing a connection skips the TCP and TLS handshakes which would
+  otherwise be paid on every request. The pool is thread safe and can be
+  shared by several clients.
+  """
+
+  def __init__(self, max_idle_per_host=8, timeout=None, ssl_context=None):
+    self.max_idle_per_host = max_idle_per_host
+    self.timeout = timeout
+    self.ssl_context = ssl_context
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def _NewConnection(self, scheme, netloc):
+    kwargs = {}
+    if self.timeout is not None:
+      kwargs['timeout'] = self.timeout
+    if scheme == 'https':
+      if self.ssl_context is not None:
+        kwargs['context'] = self.ssl_context
+      return httplib.HTTPSConnection(netloc, **kwargs)
+    return httplib.HTTPConnection(netloc, **kwargs)
+
+  def Get(self, scheme, netloc):
+    """Returns a (connection, reused) tuple for the host."""
+    while True:
+      self._lock.acquire()
+      try:
+        idle = self._idle.get((scheme, netloc))
+        if not idle:
+          break
+        connection = idle.pop()
+      finally:
+        self._lock.release()
+      if not self._IsClosed(connection):
+        return connection, True
+      connection.close()
+    return self._NewConnection(scheme, netloc), False
+
+  def _IsClosed(self, connection):
+    """Returns True if the server has closed an idle connection.
+
+    Nothing is expected on an idle connection, so a readable socket means
+    the server has closed it or sent something which cannot be answered.
+    """
+    if connection.sock is None:
+      return True
+    try:
+      return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+      return True
+
+  def Put(self, scheme, netloc, connection):
+    """Returns a connection whose last response was fully read."""
+    self._lock.acquire()
+    try:
+      idle = self._idle.setdefault((scheme, netloc), [])
+      if len(idle) < self.max_idle_per_host:
+        idle.append(connection)
+        return
+    finally:
+      self._lock.release()
+    connection.close()
+
+  def CloseAll(self):
+    self._lock.acquire()
+    try:
+      for idle in self._idle.values():
+        for connection in idle:
+          connection.close()
+      self._idle = {}
+    finally:
+      self._lock.release()
 
 
 class ScorpionClient(object):
 
-  def __init__(self, username=None, password=None):
+  # The server's batch endpoint, used by BatchRead and BatchWrite.
+  batch_resource = '/_batch'
+  # Watch and WaitForChange request this followed by the resource prefix.
+  watch_resource = '/_watch'
+  # List requests this followed by the resource prefix.
+  listing_resource = '/_list'
+
+  def __init__(self, username=None, password=None, pool=None, max_workers=4,
+               etag_cache_size=0, ssl_context=None):
+    """Creates a client which reads and writes resources on a server.
+
+    Args:
+      username: str (optional) Sent with Basic auth on every request.
+      password: str (optional)
+      pool: ConnectionPool (optional) Used to reuse connections. A new pool
+          is created if one is not given.
+      max_workers: int (optional) The most requests ReadMany and WriteMany
+          will have in flight at once.
+      etag_cache_size: int (optional) The number of resources to remember
+          along with their ETags. When a remembered resource is read again
+          the request is made conditional, and an unchanged resource is
+          returned from memory without being downloaded.
+      ssl_context: ssl.SSLContext (optional) Used for HTTPS connections when
+          a new pool is created.
+    """
     self.__headers = {}
     self.__username = username
     self.__password = password
+    if username is not None and password is not None:
+      self._GenerateAuthHeader()
+    self.pool = pool or ConnectionPool(ssl_context=ssl_context)
+    self.max_workers = max_workers
+    self.etag_cache_size = etag_cache_size
+    self._etag_cache = OrderedDict()
+    self._etag_lock = threading.Lock()
     
   def SetCredentials(self, username, password):
     self.__username = username
@@ -34,14 +160,315 @@ class ScorpionClient(object):
     to_encode = ':'.join([self.__username, self.__password])
     encoded = base64.encodestring(to_encode).strip()
     self.__headers['Authorization'] = 'Basic %s' % encoded.strip()
+
+  def _Request(self, method, url, data=None, extra_headers=None):
+    """Makes a request on a pooled connection.
+
+    Returns:
+      A (response, body) tuple. The response body has already been read.
+    """
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+      path = '%s?%s' % (path, parts.query)
+    headers = dict(self.__headers)
+    if extra_headers:
+      headers.update(extra_headers)
+    while True:
+      connection, reused = self.pool.Get(parts.scheme, parts.netloc)
+      try:
+        connection.request(method, path, data, headers)
+        response = connection.getresponse()
+        body = response.read()
+      except (httplib.HTTPException, socket.error):
+        connection.close()
+        if reused and method in RETRY_METHODS:
+          # The server may have closed an idle connection, so try again
+          # with a new one.
+          continue
+        raise
+      if response.will_close:
+        connection.close()
+      else:
+        self.pool.Put(parts.scheme, parts.netloc, connection)
+      return response, body
+
+  def _CheckResponse(self, url, response, body):
+    if response.status >= 400:
+      raise urllib2.HTTPError(url, response.status, response.reason,
+                              response.msg, StringIO(body))
+
+  def _GetCachedVersion(self, url):
+    self._etag_lock.acquire()
+    try:
+      cached = self._etag_cache.pop(url, None)
+      if cached is not None:
+        self._etag_cache[url] = cached
+      return cached
+    finally:
+      self._etag_lock.release()
+
+  def _CacheVersion(self, url, etag, body):
+    self._etag_lock.acquire()
+    try:
+      self._etag_cache.pop(url, None)
+      self._etag_cache[url] = (etag, body)
+      while len(self._etag_cache) > self.etag_cache_size:
+        self._etag_cache.popitem(last=False)
+    finally:
+      self._etag_lock.release()
     
   def Read(self, url):
-    request = urllib2.Request(url, None, self.__headers)
-    response = urllib2.urlopen(request)
-    return response.read()
+    extra_headers = {}
+    cached = None
+    if self.etag_cache_size:
+      cached = self._GetCachedVersion(url)
+      if cached is not None:
+        extra_headers['If-None-Match'] = cached[0]
+    response, body = self._Request('GET', url, None, extra_headers)
+    if response.status == 304 and cached is not None:
+      return cached[1]
+    self._CheckResponse(url, response, body)
+    etag = response.getheader('etag')
+    if self.etag_cache_size and etag:
+      self._CacheVersion(url, etag, body)
+    return body
     
   def Write(self, url, data):
-    request = urllib2.Request(url, data, self.__headers)
-    response = urllib2.urlopen(request)
-    return response.read()
-  
\ No newline at end of file
+    response, body = self._Request('POST', url, data)
+    self._CheckResponse(url, response, body)
+    return body
+
+  def ReadMany(self, urls, raise_errors=True):
+    """Reads several resources concurrently using up to max_workers threads.
+
+    Returns:
+      A list of the response bodies in the same order as urls. If 
+      raise_errors is False, a failed read leaves its exception in the list
+      instead of raising it.
+    """
+    return self._RunConcurrently(self.Read, [(url,) for url in urls],
+                                 raise_errors)
+
+  def WriteMany(self, writes, raise_errors=True):
+    """Writes several resources concurrently.
+
+    Args:
+      writes: A list of (url, data) tuples.
+      raise_errors: bool (optional) See ReadMany.
+
+    Returns:
+      A list of the server's acknowledgements in the order of writes.
+    """
+    return self._RunConcurrently(self.Write, list(writes), raise_errors)
+
+  def BatchRead(self, urls, raise_errors=True):
+    """Reads several resources from one server with a single request.
+
+    Unlike ReadMany this makes one request, so the credentials and
+    connection are only set up once, but the ETag cache is not used.
+
+    Args:
+      urls: A list of resource URLs which must all be on the same server.
+      raise_errors: bool (optional) If False, an item which failed leaves a
+          urllib2.HTTPError in the list instead of raising it.
+
+    Returns:
+      A list of the resource contents in the same order as urls.
+    """
+    return self._Batch([('GET', url, None) for url in urls], raise_errors)
+
+  def BatchWrite(self, writes, raise_errors=True):
+    """Writes several resources on one server with a single request.
+
+    Args:
+      writes: A list of (url, data) tuples.
+      raise_errors: bool (optional) See BatchRead.
+
+    Returns:
+      A list of the server's acknowledgements in the order of writes.
+    """
+    return self._Batch([('POST', url, data) for url, data in writes],
+                       raise_errors)
+
+  def _Batch(self, items, raise_errors):
+    if not items:
+      return []
+    hosts = set()
+    batch_items = []
+    for method, url, data in items:
+      parts = urlparse.urlsplit(url)
+      hosts.add((parts.scheme, parts.netloc))
+      batch_items.append((method, parts.path or '/', data))
+    if len(hosts) > 1:
+      raise ValueError('All resources in a batch must be on one server')
+    scheme, netloc = hosts.pop()
+    batch_url = urlparse.urlunsplit((scheme, netloc, self.batch_resource,
+                                     '', ''))
+    response, body = self._Request('POST', batch_url,
+                                   FormatBatchRequest(batch_items))
+    self._CheckResponse(batch_url, response, body)
+    results = []
+    for (method, url, unused), (status, resource, data) in zip(
+        items, ParseBatchResponse(body)):
+      if status >= 400:
+        error = urllib2.HTTPError(url, status, httplib.responses.get(status),
+                                  None, StringIO(data))
+        if raise_errors:
+          raise error
+        results.append(error)
+      else:
+        results.append(data)
+    return results
+
+  def Watch(self, url, last_event_id=None, timeout=None):
+    """Yields change events for resources under a prefix as they happen.
+
+    Each event is a dict with 'event' and 'id' keys. A 'change' event also
+    has the 'resource', 'etag' and 'size' of the new content. The stream
+    starts with a 'ready' event, and a 'reset' event means that changes
+    since last_event_id were missed, so the resources should be read again.
+
+    Args:
+      url: str The prefix to watch, such as https://host/user/notes.
+      last_event_id: str (optional) The id of the last event seen, to also
+          receive the changes made since then.
+      timeout: float (optional) Stop after this many seconds.
+    """
+    parts = urlparse.urlsplit(url)
+    path = self.watch_resource + (parts.path or '/')
+    headers = dict(self.__headers)
+    headers['Accept'] = 'text/event-stream'
+    if last_event_id is not None:
+      headers['Last-Event-ID'] = last_event_id
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+    # The stream holds its connection until it ends, so it does not come
+    # from the pool.
+    connection = self.pool._NewConnection(parts.scheme, parts.netloc)
+    try:
+      connection.request('GET', path, None, headers)
+      # getresponse would close the connection's socket, since the stream
+      # has no length, so the response is read from the socket here. The
+      # socket stays open until the connection is closed, and its timeout
+      # can be changed as the deadline approaches.
+      sock = connection.sock
+      response = httplib.HTTPResponse(sock, method='GET', buffering=True)
+      response.begin()
+      if response.status != 200:
+        self._CheckResponse(url, response, response.read())
+      event = {}
+      while True:
+        if deadline is not None:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            return
+          sock.settimeout(remaining)
+        try:
+          line = response.fp.readline()
+        except socket.timeout:
+          return
+        if not line:
+          return
+        line = line.rstrip('\r\n')
+        if not line:
+          if event.has_key('event'):
+            yield event
+          event = {}
+        elif line.startswith(':'):
+          # Comments keep idle connections alive.
+          continue
+        else:
+          field, _, value = line.partition(':')
+          value = value.lstrip(' ')
+          if field == 'data':
+            event.update(json.loads(value))
+          elif field in ('event', 'id'):
+            event[field] = value
+    finally:
+      connection.close()
+
+  def WaitForChange(self, url, last_event_id=None, timeout=None):
+    """Waits for a resource under a prefix to change.
+
+    Pass the id of the returned event as last_event_id to the next call so
+    that no change made in between is missed.
+
+    Returns:
+      The first 'change' or 'reset' event as described in Watch, or None
+      if the timeout passed first.
+    """
+    events = self.Watch(url, last_event_id, timeout)
+    try:
+      for event in events:
+        if event['event'] != 'ready':
+          return event
+      return None
+    finally:
+      events.close()
+
+  def List(self, url, page_size=None):
+    """Yields the resources under a prefix which the user may read.
+
+    Each resource is a dict with its 'name', 'size' and 'mtime', in name
+    order. Further pages are requested as they are needed.
+
+    Args:
+      url: str The prefix to list, such as https://host/user/notes/.
+      page_size: int (optional) Resources to request at a time. Defaults
+          to the server's page size.
+    """
+    parts = urlparse.urlsplit(url)
+    path = self.listing_resource + (parts.path or '/')
+    after = None
+    while True:
+      query = {}
+      if after is not None:
+        query['after'] = after
+      if page_size:
+        query['limit'] = page_size
+      list_url = urlparse.urlunsplit((parts.scheme, parts.netloc, path,
+                                      urllib.urlencode(query), ''))
+      response, body = self._Request('GET', list_url)
+      self._CheckResponse(list_url, response, body)
+      page = json.loads(body)
+      for resource in page['resources']:
+        yield resource
+      after = page['next_after']
+      if after is None:
+        return
+
+  def _RunConcurrently(self, function, argument_lists, raise_errors):
+    results = [None] * len(argument_lists)
+    next_index = [0]
+    index_lock = threading.Lock()
+
+    def Work():
+      while True:
+        index_lock.acquire()
+        try:
+          index = next_index[0]
+          next_index[0] += 1
+        finally:
+          index_lock.release()
+        if index >= len(argument_lists):
+          return
+        try:
+          results[index] = function(*argument_lists[index])
+        except Exception, e:
+          results[index] = e
+
+    workers = []
+    for i in xrange(min(self.max_workers, len(argument_lists))):
+      worker = threading.Thread(target=Work)
+      worker.setDaemon(True)
+      worker.start()
+      workers.append(worker)
+    for worker in workers:
+      worker.join()
+    if raise_errors:
+      for result in results:
+        if isinstance(result, Exception):
+          raise result
+    return results
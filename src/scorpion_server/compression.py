@@ -0,0 +1,119 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compressed variants of resources for Content-Encoding negotiation.
+
+gzip is always available. Brotli ('br') is offered as well when the
+optional brotli module is installed.
+"""
+
+import gzip
+from cStringIO import StringIO
+
+from scorpion_server.cache import LruCache
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+
+# Content types which are already compressed and only get bigger when
+# compressed again. Entries ending in '/' match a whole family of types.
+INCOMPRESSIBLE_TYPES = ('image/', 'audio/', 'video/', 'font/woff',
+                        'application/zip', 'application/gzip',
+                        'application/x-gzip', 'application/x-bzip2',
+                        'application/x-xz', 'application/x-7z-compressed',
+                        'application/x-rar-compressed', 'application/pdf')
+# Compressible image formats are the exception to the image/ rule.
+COMPRESSIBLE_EXCEPTIONS = ('image/svg+xml', 'image/x-icon', 'image/bmp')
+
+
+def _Gzip(data):
+  buffer = StringIO()
+  # A fixed mtime keeps the output, and so its cache entry, stable.
+  gzip_file = gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6,
+                            mtime=0)
+  try:
+    gzip_file.write(data)
+  finally:
+    gzip_file.close()
+  return buffer.getvalue()
+
+
+def _Brotli(data):
+  return brotli.compress(data)
+
+
+ENCODERS = {'gzip': _Gzip}
+if brotli is not None:
+  ENCODERS['br'] = _Brotli
+
+
+def AvailableEncodings():
+  """Returns the supported codings, most preferred first."""
+  return [coding for coding in ('br', 'gzip') if ENCODERS.has_key(coding)]
+
+
+def IsCompressible(content_type):
+  content_type = content_type.split(';')[0].strip().lower()
+  if content_type in COMPRESSIBLE_EXCEPTIONS:
+    return True
+  for incompressible in INCOMPRESSIBLE_TYPES:
+    if incompressible.endswith('/'):
+      if content_type.startswith(incompressible):
+        return False
+    elif content_type == incompressible or content_type.startswith(
+        incompressible):
+      return False
+  return True
+
+
+def VariantETag(etag, coding):
+  """Gives each encoded variant its own strong entity tag."""
+  return '%s-%s"' % (etag[:-1], coding)
+
+
+class CompressedVariantCache(object):
+  """Keeps compressed copies of resources so each is compressed only once.
+
+  Entries are keyed by the resource's location, its entity tag (which
+  changes whenever the size or mtime does) and the coding, so a changed
+  resource simply misses and the stale variant ages out of the LRU.
+  """
+
+  def __init__(self, max_bytes):
+    self.cache = LruCache(max_bytes)
+
+  def GetVariant(self, file_name, etag, coding, read_data):
+    """Returns the encoded content, compressing it on a cache miss.
+
+    Args:
+      file_name: str Where the resource is stored.
+      etag: str The entity tag of the unencoded resource.
+      coding: str One of the codings from AvailableEncodings.
+      read_data: function Called with no arguments to get the unencoded
+          content when it needs to be compressed.
+    """
+    key = (file_name, etag, coding)
+    encoded = self.cache.Get(key)
+    if encoded is None:
+      encoded = ENCODERS[coding](read_data())
+      self.cache.Put(key, encoded, len(encoded))
+    return encoded
+
+  def Stats(self):
+    return self.cache.Stats()
@@ -0,0 +1,420 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Concurrency models for serving connections.
+
+The mix-in classes in this module follow the SocketServer convention and
+should be listed before the server class, for example:
+
+  class ThreadedServer(ThreadPoolMixIn, HTTPServer): pass
+
+They only change how accepted connections are scheduled. Each connection
+is still handled by calling finish_request and shutdown_request on the
+server, so request handlers behave exactly as they do in the single
+threaded server.
+"""
+
+import errno
+import os
+import select
+import signal
+import socket
+import threading
+import time
+import Queue
+from SocketServer import BaseServer
+
+
+# A prefork child which exits within FAST_EXIT_SECONDS of being started is
+# restarted after a delay, which doubles with each such exit up to
+# MAX_RESTART_DELAY seconds, so that a child which can not start does not
+# keep the parent forking in a tight loop.
+FAST_EXIT_SECONDS = 5
+MIN_RESTART_DELAY = 0.1
+MAX_RESTART_DELAY = 30
+
+# Guards the creation of each EventLoopMixIn server's stopped event.
+_state_lock = threading.Lock()
+
+
+class ThreadPoolMixIn:
+  """Handles each connection on one of a fixed number of worker threads.
+
+  At most max_connections connections are queued or being handled at any
+  time. Connections accepted beyond that limit are closed immediately
+  instead of waiting in an unbounded queue.
+
+  A worker which waits for the next request on a keep-alive connection
+  (see WaitForData) is not free for other clients, so fewer connections
+  than worker_threads may wait at once, and the one which has waited
+  longest is given up when a new connection finds every worker busy.
+  """
+
+  worker_threads = 16
+  max_connections = 128
+  # Seconds between checks of whether an idle connection has been given up.
+  idle_poll_interval = 0.25
+
+  _workers = None
+
+  def StartWorkers(self):
+    """Starts the worker threads if they are not already running.
+
+    Threads do not survive a fork, so this is called from serve_forever
+    rather than from the constructor.
+    """
+    if self._workers is not None:
+      return
+    self._connection_queue = Queue.Queue()
+    self._connection_count = 0
+    self._busy_workers = 0
+    # [connection, given up] for each connection in WaitForData, longest
+    # waiting first.
+    self._idle_waiters = []
+    self._count_lock = threading.Lock()
+    self._workers = []
+    for i in xrange(self.worker_threads):
+      worker = threading.Thread(target=self._WorkerLoop,
+                                name='scorpion-worker-%d' % i)
+      worker.setDaemon(True)
+      worker.start()
+      self._workers.append(worker)
+
+  def ActiveConnections(self):
+    """Returns the number of connections which are queued or in progress."""
+    return self._connection_count
+
+  def _AdmitConnection(self):
+    self._count_lock.acquire()
+    try:
+      if self._connection_count >= self.max_connections:
+        return False
+      self._connection_count += 1
+      return True
+    finally:
+      self._count_lock.release()
+
+  def _ReleaseConnection(self):
+    self._count_lock.acquire()
+    try:
+      self._connection_count -= 1
+    finally:
+      self._count_lock.release()
+
+  def process_request(self, request, client_address):
+    self.StartWorkers()
+    if self._AdmitConnection():
+      self._DispatchConnection(request, client_address)
+    else:
+      # Refuse the connection rather than letting the backlog grow.
+      self.shutdown_request(request)
+
+  def _DispatchConnection(self, request, client_address):
+    self._connection_queue.put((request, client_address))
+    self._count_lock.acquire()
+    try:
+      if self._busy_workers >= self.worker_threads and self._idle_waiters:
+        self._idle_waiters.pop(0)[1] = True
+    finally:
+      self._count_lock.release()
+
+  def _WorkerLoop(self):
+    while True:
+      request, client_address = self._connection_queue.get()
+      self._count_lock.acquire()
+      self._busy_workers += 1
+      self._count_lock.release()
+      try:
+        try:
+          self.finish_request(request, client_address)
+        except:
+          self.handle_error(request, client_address)
+      finally:
+        self._count_lock.acquire()
+        self._busy_workers -= 1
+        self._count_lock.release()
+        self._FinishConnection(request, client_address)
+
+  def _FinishConnection(self, request, client_address):
+    """Called by a worker once it is done with a connection."""
+    self.shutdown_request(request)
+    self._ReleaseConnection()
+
+  def RequestsServed(self, request):
+    """Returns how many requests were served on the connection before."""
+    return 0
+
+  def KeepAlive(self, request, requests_served):
+    """Offers to watch an idle keep-alive connection without a worker.
+
+    Returns:
+      True if the request handler should return without closing the
+      connection, or False if it should wait with WaitForData instead.
+    """
+    return False
+
+  def WaitForData(self, connection, timeout):
+    """Waits up to timeout seconds for the client to send more data.
+
+    Returns:
+      True if data arrived, or False if the connection should be closed
+      because it stayed idle, failed or was given up for a new connection.
+    """
+    waiter = [connection, False]
+    self._count_lock.acquire()
+    try:
+      self._idle_waiters.append(waiter)
+      if len(self._idle_waiters) >= self.worker_threads:
+        self._idle_waiters.pop(0)[1] = True
+    finally:
+      self._count_lock.release()
+    deadline = time.time() + timeout
+    try:
+      while not waiter[1]:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        try:
+          if select.select([connection], [], [],
+                           min(remaining, self.idle_poll_interval))[0]:
+            return True
+        except (select.error, socket.error, ValueError):
+          return False
+      return False
+    finally:
+      self._count_lock.acquire()
+      try:
+        if waiter in self._idle_waiters:
+          self._idle_waiters.remove(waiter)
+      finally:
+        self._count_lock.release()
+
+  def serve_forever(self, poll_interval=0.5):
+    self.StartWorkers()
+    BaseServer.serve_forever(self, poll_interval)
+
+
+class EventLoopMixIn(ThreadPoolMixIn):
+  """Multiplexes waiting connections with select before using a worker.
+
+  Newly accepted connections are watched by a single event loop until the
+  client has sent data, and only then are they handed to the worker pool.
+  Clients which connect and stall never tie up a worker thread, and
+  connections which stay silent for longer than connection_timeout seconds
+  are closed. Keep-alive connections are handed back to the loop between
+  requests (see KeepAlive) and closed after keepalive_timeout idle
+  seconds. The number of waiting and active connections together is
+  bounded by max_connections.
+  """
+
+  connection_timeout = 30
+  keepalive_timeout = 15
+
+  _wake_write = None
+  _stop_requested = False
+  _stopped = None
+
+  def RequestsServed(self, request):
+    return self._requests_served.pop(request, 0)
+
+  def KeepAlive(self, request, requests_served):
+    if self._wake_write is None:
+      return False
+    # The worker passes the connection back to the loop once the request
+    # handler has returned, in _FinishConnection.
+    self._keep_alive[request] = requests_served
+    return True
+
+  def _FinishConnection(self, request, client_address):
+    requests_served = self._keep_alive.pop(request, None)
+    if requests_served is not None:
+      self._returned_lock.acquire()
+      try:
+        if self._wake_write is not None:
+          self._returned.append((request, client_address, requests_served))
+          os.write(self._wake_write, 'x')
+          return
+      finally:
+        self._returned_lock.release()
+    ThreadPoolMixIn._FinishConnection(self, request, client_address)
+
+  def _StoppedEvent(self):
+    _state_lock.acquire()
+    try:
+      if self._stopped is None:
+        self._stopped = threading.Event()
+      return self._stopped
+    finally:
+      _state_lock.release()
+
+  def serve_forever(self, poll_interval=0.5):
+    """Runs the event loop until shutdown is called.
+
+    A shutdown request is noticed within poll_interval seconds.
+    """
+    self.StartWorkers()
+    stopped = self._StoppedEvent()
+    stopped.clear()
+    # Maps waiting connections to (client_address, deadline, the number of
+    # requests served on the connection so far).
+    waiting = {}
+    self._keep_alive = {}
+    self._requests_served = {}
+    self._returned = []
+    self._returned_lock = threading.Lock()
+    # Workers write to the pipe to wake the loop when they return a
+    # connection.
+    wake_read, self._wake_write = os.pipe()
+    try:
+      while not self._stop_requested:
+        try:
+          readable = select.select([self.socket, wake_read] + waiting.keys(),
+                                   [], [], poll_interval)[0]
+        except select.error, e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+        for connection in readable:
+          if connection is self.socket:
+            self._AcceptConnection(waiting)
+          elif connection is wake_read:
+            os.read(wake_read, 4096)
+            self._TakeReturnedConnections(waiting)
+          else:
+            client_address, unused, requests_served = waiting.pop(connection)
+            if requests_served:
+              self._requests_served[connection] = requests_served
+            self._DispatchConnection(connection, client_address)
+        now = time.time()
+        for connection, (client_address, deadline, unused) in waiting.items():
+          if now > deadline:
+            del waiting[connection]
+            self.shutdown_request(connection)
+            self._ReleaseConnection()
+    finally:
+      # Workers close the connections they finish from now on.
+      self._returned_lock.acquire()
+      try:
+        wake_write, self._wake_write = self._wake_write, None
+      finally:
+        self._returned_lock.release()
+      self._TakeReturnedConnections(waiting)
+      os.close(wake_read)
+      os.close(wake_write)
+      # Connections which are waiting for a request are closed. Those
+      # already handed to the workers are finished by them.
+      for connection in waiting:
+        self.shutdown_request(connection)
+        self._ReleaseConnection()
+      self._stop_requested = False
+      stopped.set()
+
+  def shutdown(self):
+    """Stops serve_forever and waits until it has returned."""
+    self._stop_requested = True
+    self._StoppedEvent().wait()
+
+  def _TakeReturnedConnections(self, waiting):
+    self._returned_lock.acquire()
+    try:
+      returned, self._returned = self._returned, []
+    finally:
+      self._returned_lock.release()
+    deadline = time.time() + self.keepalive_timeout
+    for request, client_address, requests_served in returned:
+      waiting[request] = (client_address, deadline, requests_served)
+
+  def _AcceptConnection(self, waiting):
+    try:
+      request, client_address = self.get_request()
+    except EnvironmentError:
+      return
+    if not self.verify_request(request, client_address):
+      self.shutdown_request(request)
+    elif self._AdmitConnection():
+      waiting[request] = (client_address,
+                          time.time() + self.connection_timeout, 0)
+    else:
+      self.shutdown_request(request)
+
+
+def ServePreforked(server, processes):
+  """Serves from several forked processes which share the listening socket.
+
+  The server must already be bound and listening. Each child process calls
+  server.serve_forever and accepts connections from the shared socket, so
+  all CPU cores can be used. The parent restarts children which exit,
+  forwards SIGHUP to them and stops them all on SIGINT or SIGTERM.
+  Children which exit soon after starting are restarted with a growing
+  delay.
+  """
+  # Maps each child's pid to the time it was started.
+  children = {}
+  stopping = []
+
+  def StartChild():
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      signal.signal(signal.SIGINT, signal.SIG_DFL)
+      # Children reload their own copy of the user data on SIGHUP.
+      signal.signal(signal.SIGHUP, child_hup_handler)
+      try:
+        server.serve_forever()
+      finally:
+        os._exit(0)
+    children[pid] = time.time()
+
+  def SignalChildren(signum):
+    for pid in children:
+      try:
+        os.kill(pid, signum)
+      except OSError:
+        pass
+
+  def Stop(signum, frame):
+    stopping.append(signum)
+    SignalChildren(signal.SIGTERM)
+
+  signal.signal(signal.SIGTERM, Stop)
+  signal.signal(signal.SIGINT, Stop)
+  # The parent only passes SIGHUP on to the children.
+  child_hup_handler = signal.getsignal(signal.SIGHUP)
+  signal.signal(signal.SIGHUP, lambda signum, frame: SignalChildren(signum))
+
+  for i in xrange(processes):
+    StartChild()
+
+  restart_delay = 0
+  while children:
+    try:
+      pid, status = os.wait()
+    except OSError, e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+    started = children.pop(pid, None)
+    if started is None or stopping:
+      continue
+    if time.time() - started < FAST_EXIT_SECONDS:
+      restart_delay = min(max(restart_delay * 2, MIN_RESTART_DELAY),
+                          MAX_RESTART_DELAY)
+      # A signal cuts the sleep short, so a stop is not held up.
+      time.sleep(restart_delay)
+    else:
+      restart_delay = 0
+    if not stopping:
+      StartChild()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for HTTP validators, conditional requests and byte ranges."""
+
+import email.utils
+
+
+class UnsatisfiableRangeError(Exception):
+  pass
+
+
+def MakeETag(size, mtime):
+  """Creates a strong entity tag from a resource's size and mtime."""
+  return '"%x-%x"' % (size, int(mtime * 1000000))
+
+
+def ParseETagList(header):
+  """Splits an If-None-Match or If-Match header into its entity tags.
+
+  Weak tags are returned without their W/ prefix, since If-None-Match uses
+  the weak comparison function.
+  """
+  etags = []
+  for etag in header.split(','):
+    etag = etag.strip()
+    if etag.startswith('W/'):
+      etag = etag[2:]
+    if etag:
+      etags.append(etag)
+  return etags
+
+
+def ParseHttpDate(header):
+  """Converts an HTTP date into seconds since the epoch, or None."""
+  parsed = email.utils.parsedate_tz(header)
+  if parsed is None:
+    return None
+  return email.utils.mktime_tz(parsed)
+
+
+def IsNotModified(if_none_match, if_modified_since, etag, mtime):
+  """Decides whether a GET can be answered with 304 Not Modified.
+
+  If-None-Match takes precedence over If-Modified-Since when both are sent.
+
+  Args:
+    if_none_match: str or None The If-None-Match request header.
+    if_modified_since: str or None The If-Modified-Since request header.
+    etag: str The current entity tag of the resource.
+    mtime: float The current modification time of the resource.
+  """
+  if if_none_match is not None:
+    etags = ParseETagList(if_none_match)
+    return '*' in etags or etag in etags
+  if if_modified_since is not None:
+    since = ParseHttpDate(if_modified_since)
+    # HTTP dates only have one second resolution.
+    return since is not None and int(mtime) <= since
+  return False
+
+
+def RangeIsCurrent(if_range, etag, mtime):
+  """Checks an If-Range header, which may hold an entity tag or a date."""
+  if if_range is None:
+    return True
+  if_range = if_range.strip()
+  if if_range.startswith('"') or if_range.startswith('W/'):
+    # Only strong entity tags may be used with If-Range.
+    return if_range == etag
+  since = ParseHttpDate(if_range)
+  return since is not None and int(mtime) <= since
+
+
+def ParseRange(header, size):
+  """Parses a Range header for a single range of bytes.
+
+  Args:
+    header: str The Range request header, for example 'bytes=0-499'.
+    size: int The length of the resource in bytes.
+
+  Returns:
+    A (start, end) tuple where end is one past the last byte to send, or
+    None if the header should be ignored and the whole resource sent. Sets
+    of more than one range are ignored rather than answered with a
+    multipart response.
+
+  Raises:
+    UnsatisfiableRangeError if the range lies outside of the resource.
+  """
+  unit, _, ranges = header.partition('=')
+  if unit.strip().lower() != 'bytes' or ',' in ranges:
+    return None
+  first, dash, last = ranges.strip().partition('-')
+  if not dash:
+    return None
+  try:
+    if not first:
+      # A suffix range such as bytes=-500 asks for the last 500 bytes.
+      suffix_length = int(last)
+      if suffix_length <= 0 or size == 0:
+        raise UnsatisfiableRangeError(header)
+      return (max(size - suffix_length, 0), size)
+    start = int(first)
+    if start >= size:
+      raise UnsatisfiableRangeError(header)
+    if last:
+      end = int(last) + 1
+    else:
+      end = size
+  except ValueError:
+    return None
+  if start < 0 or end <= start:
+    return None
+  return (start, min(end, size))
+
+
+def ParseQualityList(header):
+  """Parses a header such as Accept-Encoding into a dict of q-values."""
+  qualities = {}
+  for item in header.split(','):
+    parts = item.split(';')
+    name = parts[0].strip().lower()
+    if not name:
+      continue
+    quality = 1.0
+    for parameter in parts[1:]:
+      key, _, value = parameter.partition('=')
+      if key.strip().lower() == 'q':
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    qualities[name] = quality
+  return qualities
+
+
+def ChooseContentEncoding(accept_encoding, available):
+  """Picks the best content coding the client accepts.
+
+  Args:
+    accept_encoding: str or None The Accept-Encoding request header.
+    available: list of str The codings the server can produce, in order of
+        preference when the client rates several of them equally.
+
+  Returns:
+    One of the available codings, or None to send the content unencoded.
+  """
+  if not accept_encoding:
+    return None
+  qualities = ParseQualityList(accept_encoding)
+  best = None
+  best_quality = 0.0
+  for coding in available:
+    quality = qualities.get(coding, qualities.get('*', 0.0))
+    if quality > best_quality:
+      best, best_quality = coding, quality
+  return best
@@ -0,0 +1,500 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An append-only journal of resource writes with group commit.
+
+When the server is given a journal directory, every write is appended to
+the journal, and made durable according to the fsync policy, before it is
+applied to the storage backend. If the server stops between the two, the
+write is applied when the journal is replayed on the next start. The fsync
+policies are:
+
+  always:   each write is fsynced on its own before it is applied.
+  group:    a write waits for an fsync, but one fsync covers every write
+            appended while the previous fsync was running, so concurrent
+            POSTs share the cost.
+  periodic: writes do not wait. A background thread fsyncs the journal
+            every sync_interval seconds, so a crash may lose that much.
+  none:     the journal is never fsynced and the operating system decides
+            when it reaches the disk. It still protects against the server
+            process dying.
+
+Each process appends to its own file, journal.<pid>, in the journal
+directory. A record is a header followed by the resource name and data:
+
+  magic 'SJR1', CRC-32, sequence, time, flags, name length, data length
+
+The CRC covers the data, the resource name and the header fields after
+the CRC, in that order, so a record which was only partly
+written when the machine stopped is recognised and ignored on replay.
+Once a process's file grows past max_bytes, it checkpoints the whole
+journal: it waits until no process has a record which has not been
+applied, syncs every resource named in any journal file to disk through
+the backend, and truncates all of the files. Truncating only its own file
+would let an older record for the same resource in another process's file
+be replayed over the newer content. Processes coordinate through two lock
+files in the journal directory, which are locked with flock:
+
+  gate.lock:     held exclusively by a checkpoint, and briefly shared by
+                 each append, so that new appends wait for the checkpoint.
+  inflight.lock: shared by each process while it has records which have
+                 not been applied, and held exclusively by a checkpoint.
+
+Platforms without fcntl can not fork prefork children, so there is only
+one process and no locking is needed.
+"""
+
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+
+FSYNC_POLICIES = ('always', 'group', 'periodic', 'none')
+JOURNAL_FILE_PREFIX = 'journal.'
+RECORD_MAGIC = 'SJR1'
+# magic, crc, sequence, time, flags, name length, data length
+RECORD_HEADER = struct.Struct('>4sLQdBHQ')
+# The part of the header covered by the CRC.
+_CHECKED_HEADER = struct.Struct('>QdBHQ')
+# Set on a record which cancels the earlier record with the same sequence
+# number, because applying it to the backend failed.
+FLAG_CANCELLED = 1
+# Record data up to this size is held in memory before being appended.
+SPOOL_BYTES = 1024 * 1024
+COPY_CHUNK_SIZE = 64 * 1024
+GATE_LOCK_FILE = 'gate.lock'
+INFLIGHT_LOCK_FILE = 'inflight.lock'
+
+
+class JournalRecord(object):
+  """A write which has been appended to the journal but not yet applied."""
+
+  def __init__(self, sequence, resource, spool, size):
+    self.sequence = sequence
+    self.resource = resource
+    self.size = size
+    self._spool = spool
+
+  def Chunks(self, chunk_size=COPY_CHUNK_SIZE):
+    """Yields the record's data, which can then be given to a backend."""
+    self._spool.seek(0)
+    while True:
+      chunk = self._spool.read(chunk_size)
+      if not chunk:
+        break
+      yield chunk
+
+  def Close(self):
+    self._spool.close()
+
+
+def _RecordCrc(data_crc, resource, checked_header):
+  crc = zlib.crc32(resource, data_crc)
+  return zlib.crc32(checked_header, crc) & 0xffffffff
+
+
+def _WriteAll(fd, data):
+  while data:
+    written = os.write(fd, data)
+    data = data[written:]
+
+
+def _ReadRecords(file_name):
+  """Yields (time, sequence, flags, resource, data offset, data length).
+
+  Stops at the first record which is incomplete or fails its CRC, which is
+  where the process stopped writing.
+  """
+  journal_file = open(file_name, 'rb')
+  try:
+    while True:
+      header = journal_file.read(RECORD_HEADER.size)
+      if len(header) < RECORD_HEADER.size:
+        return
+      (magic, crc, sequence, record_time, flags, name_length,
+       data_length) = RECORD_HEADER.unpack(header)
+      if magic != RECORD_MAGIC:
+        return
+      resource = journal_file.read(name_length)
+      if len(resource) < name_length:
+        return
+      data_offset = journal_file.tell()
+      data_crc = 0
+      remaining = data_length
+      while remaining:
+        chunk = journal_file.read(min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+          return
+        data_crc = zlib.crc32(chunk, data_crc)
+        remaining -= len(chunk)
+      if _RecordCrc(data_crc, resource, header[8:]) != crc:
+        return
+      yield (record_time, sequence, flags, resource, data_offset,
+             data_length)
+  finally:
+    journal_file.close()
+
+
+def _ReadData(file_name, offset, length):
+  journal_file = open(file_name, 'rb')
+  try:
+    journal_file.seek(offset)
+    while length:
+      chunk = journal_file.read(min(length, COPY_CHUNK_SIZE))
+      if not chunk:
+        raise IOError('Journal file %s is truncated' % file_name)
+      length -= len(chunk)
+      yield chunk
+  finally:
+    journal_file.close()
+
+
+class Journal(object):
+
+  def __init__(self, directory, fsync_policy='group', sync_interval=1.0,
+               max_bytes=64 * 1024 * 1024):
+    """
+    Args:
+      directory: str Where the journal files are kept. It is created if it
+          does not exist.
+      fsync_policy: str (optional) One of FSYNC_POLICIES.
+      sync_interval: float (optional) Seconds between fsyncs with the
+          periodic policy.
+      max_bytes: int (optional) The size at which a journal file is
+          truncated, once all of its records have been applied.
+    """
+    if fsync_policy not in FSYNC_POLICIES:
+      raise ValueError('Unknown fsync policy: %s' % fsync_policy)
+    self.directory = directory
+    self.fsync_policy = fsync_policy
+    self.sync_interval = sync_interval
+    self.max_bytes = max_bytes
+    self.records = 0
+    self.fsyncs = 0
+    self.checkpoints = 0
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    # Guards the journal file, the sequence numbers and the count of
+    # records which have not been applied yet.
+    self._lock = threading.Condition()
+    # Lets one thread at a time fsync while the others wait for it.
+    self._sync_condition = threading.Condition()
+    self._pid = None
+    self._fd = None
+    self._gate_fd = None
+    self._inflight_fd = None
+
+  def _CheckProcess(self):
+    """Opens this process's journal file. Must be called holding the lock.
+
+    A prefork child must not append to its parent's file, and its parent's
+    threads do not survive the fork.
+    """
+    if self._pid == os.getpid():
+      return
+    self._pid = os.getpid()
+    self.file_name = os.path.join(self.directory,
+                                  '%s%d' % (JOURNAL_FILE_PREFIX, self._pid))
+    self._fd = os.open(self.file_name,
+                       os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    # flock locks belong to the open file, which a forked child shares
+    # with its parent, so each process opens the lock files itself.
+    self._gate_fd = self._OpenLockFile(GATE_LOCK_FILE)
+    self._inflight_fd = self._OpenLockFile(INFLIGHT_LOCK_FILE)
+    self._size = os.fstat(self._fd).st_size
+    self._sequence = 0
+    self._written = 0
+    self._synced = 0
+    self._syncing = False
+    self._unapplied = 0
+    self._checkpointing = False
+    if self.fsync_policy == 'periodic':
+      syncer = threading.Thread(target=self._SyncLoop, name='scorpion-journal')
+      syncer.setDaemon(True)
+      syncer.start()
+
+  def _OpenLockFile(self, name):
+    if fcntl is None:
+      return None
+    return os.open(os.path.join(self.directory, name),
+                   os.O_RDWR | os.O_CREAT, 0644)
+
+  def JournalFiles(self):
+    return sorted(
+        os.path.join(self.directory, name)
+        for name in os.listdir(self.directory)
+        if name.startswith(JOURNAL_FILE_PREFIX))
+
+  def Replay(self, apply, sync):
+    """Applies every complete record left by earlier processes.
+
+    Must be called before any writes are appended, normally when the
+    server starts. Records from all journal files are applied in the order
+    in which they were written. Cancelled records are skipped, and a record
+    which fails to apply again is skipped as well. The files are removed
+    afterwards.
+
+    Args:
+      apply: function Called with a resource and an iterable of data
+          chunks to write it to the backend.
+      sync: function Called with a set of resources to make their content
+          durable before the journal files are removed.
+
+    Returns:
+      The number of records which were applied.
+    """
+    records = []
+    for file_name in self.JournalFiles():
+      file_records = {}
+      for (record_time, sequence, flags, resource, data_offset,
+           data_length) in _ReadRecords(file_name):
+        if flags & FLAG_CANCELLED:
+          file_records.pop(sequence, None)
+        else:
+          file_records[sequence] = (record_time, file_name, sequence,
+                                    resource, data_offset, data_length)
+      records.extend(file_records.values())
+    records.sort()
+    applied = 0
+    resources = set()
+    for (record_time, file_name, sequence, resource, data_offset,
+         data_length) in records:
+      try:
+        apply(resource, _ReadData(file_name, data_offset, data_length))
+      except (IOError, OSError):
+        continue
+      applied += 1
+      resources.add(resource)
+    if resources:
+      sync(resources)
+    for file_name in self.JournalFiles():
+      os.remove(file_name)
+    return applied
+
+  def Append(self, resource, chunks):
+    """Appends a write to the journal and waits as the fsync policy says.
+
+    The chunks are read in full before anything is appended, so a request
+    body which fails part way through leaves the journal unchanged.
+
+    Returns:
+      A JournalRecord to apply to the backend. Applied must be called
+      with it afterwards.
+    """
+    spool = tempfile.SpooledTemporaryFile(SPOOL_BYTES)
+    data_crc = 0
+    size = 0
+    try:
+      for chunk in chunks:
+        spool.write(chunk)
+        data_crc = zlib.crc32(chunk, data_crc)
+        size += len(chunk)
+    except:
+      spool.close()
+      raise
+    self._lock.acquire()
+    try:
+      self._CheckProcess()
+      gate_fd = self._gate_fd
+    finally:
+      self._lock.release()
+    if gate_fd is not None:
+      # Waits while another process is checkpointing.
+      fcntl.flock(gate_fd, fcntl.LOCK_SH)
+      fcntl.flock(gate_fd, fcntl.LOCK_UN)
+    self._lock.acquire()
+    try:
+      while self._checkpointing:
+        self._lock.wait()
+      if not self._unapplied and self._inflight_fd is not None:
+        fcntl.flock(self._inflight_fd, fcntl.LOCK_SH)
+      self._sequence += 1
+      sequence = self._sequence
+      try:
+        self._WriteRecord(sequence, 0, resource, spool, size, data_crc)
+      except:
+        if not self._unapplied and self._inflight_fd is not None:
+          fcntl.flock(self._inflight_fd, fcntl.LOCK_UN)
+        spool.close()
+        raise
+      self._unapplied += 1
+      if self.fsync_policy == 'always':
+        self._Fsync()
+        self._synced = sequence
+    finally:
+      self._lock.release()
+    if self.fsync_policy == 'group':
+      self._SyncUpTo(sequence)
+    return JournalRecord(sequence, resource, spool, size)
+
+  def _WriteRecord(self, sequence, flags, resource, spool, size, data_crc):
+    """Appends one record. Must be called holding the lock."""
+    checked = _CHECKED_HEADER.pack(sequence, time.time(), flags,
+                                   len(resource), size)
+    header = (RECORD_MAGIC +
+              struct.pack('>L', _RecordCrc(data_crc, resource, checked)) +
+              checked + resource)
+    _WriteAll(self._fd, header)
+    self._size += len(header)
+    if size:
+      spool.seek(0)
+      while True:
+        chunk = spool.read(COPY_CHUNK_SIZE)
+        if not chunk:
+          break
+        _WriteAll(self._fd, chunk)
+        self._size += len(chunk)
+    # A cancel record reuses the sequence number of an older write, and
+    # must not make later writes look unwritten to _SyncUpTo.
+    self._written = max(self._written, sequence)
+    self.records += 1
+
+  def _Fsync(self):
+    os.fsync(self._fd)
+    self.fsyncs += 1
+
+  def _SyncUpTo(self, sequence):
+    """Waits until the record with this sequence number is on disk.
+
+    The first waiting thread fsyncs everything written so far while the
+    others wait. Threads which arrive during that fsync are covered by the
+    next one, which the first of them starts.
+    """
+    self._sync_condition.acquire()
+    try:
+      while self._synced < sequence:
+        if self._syncing:
+          self._sync_condition.wait()
+          continue
+        self._syncing = True
+        target = self._written
+        self._sync_condition.release()
+        try:
+          self._Fsync()
+        finally:
+          self._sync_condition.acquire()
+          self._syncing = False
+          self._sync_condition.notifyAll()
+        self._synced = max(self._synced, target)
+    finally:
+      self._sync_condition.release()
+
+  def _SyncLoop(self):
+    pid = self._pid
+    while pid == os.getpid():
+      time.sleep(self.sync_interval)
+      if self._synced < self._written:
+        self._SyncUpTo(self._written)
+
+  def Applied(self, record, succeeded=True):
+    """Records that a write was applied, or that applying it failed.
+
+    A failed write is cancelled in the journal so that replaying it later
+    can not overwrite newer content.
+    """
+    record.Close()
+    self._lock.acquire()
+    try:
+      if not succeeded and self._pid == os.getpid():
+        self._WriteRecord(record.sequence, FLAG_CANCELLED, record.resource,
+                          None, 0, 0)
+      self._unapplied -= 1
+      if not self._unapplied and self._inflight_fd is not None:
+        fcntl.flock(self._inflight_fd, fcntl.LOCK_UN)
+      self._lock.notifyAll()
+    finally:
+      self._lock.release()
+
+  def NeedsCheckpoint(self):
+    return (self._pid == os.getpid() and not self._checkpointing and
+            self._size >= self.max_bytes)
+
+  def Checkpoint(self, sync):
+    """Truncates every journal file once the writes in them are durable.
+
+    New appends, in this process and in the others, wait until the
+    checkpoint is done.
+
+    Args:
+      sync: function Called with the set of resources named in the
+          journal files, to make their content durable in the backend.
+    """
+    self._lock.acquire()
+    try:
+      if not self.NeedsCheckpoint():
+        return
+      self._checkpointing = True
+      try:
+        while self._unapplied:
+          self._lock.wait()
+        gate_fd = self._OpenLockFile(GATE_LOCK_FILE)
+        inflight_fd = self._OpenLockFile(INFLIGHT_LOCK_FILE)
+        try:
+          if gate_fd is not None:
+            fcntl.flock(gate_fd, fcntl.LOCK_EX)
+            fcntl.flock(inflight_fd, fcntl.LOCK_EX)
+          self._size = os.fstat(self._fd).st_size
+          # Another process may have checkpointed while this one waited.
+          if self._size >= self.max_bytes:
+            self._CheckpointFiles(sync)
+        finally:
+          # Closing the files releases the locks.
+          for fd in (gate_fd, inflight_fd):
+            if fd is not None:
+              os.close(fd)
+      finally:
+        self._checkpointing = False
+        self._lock.notifyAll()
+    finally:
+      self._lock.release()
+
+  def _CheckpointFiles(self, sync):
+    """Must be called with no records left to apply in any process."""
+    journal_files = self.JournalFiles()
+    resources = set()
+    for file_name in journal_files:
+      for record in _ReadRecords(file_name):
+        resources.add(record[3])
+    sync(resources)
+    for file_name in journal_files:
+      if file_name == self.file_name:
+        fd = self._fd
+      else:
+        try:
+          fd = os.open(file_name, os.O_WRONLY)
+        except OSError:
+          continue
+      try:
+        os.ftruncate(fd, 0)
+        os.fsync(fd)
+        self.fsyncs += 1
+      finally:
+        if fd != self._fd:
+          os.close(fd)
+    self._size = 0
+    self.checkpoints += 1
+
+  def Stats(self):
+    return {'records': self.records, 'fsyncs': self.fsyncs,
+            'checkpoints': self.checkpoints}
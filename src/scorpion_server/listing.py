@@ -0,0 +1,173 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-memory index of resource names for listing and prefix queries.
+
+The index keeps every resource name in a sorted list, so the resources
+under a prefix are found with a binary search and read in order without
+touching the disk. Writes made through the DataStore update the index as
+they happen. Changes made some other way, such as files copied into the
+hosted directory or writes by another prefork process, are picked up by a
+full rescan of the backend every rescan_interval seconds.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+
+# The number of names examined per lock acquisition while listing, so that
+# a long listing does not hold up writers.
+SCAN_BATCH = 500
+
+
+class ResourceIndex(object):
+
+  def __init__(self, backend, rescan_interval=None):
+    """
+    Args:
+      backend: storage.StorageBackend The backend whose resources are
+          indexed.
+      rescan_interval: int (optional) Seconds between full rescans of the
+          backend. The index is never rescanned by itself if this is None.
+    """
+    self.backend = backend
+    self.rescan_interval = rescan_interval
+    self.rescans = 0
+    self._lock = threading.Lock()
+    self._names = []
+    # Maps each name to its (size, mtime).
+    self._stats = {}
+    # Updates made while a rescan is running, which the rescan's older view
+    # of the backend must not undo.
+    self._scan_updates = None
+    self._pid = None
+
+  def __len__(self):
+    return len(self._names)
+
+  def _CheckProcess(self):
+    """Starts the rescan thread, once in each process."""
+    if self._pid == os.getpid() or not self.rescan_interval:
+      return
+    self._lock.acquire()
+    try:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+    finally:
+      self._lock.release()
+    rescanner = threading.Thread(target=self._RescanLoop,
+                                 name='scorpion-index')
+    rescanner.setDaemon(True)
+    rescanner.start()
+
+  def _RescanLoop(self):
+    pid = self._pid
+    while pid == os.getpid():
+      time.sleep(self.rescan_interval)
+      try:
+        self.Rescan()
+      except (IOError, OSError):
+        # Try again next time, keeping the index as it is.
+        pass
+
+  def Rescan(self):
+    """Rebuilds the index from a full listing of the backend."""
+    self._lock.acquire()
+    try:
+      self._scan_updates = {}
+    finally:
+      self._lock.release()
+    stats = {}
+    try:
+      for name, size, mtime in self.backend.ListResourceStats():
+        stats[name] = (size, mtime)
+    except:
+      self._lock.acquire()
+      self._scan_updates = None
+      self._lock.release()
+      raise
+    self._lock.acquire()
+    try:
+      stats.update(self._scan_updates)
+      self._scan_updates = None
+      self._stats = stats
+      self._names = sorted(stats)
+      self.rescans += 1
+    finally:
+      self._lock.release()
+    self._CheckProcess()
+
+  def Update(self, resource, resource_stat):
+    """Records a write. Has the signature of a DataStore listener."""
+    self._CheckProcess()
+    name = self.backend.ResourceName(resource)
+    entry = (resource_stat.st_size, resource_stat.st_mtime)
+    self._lock.acquire()
+    try:
+      if name not in self._stats:
+        bisect.insort(self._names, name)
+      self._stats[name] = entry
+      if self._scan_updates is not None:
+        self._scan_updates[name] = entry
+    finally:
+      self._lock.release()
+
+  def List(self, prefix, after=None, limit=100, is_visible=None):
+    """Returns resources whose names start with prefix, in name order.
+
+    Args:
+      prefix: str The start of the names to return. Use a trailing / to
+          list the contents of a directory.
+      after: str (optional) Only return names which sort after this one,
+          normally the next_after of the previous page.
+      limit: int (optional) The most resources to return.
+      is_visible: function (optional) Called with each name. Names for
+          which it returns False are left out.
+
+    Returns:
+      A tuple of a list of (name, size, mtime) tuples, and the value to
+      pass as after to get the next page, or None if this is the last page.
+    """
+    self._CheckProcess()
+    entries = []
+    position = prefix
+    find = bisect.bisect_left
+    if after is not None and after >= prefix:
+      position = after
+      find = bisect.bisect_right
+    while True:
+      self._lock.acquire()
+      try:
+        start = find(self._names, position)
+        names = self._names[start:start + SCAN_BATCH]
+        stats = [self._stats[name] for name in names]
+      finally:
+        self._lock.release()
+      for name, (size, mtime) in zip(names, stats):
+        if not name.startswith(prefix):
+          return entries, None
+        if is_visible is not None and not is_visible(name):
+          continue
+        if len(entries) >= limit:
+          return entries, entries[-1][0]
+        entries.append((name, size, mtime))
+      if len(names) < SCAN_BATCH:
+        return entries, None
+      position = names[-1]
+      find = bisect.bisect_right
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counters, gauges and histograms rendered in the Prometheus text format.
+
+Each metric keeps its values in a dict keyed by a tuple of label values
+and guards updates with its own lock, so recording a value costs a dict
+lookup and a few additions.
+"""
+
+import bisect
+import threading
+
+
+# Upper bounds, in seconds, of the default latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _FormatLabels(label_names, label_values, extra=None):
+  pairs = zip(label_names, label_values)
+  if extra:
+    pairs.append(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join(
+      ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+          '"', '\\"').replace('\n', '\\n')) for name, value in pairs])
+
+
+class Counter(object):
+
+  metric_type = 'counter'
+
+  def __init__(self, name, help_text, label_names=()):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = tuple(label_names)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def Inc(self, amount=1, *label_values):
+    self._lock.acquire()
+    try:
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+    finally:
+      self._lock.release()
+
+  def Value(self, *label_values):
+    return self._values.get(label_values, 0)
+
+  def Render(self):
+    lines = []
+    for label_values, value in sorted(self._values.items()):
+      lines.append('%s%s %s' % (
+          self.name, _FormatLabels(self.label_names, label_values), value))
+    return lines
+
+
+class Gauge(Counter):
+
+  metric_type = 'gauge'
+
+  def Dec(self, amount=1, *label_values):
+    self.Inc(-amount, *label_values)
+
+  def Set(self, value, *label_values):
+    self._lock.acquire()
+    try:
+      self._values[label_values] = value
+    finally:
+      self._lock.release()
+
+
+class Histogram(object):
+
+  metric_type = 'histogram'
+
+  def __init__(self, name, help_text, label_names=(),
+               buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = tuple(label_names)
+    self.buckets = tuple(buckets)
+    # Maps label values to [bucket counts..., count, sum]. The bucket
+    # counts are not cumulative; Render adds them up.
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def Observe(self, value, *label_values):
+    index = bisect.bisect_left(self.buckets, value)
+    self._lock.acquire()
+    try:
+      counts = self._values.get(label_values)
+      if counts is None:
+        counts = [0] * (len(self.buckets) + 2)
+        self._values[label_values] = counts
+      if index < len(self.buckets):
+        counts[index] += 1
+      counts[-2] += 1
+      counts[-1] += value
+    finally:
+      self._lock.release()
+
+  def Count(self, *label_values):
+    counts = self._values.get(label_values)
+    if counts is None:
+      return 0
+    return counts[-2]
+
+  def Render(self):
+    lines = []
+    for label_values, counts in sorted(self._values.items()):
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets, counts):
+        cumulative += bucket_count
+        lines.append('%s_bucket%s %d' % (
+            self.name, _FormatLabels(self.label_names, label_values,
+                                     ('le', repr(bound))), cumulative))
+      lines.append('%s_bucket%s %d' % (
+          self.name, _FormatLabels(self.label_names, label_values,
+                                   ('le', '+Inf')), counts[-2]))
+      labels = _FormatLabels(self.label_names, label_values)
+      lines.append('%s_sum%s %r' % (self.name, labels, counts[-1]))
+      lines.append('%s_count%s %d' % (self.name, labels, counts[-2]))
+    return lines
+
+
+class MetricsRegistry(object):
+  """A set of metrics which are rendered together."""
+
+  def __init__(self):
+    self.metrics = []
+
+  def Add(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def Render(self, extra_metrics=()):
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in list(self.metrics) + list(extra_metrics):
+      lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+      lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+      lines.extend(metric.Render())
+    return '\n'.join(lines) + '\n'
+
+
+class ServerMetrics(MetricsRegistry):
+  """The metrics recorded by the resource server's request handler."""
+
+  def __init__(self):
+    MetricsRegistry.__init__(self)
+    self.request_seconds = self.Add(Histogram(
+        'scorpion_request_seconds',
+        'Time taken to handle a request, by method and status.',
+        ('method', 'status')))
+    self.phase_seconds = self.Add(Histogram(
+        'scorpion_phase_seconds',
+        'Time spent in each phase of handling a request.', ('phase',)))
+    self.received_bytes = self.Add(Counter(
+        'scorpion_received_bytes_total', 'Request body bytes received.'))
+    self.sent_bytes = self.Add(Counter(
+        'scorpion_sent_bytes_total', 'Response body bytes sent.'))
+    self.active_connections = self.Add(Gauge(
+        'scorpion_active_connections', 'Connections being handled.'))
+    self.active_requests = self.Add(Gauge(
+        'scorpion_active_requests', 'Requests being handled.'))
+    self.rejected_requests = self.Add(Counter(
+        'scorpion_rejected_requests_total',
+        'Requests refused by admission control, by reason.', ('reason',)))
+
+  def ObservePhase(self, phase, seconds):
+    self.phase_seconds.Observe(seconds, phase)
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Salted password hashes for the users file.
+
+A hashed entry in the users file looks like:
+
+  jeff<TAB>pbkdf2_sha256$100000$<base64 salt>$<base64 hash>
+
+Entries which do not start with the pbkdf2_sha256$ prefix are treated as
+plain text passwords, so existing users files keep working until they are
+migrated. To hash every plain text password in a users file, run:
+
+  python -m scorpion_server.passwords config/users
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+
+
+HASH_ALGORITHM = 'pbkdf2_sha256'
+DEFAULT_ITERATIONS = 100000
+SALT_BYTES = 16
+
+
+def HashPassword(password, salt=None, iterations=DEFAULT_ITERATIONS):
+  """Returns the stored form of a password using a new random salt."""
+  if salt is None:
+    salt = os.urandom(SALT_BYTES)
+  digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+  return '%s$%d$%s$%s' % (HASH_ALGORITHM, iterations,
+                          base64.b64encode(salt), base64.b64encode(digest))
+
+
+def IsHashed(stored_password):
+  return stored_password.startswith(HASH_ALGORITHM + '$')
+
+
+def VerifyPassword(password, stored_password):
+  """Checks a password against a hashed or plain text stored password."""
+  if not IsHashed(stored_password):
+    return hmac.compare_digest(password, stored_password)
+  try:
+    algorithm, iterations, salt, digest = stored_password.split('$')
+    iterations = int(iterations)
+    salt = base64.b64decode(salt)
+    digest = base64.b64decode(digest)
+  except (ValueError, TypeError):
+    return False
+  return hmac.compare_digest(
+      hashlib.pbkdf2_hmac('sha256', password, salt, iterations), digest)
+
+
+def MigrateUsersFile(source, destination=None, iterations=DEFAULT_ITERATIONS):
+  """Hashes every plain text password in a users file.
+
+  Lines which are already hashed are copied unchanged. The new file is
+  written next to the destination and renamed into place, so a running
+  server never reads a partially written file.
+
+  Args:
+    source: str The users file to read.
+    destination: str (optional) Where to write the result. Defaults to
+        replacing source.
+    iterations: int (optional) The PBKDF2 iteration count for new hashes.
+
+  Returns:
+    The number of passwords which were hashed.
+  """
+  destination = destination or source
+  migrated = 0
+  lines = []
+  users_file = open(source, 'r')
+  try:
+    for line in users_file.readlines():
+      line_parts = line.rstrip('\r\n').split('\t')
+      if len(line_parts) < 2:
+        lines.append(line.rstrip('\r\n'))
+        continue
+      if not IsHashed(line_parts[1]):
+        line_parts[1] = HashPassword(line_parts[1], iterations=iterations)
+        migrated += 1
+      lines.append('\t'.join(line_parts))
+  finally:
+    users_file.close()
+  fd, temp_name = tempfile.mkstemp(
+      prefix='.users-', dir=os.path.dirname(os.path.abspath(destination)))
+  temp_file = os.fdopen(fd, 'w')
+  try:
+    temp_file.write('\n'.join(lines))
+  finally:
+    temp_file.close()
+  if os.name == 'nt' and os.path.exists(destination):
+    os.remove(destination)
+  os.rename(temp_name, destination)
+  return migrated
+
+
+def main(argv):
+  if len(argv) not in (2, 3):
+    print 'Usage: %s USERS_FILE [OUTPUT_FILE]' % argv[0]
+    return 2
+  migrated = MigrateUsersFile(*argv[1:])
+  print 'Hashed %d password(s).' % migrated
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Token bucket rate limits and concurrency limits for admitting requests.
+
+Rate limits are read from a file next to the permissions file, with one
+tab separated line per user:
+
+  <user>	<requests/s>	<request burst>	<bytes/s>	<byte burst>
+
+An empty user sets the limits for anonymous clients, which are counted
+separately for each client address. A user of * sets the limits for logged
+in users who do not have a line of their own. A rate of 0 leaves that
+budget unlimited, and lines starting with # are ignored. For example:
+
+  	5	20	1048576	4194304
+  *	50	100	10485760	52428800
+  jeff	0	0	0	0
+
+The byte budget counts request and response bodies. A request is only
+refused for bytes when its declared upload does not fit in the bucket, so a
+large download is charged after it is sent and delays the next request.
+"""
+
+import collections
+import math
+import os
+import threading
+import time
+
+
+RateLimit = collections.namedtuple(
+    'RateLimit',
+    'requests_per_second request_burst bytes_per_second byte_burst')
+
+
+def LoadRateLimits(file_name):
+  """Returns a dict mapping users to their RateLimit."""
+  limits = {}
+  if not file_name or not os.path.exists(file_name):
+    return limits
+  limits_file = open(file_name, 'r')
+  try:
+    for line in limits_file.readlines():
+      line = line.rstrip('\r\n')
+      if not line.strip() or line.startswith('#'):
+        continue
+      line_parts = line.split('\t')
+      if len(line_parts) != 5:
+        raise ValueError('Invalid rate limit line: %r' % line)
+      requests_per_second, request_burst, bytes_per_second, byte_burst = [
+          float(part) for part in line_parts[1:]]
+      limits[line_parts[0]] = RateLimit(
+          requests_per_second, max(request_burst, 1.0),
+          bytes_per_second, byte_burst)
+  finally:
+    limits_file.close()
+  return limits
+
+
+class TokenBucket(object):
+  """Holds up to burst tokens which are refilled at rate per second.
+
+  Taking more tokens than are available leaves the bucket in debt, which
+  is paid off by the refill before anything else is allowed.
+  """
+
+  def __init__(self, rate, burst, now):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = now
+
+  def WaitTime(self, amount, now):
+    """Returns the seconds until amount tokens are available."""
+    self.tokens = min(self.burst,
+                      self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    if self.tokens >= amount:
+      return 0
+    return (amount - self.tokens) / self.rate
+
+  def Take(self, amount):
+    self.tokens -= amount
+
+
+class RateLimiter(object):
+  """Keeps a request bucket and a byte bucket for each client.
+
+  Clients are identified by any hashable key, such as ('user', name) or
+  ('address', ip). At most max_clients sets of buckets are kept, and the
+  least recently used client is forgotten, which refills its buckets.
+  """
+
+  def __init__(self, max_clients=10000):
+    self.max_clients = max_clients
+    self._buckets = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def _GetBuckets(self, key, limit, now):
+    entry = self._buckets.pop(key, None)
+    if entry is None or entry[0] != limit:
+      # A changed limit, for example after a reload, starts a fresh bucket.
+      request_bucket = byte_bucket = None
+      if limit.requests_per_second:
+        request_bucket = TokenBucket(limit.requests_per_second,
+                                     limit.request_burst, now)
+      if limit.bytes_per_second:
+        byte_bucket = TokenBucket(limit.bytes_per_second, limit.byte_burst,
+                                  now)
+      entry = (limit, request_bucket, byte_bucket)
+    self._buckets[key] = entry
+    while len(self._buckets) > self.max_clients:
+      self._buckets.popitem(last=False)
+    return entry
+
+  def Admit(self, key, limit, upload_bytes=0):
+    """Takes a request token if the client is within its limits.
+
+    Args:
+      key: The client's identity.
+      limit: RateLimit or None The client's limits. None is unlimited.
+      upload_bytes: int (optional) The declared size of the request body.
+
+    Returns:
+      0 if the request may go ahead, otherwise the number of seconds the
+      client should wait before trying again.
+    """
+    if limit is None:
+      return 0
+    self._lock.acquire()
+    try:
+      now = time.time()
+      unused, request_bucket, byte_bucket = self._GetBuckets(key, limit, now)
+      wait = 0
+      if request_bucket is not None:
+        wait = request_bucket.WaitTime(1, now)
+      if byte_bucket is not None:
+        # A body larger than the whole bucket is allowed once it is full.
+        wait = max(wait, byte_bucket.WaitTime(
+            min(upload_bytes, byte_bucket.burst), now))
+      if not wait and request_bucket is not None:
+        request_bucket.Take(1)
+      return wait
+    finally:
+      self._lock.release()
+
+  def Charge(self, key, limit, byte_count):
+    """Takes the bytes a finished request transferred from its budget."""
+    if limit is None or not limit.bytes_per_second:
+      return
+    self._lock.acquire()
+    try:
+      self._GetBuckets(key, limit, time.time())[2].Take(byte_count)
+    finally:
+      self._lock.release()
+
+
+def RetryAfter(wait):
+  """Formats a wait in seconds for the Retry-After header."""
+  return str(max(1, int(math.ceil(wait))))
+
+
+class ConcurrencyLimit(object):
+  """Counts requests in progress and refuses any beyond the limit."""
+
+  def __init__(self, limit=None):
+    self.limit = limit
+    self.active = 0
+    self._lock = threading.Lock()
+
+  def Acquire(self):
+    """Returns True, and takes a slot, if one is free."""
+    self._lock.acquire()
+    try:
+      if self.limit is not None and self.active >= self.limit:
+        return False
+      self.active += 1
+      return True
+    finally:
+      self._lock.release()
+
+  def Release(self):
+    self._lock.acquire()
+    try:
+      self.active -= 1
+    finally:
+      self._lock.release()
@@ -14,197 +14,610 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
 import os
 import os.path
+import signal
 import socket
+import time
 import cgi
-import base64
+import json
+import optparse
+import sys
+import urlparse
+from ConfigParser import RawConfigParser
 from SocketServer import BaseServer
 from BaseHTTPServer import HTTPServer
 from SimpleHTTPServer import SimpleHTTPRequestHandler
-from OpenSSL import SSL
+from scorpion_server.accesslog import Logger
+from scorpion_server.accesslog import ReadHotPaths
+from scorpion_server.batch import BatchFormatError
+from scorpion_server.batch import FormatBatchFrame
+from scorpion_server.batch import FormatBatchFrameHeader
+from scorpion_server.batch import ReadBatchRequest
+from scorpion_server.compression import AvailableEncodings
+from scorpion_server.compression import CompressedVariantCache
+from scorpion_server.compression import IsCompressible
+from scorpion_server.compression import VariantETag
+from scorpion_server.concurrency import EventLoopMixIn
+from scorpion_server.concurrency import ServePreforked
+from scorpion_server.concurrency import ThreadPoolMixIn
+from scorpion_server.httputil import ChooseContentEncoding
+from scorpion_server.httputil import IsNotModified
+from scorpion_server.httputil import MakeETag
+from scorpion_server.httputil import ParseRange
+from scorpion_server.httputil import RangeIsCurrent
+from scorpion_server.httputil import UnsatisfiableRangeError
+from scorpion_server.journal import Journal
+from scorpion_server.listing import ResourceIndex
+from scorpion_server.metrics import Gauge
+from scorpion_server.metrics import ServerMetrics
+from scorpion_server.ratelimit import ConcurrencyLimit
+from scorpion_server.ratelimit import RateLimiter
+from scorpion_server.ratelimit import RetryAfter
+from scorpion_server.storage import CreateBackend
+from scorpion_server.storage import DataStore
+from scorpion_server.users import AUTH_CACHE_SIZE
+from scorpion_server.users import AUTH_CACHE_TTL
+from scorpion_server.users import SharedUserData
+from scorpion_server.users import UserData
+from scorpion_server.watch import WatchHub
 
 
 CONFIGURATION_DIRECTORY = 'config'
 USER_DATA_FILENAME = 'users'
 PERMISSIONS_DATA_FILENAME = 'permissions'
+# Per user request and byte rate limits, described in ratelimit.py. There
+# are no limits if the file does not exist.
+RATE_LIMITS_FILENAME = 'ratelimits'
 SSL_PEM_FILENAME = 'server.pem'
 RESOURCE_DIRECTORY = 'hosted'
+# Where resource content is kept: 'filesystem' stores each resource at the
+# matching path under RESOURCE_DIRECTORY, 'sharded' spreads the files over
+# hashed subdirectories and 'sqlite' keeps them in one database file.
+STORAGE_BACKEND = 'filesystem'
+# If set, writes are appended to a journal in this directory before they
+# are applied, and the journal is replayed when the server starts. See
+# journal.py for the JOURNAL_FSYNC_POLICY choices. A journal file is
+# truncated once it reaches JOURNAL_MAX_BYTES and its writes are applied.
+JOURNAL_DIRECTORY = None
+JOURNAL_FSYNC_POLICY = 'group'
+JOURNAL_SYNC_INTERVAL = 1
+JOURNAL_MAX_BYTES = 64 * 1024 * 1024
 DEFAULT_RESOURCE_FILENAME = 'index'
 SERVER_PORT = 443
 SERVER_AUTH_REALM = 'scorpion server'
 LOG_FILE_NAME = 'log'
+# The log file is rotated when it reaches LOG_MAX_BYTES, keeping
+# LOG_BACKUP_COUNT old files (log.1 is the newest).
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# How StartServer handles connections: 'single' handles one connection at a
+# time, 'threaded' uses a pool of WORKER_THREADS threads, 'event' waits for
+# client data in a select loop before handing connections to the thread
+# pool, and 'prefork' runs WORKER_PROCESSES threaded processes which share
+# the listening socket.
+CONCURRENCY_MODE = 'single'
+WORKER_THREADS = 16
+WORKER_PROCESSES = 4
+# The most connections a server process will queue or handle at once.
+MAX_CONNECTIONS = 128
+# Seconds the event loop waits for a new connection to send its request.
+CONNECTION_WAIT_TIMEOUT = 30
+# Total bytes of resource content the server keeps in memory, and the
+# largest single resource it will cache. Set RESOURCE_CACHE_BYTES to 0 to
+# disable the cache.
+RESOURCE_CACHE_BYTES = 16 * 1024 * 1024
+RESOURCE_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+# Resources are read from disk and sent to the client in pieces of this
+# many bytes, so memory use does not grow with the size of a resource.
+STREAM_CHUNK_SIZE = 64 * 1024
+# The Content-Type sent for resources without a recognised file extension,
+# such as the default index files.
+DEFAULT_CONTENT_TYPE = 'text/html'
+# Resources between these sizes are sent gzip (or brotli) encoded to
+# clients which accept it, unless their type is already compressed. The
+# compressed copies are kept in a cache of COMPRESSION_CACHE_BYTES. Set
+# COMPRESSION_MIN_BYTES to None to turn compression off.
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSION_MAX_BYTES = 8 * 1024 * 1024
+COMPRESSION_CACHE_BYTES = 8 * 1024 * 1024
+# The largest request body, in bytes, that the server will accept.
+MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+# Seconds an idle HTTP/1.1 connection is kept open waiting for the next
+# request, and the number of requests served on one connection before it
+# is closed. In the event mode idle connections wait in the event loop. In
+# the threaded and prefork modes each one holds a worker thread, so the
+# longest idle connection is closed when a new client finds every worker
+# busy.
+KEEPALIVE_TIMEOUT = 15
+MAX_KEEPALIVE_REQUESTS = 100
+# Seconds for which a TLS session may be resumed by a returning client.
+TLS_SESSION_TIMEOUT = 300
+# Request bodies up to this size are read and thrown away when a POST is
+# rejected so that the connection can be reused. Larger bodies cause the
+# connection to be closed instead.
+MAX_DISCARDED_BODY_BYTES = 64 * 1024
+# The resource which serves the server's metrics in the Prometheus text
+# format. Only logged in users with read permission on it may fetch it.
+METRICS_RESOURCE = '/_metrics'
+# Requests are counted in the metrics by method. Any other method is
+# counted as 'other', so that clients can not add label values at will.
+METRICS_METHODS = ('GET', 'HEAD', 'POST')
+# POSTing a list of reads and writes to this resource performs them all in
+# one request. See batch.py for the format. A batch may hold at most
+# BATCH_MAX_ITEMS items.
+BATCH_RESOURCE = '/_batch'
+BATCH_MAX_ITEMS = 1000
+BATCH_CONTENT_TYPE = 'application/x-scorpion-batch'
+# GET /_watch/<prefix> opens a Server-Sent Events stream of changes to the
+# resources under the prefix. Watchers are served by one thread, and at
+# most WATCH_MAX_WATCHERS may be open in each server process. The last
+# WATCH_HISTORY_SIZE changes are kept for clients which reconnect. Watching
+# is refused in the prefork mode, since each process only sees the writes
+# it handles itself.
+WATCH_RESOURCE = '/_watch'
+WATCH_MAX_WATCHERS = 1000
+WATCH_HISTORY_SIZE = 1000
+WATCH_HEARTBEAT_INTERVAL = 15
+# GET /_list/<prefix>?after=<name>&limit=<n> returns the names, sizes and
+# modification times of the resources under the prefix which the user may
+# read, as JSON. Pages hold LISTING_DEFAULT_LIMIT resources unless the
+# client asks for more, up to LISTING_MAX_LIMIT. Listings come from an
+# in-memory index which is rebuilt from storage every
+# LISTING_RESCAN_INTERVAL seconds to pick up changes made outside of this
+# server process. None turns the rescans off.
+LISTING_RESOURCE = '/_list'
+LISTING_DEFAULT_LIMIT = 100
+LISTING_MAX_LIMIT = 1000
+LISTING_RESCAN_INTERVAL = 60
+# Rate limit buckets are kept for at most this many users and anonymous
+# client addresses in each server process.
+RATE_LIMIT_MAX_CLIENTS = 10000
+# The most requests, and the most POSTs, a server process will handle at
+# once. Requests beyond these limits get a 503 before their body is read.
+# None means no limit.
+MAX_CONCURRENT_REQUESTS = None
+MAX_CONCURRENT_UPLOADS = None
+
+# AUTH_CACHE_SIZE and AUTH_CACHE_TTL, which control how long successful
+# logins are remembered, are imported from users.py. Set AUTH_CACHE_SIZE
+# to 0 to check the password on every request.
+# Before accepting connections the server reads the most requested
+# PREWARM_RESOURCES resources, found in the last PREWARM_LOG_BYTES of the
+# log file, into the resource cache. Set PREWARM_RESOURCES to 0 to start
+# with a cold cache.
+PREWARM_RESOURCES = 100
+PREWARM_LOG_BYTES = 1024 * 1024
+
+# pyOpenSSL's SSL module, imported when the first server is created so that
+# importing this module does not load the TLS stack.
+SSL = None
+# Errors which mean the client has gone away. _LoadSSL adds the TLS errors.
+_DISCONNECT_ERRORS = (socket.error,)
 
 
 class BadCredentialsError(Exception):
   pass
-  
-  
-class Logger(object):
-    
-  def __init__(self):
-    self.log_file = None
-    
-  def openLog(self):
-    self.log_file = open(LOG_FILE_NAME, 'w')
 
-  def writeln(self, text):
-    if self.log_file:
-      self.log_file.write('%s\n' % text)
 
-      
+class RequestBodyError(Exception):
+  """Raised when a request body can not be read.
+
+  The code attribute holds the HTTP status code to send to the client.
+  """
+
+  def __init__(self, code, message):
+    Exception.__init__(self, message)
+    self.code = code
+
+
+def _LoadSSL():
+  global SSL, _DISCONNECT_ERRORS
+  if SSL is None:
+    from OpenSSL import SSL
+    _DISCONNECT_ERRORS = (SSL.SysCallError, SSL.ZeroReturnError,
+                          socket.error)
+  return SSL
+  
+  
 def OpenLog(logger):
-  logger.openLog()
+  logger.openLog(LOG_FILE_NAME, LOG_MAX_BYTES, LOG_BACKUP_COUNT)
   
   
 # Module level global object to
 log = Logger()
+# Latency histograms, byte counters and gauges for this process.
+metrics = ServerMetrics()
 
 
 class ScorpionResourceServer(HTTPServer):
 
+  # A single threaded server closes each connection after one request, so
+  # that an idle keep-alive connection can not block every other client.
+  keep_alive = False
+  # Cleared by StartServer when the server is shared by several processes.
+  watch_enabled = True
+
   def __init__(self, server_address, HandlerClass):
     BaseServer.__init__(self, server_address, HandlerClass)
+    self.socket = self._CreateSocket()
+    self.server_bind()
+    self.server_activate()
+    # All request handlers share one UserData snapshot which is only
+    # reloaded when the users or permissions files change.
+    self.user_data_source = SharedUserData(
+        os.path.join(CONFIGURATION_DIRECTORY, USER_DATA_FILENAME),
+        os.path.join(CONFIGURATION_DIRECTORY, PERMISSIONS_DATA_FILENAME),
+        os.path.join(CONFIGURATION_DIRECTORY, RATE_LIMITS_FILENAME),
+        auth_cache_size=AUTH_CACHE_SIZE, auth_cache_ttl=AUTH_CACHE_TTL)
+    self.rate_limiter = RateLimiter(RATE_LIMIT_MAX_CLIENTS)
+    self.request_slots = ConcurrencyLimit(MAX_CONCURRENT_REQUESTS)
+    self.upload_slots = ConcurrencyLimit(MAX_CONCURRENT_UPLOADS)
+    # The data store is shared as well so that its cache lives as long as
+    # the server.
+    journal = None
+    if JOURNAL_DIRECTORY:
+      journal = Journal(JOURNAL_DIRECTORY, JOURNAL_FSYNC_POLICY,
+                        JOURNAL_SYNC_INTERVAL, JOURNAL_MAX_BYTES)
+    self.data_store = DataStore(RESOURCE_DIRECTORY, DEFAULT_RESOURCE_FILENAME,
+                                cache_size=RESOURCE_CACHE_BYTES,
+                                max_cached_resource_size=
+                                    RESOURCE_CACHE_MAX_ENTRY_BYTES,
+                                backend=CreateBackend(
+                                    STORAGE_BACKEND, RESOURCE_DIRECTORY,
+                                    DEFAULT_RESOURCE_FILENAME),
+                                journal=journal)
+    # The number of journaled writes which were applied at startup.
+    self.replayed_writes = self.data_store.ReplayJournal()
+    self.compressed_variants = CompressedVariantCache(COMPRESSION_CACHE_BYTES)
+    # Connections which have been handed to the watch hub, and so must not
+    # be closed when their request handler returns.
+    self.detached_requests = set()
+    self.watch_hub = WatchHub(self.shutdown_request,
+                              max_watchers=WATCH_MAX_WATCHERS,
+                              history_size=WATCH_HISTORY_SIZE,
+                              heartbeat_interval=WATCH_HEARTBEAT_INTERVAL)
+    self.data_store.AddListener(self.watch_hub.Notify)
+    self.resource_index = ResourceIndex(self.data_store.backend,
+                                        LISTING_RESCAN_INTERVAL)
+    self.resource_index.Rescan()
+    self.data_store.AddListener(self.resource_index.Update)
+
+  def _CreateSocket(self):
+    """Returns the listening socket, which speaks TLS.
+
+    Subclasses which serve plain sockets, as the tests do, override this
+    and _ShutdownConnection.
+    """
+    _LoadSSL()
     ctx = SSL.Context(SSL.SSLv23_METHOD)
     # Server.pem's location (containing the server private key and
     # the server certificate).
     fpem = os.path.join(CONFIGURATION_DIRECTORY, SSL_PEM_FILENAME)
     ctx.use_privatekey_file(fpem)
     ctx.use_certificate_file(fpem)
-    self.socket = SSL.Connection(ctx, socket.socket(self.address_family,
-                                                    self.socket_type))
-    self.server_bind()
-    self.server_activate()
+    self._EnableSessionResumption(ctx)
+    return SSL.Connection(ctx, socket.socket(self.address_family,
+                                             self.socket_type))
+
+  def _EnableSessionResumption(self, ctx):
+    """Lets returning clients skip the full TLS handshake.
+
+    Sessions are kept in OpenSSL's server side cache, which needs a session
+    id context to be set. Session tickets are left enabled, and since the
+    ticket keys belong to the context they also work across prefork
+    children.
+    """
+    if not hasattr(ctx, 'set_session_cache_mode'):
+      # Older versions of pyOpenSSL do not expose the session cache.
+      return
+    ctx.set_session_id('scorpion-server')
+    ctx.set_session_cache_mode(SSL.SESS_CACHE_SERVER)
+    ctx.set_timeout(TLS_SESSION_TIMEOUT)
+
+  def GetUserData(self):
+    return self.user_data_source.GetUserData()
+
+  def Prewarm(self, resources):
+    """Loads the user data and reads resources into the resource cache.
+
+    Called before the server accepts connections, so that the first
+    requests after a restart do not each wait on compiling the permission
+    index or reading from disk. Resources which can no longer be read are
+    skipped.
+
+    Args:
+      resources: list of str The resources to read, most important first.
+
+    Returns:
+      The number of resources which were found.
+    """
+    self.GetUserData()
+    if self.data_store.cache is None:
+      return 0
+    loaded = 0
+    for resource in resources:
+      try:
+        self.data_store.OpenResource(resource).Close()
+      except (IOError, OSError):
+        continue
+      loaded += 1
+    return loaded
+
+  def DetachRequest(self, request):
+    """Keeps a connection open after its request handler returns."""
+    self.detached_requests.add(request)
+
+  def shutdown_request(self, request):
+    if request in self.detached_requests:
+      self.detached_requests.discard(request)
+      return
+    self._ShutdownConnection(request)
+    self.close_request(request)
+
+  def _ShutdownConnection(self, request):
+    # SSL connections do not take a how argument to shutdown, so send the
+    # TLS close notification before closing the socket.
+    try:
+      request.shutdown()
+    except (SSL.Error, socket.error):
+      pass
+
+
+class ThreadedScorpionResourceServer(ThreadPoolMixIn, ScorpionResourceServer):
+
+  keep_alive = True
+
+  def __init__(self, server_address, HandlerClass):
+    ScorpionResourceServer.__init__(self, server_address, HandlerClass)
+    self.worker_threads = WORKER_THREADS
+    self.max_connections = MAX_CONNECTIONS
+
+
+class EventLoopScorpionResourceServer(EventLoopMixIn, ScorpionResourceServer):
+
+  keep_alive = True
+
+  def __init__(self, server_address, HandlerClass):
+    ScorpionResourceServer.__init__(self, server_address, HandlerClass)
+    self.worker_threads = WORKER_THREADS
+    self.max_connections = MAX_CONNECTIONS
+    self.connection_timeout = CONNECTION_WAIT_TIMEOUT
+    self.keepalive_timeout = KEEPALIVE_TIMEOUT
+
+
+# The server class used by StartServer for each concurrency mode. Prefork
+# children each run a threaded server.
+SERVER_CLASSES = {'single': ScorpionResourceServer,
+                  'threaded': ThreadedScorpionResourceServer,
+                  'event': EventLoopScorpionResourceServer,
+                  'prefork': ThreadedScorpionResourceServer}
 
 
-class UserData(object):
-  
-  def __init__(self, credentials_file=None, permissions_file=None):
-    self.user_credentials = {}
-    self.permissions = {}
-    if credentials_file:
-      self.LoadUserCredentials(credentials_file)
-    if permissions_file:
-      self.LoadPermissionsMap(permissions_file)
-    
-  def LoadUserCredentials(self, file_name):
-    if file_name and os.path.exists(file_name):
-      self.user_credentials = {}
-      user_file = open(file_name, 'r')
-      for line in user_file.readlines():
-        line_parts = line.strip().split('\t')
-        self.user_credentials[line_parts[0]] = line_parts[1]
-    
-  def LoadPermissionsMap(self, file_name):
-    if file_name and os.path.exists(file_name):
-      self.permissions = {}
-      permissions_file = open(file_name, 'r')
-      for line in permissions_file.readlines():
-        line_parts = line.strip().split('\t')
-        mode = line_parts[0]
-        username = line_parts[1]
-        resource = line_parts[2]
-        if not self.permissions.has_key(mode):
-          self.permissions[mode] = {}
-        if not self.permissions[mode].has_key(username):
-          self.permissions[mode][username] = []
-        self.permissions[mode][username].append(resource)
-    
-  def AuthenticateUser(self, username, password):
-    if username is None:
-      return ''
-    if (self.user_credentials.has_key(username) and 
-        self.user_credentials[username] == password):
-      return username
-    else:
-      return None
-      
-  def UserCanReadResource(self, username, resource):
-    if self.UserCanWriteResource(username, resource):
-      return True
-    if self.permissions['r'].has_key(username):
-      for allowed_resource in self.permissions['r'][username]:
-        if resource.startswith(allowed_resource):
-          return True
-    if username != '':
-      return self.UserCanReadResource('', resource)
-    else:
-      return False
-      
-  def UserCanWriteResource(self, username, resource):
-    if self.permissions['w'].has_key(username):
-      for allowed_resource in self.permissions['w'][username]:
-        if resource.startswith(allowed_resource):
-          return True
-    if username != '':
-      return self.UserCanWriteResource('', resource)
-    else:
-      return False
-    
-  def FindUserFromAuthHeader(self, auth_header):
-    if auth_header:
-      auth_string = base64.decodestring(auth_header.split(' ')[-1])
-      user_pass_list = auth_string.split(':')
-      username = user_pass_list[0]
-      password = user_pass_list[-1]
-      return self.AuthenticateUser(username, password)
-    else:
-      # If there was no auth header, this is the empty anonymous user.
-      return ''
-    
- 
-class DataStore(object):
-  
-  def __init__(self, resource_directory, default_file):
-    # The directory in which all of the resources live.
-    self.resource_directory = resource_directory
-    # The file name to rea from or write to if the resource points
-    # to a directory. Example: 'index' or 'index.html'
-    self.default_file = default_file
-  
-  def _ConvertResourceToFileName(self, resource):
-    file_parts = resource.split('/')
-    full_path = self.resource_directory
-    for part in file_parts:
-      full_path = os.path.join(full_path, part)
-    if os.path.exists(full_path):
-      if os.path.isdir(full_path):
-        full_path = os.path.join(full_path, self.default_file)
-    return full_path
-    
-  def ReadResource(self, resource):
-    file_name = self._ConvertResourceToFileName(resource)
-    # Check to see if the user can read the resource.
-    
-    resource_file = open(file_name, 'rb')
-    result = resource_file.read()
-    resource_file.close()
-    return result
-    
-  def ResourceExists(self, resource):
-    file_name = self._ConvertResourceToFileName(resource)
-    return os.path.exists(file_name)
-  
-  def WriteResource(self, resource, data):
-    file_name = self._ConvertResourceToFileName(resource)
-    resource_file = open(file_name, 'wb')
-    resource_file.write(data)
-    resource_file.close()
-    return data
-    
-    
 class ScorpionResourceRequestHandler(SimpleHTTPRequestHandler):
 
+  # Buffer writes so that the status line, headers and the first part of
+  # the body go out together instead of as one TLS record per line.
+  wbufsize = STREAM_CHUNK_SIZE
+  # Every response carries a Content-Length, so connections can be reused.
+  protocol_version = 'HTTP/1.1'
+  # BaseHTTPServer predates the 429 status code.
+  responses = dict(SimpleHTTPRequestHandler.responses)
+  responses[429] = ('Too Many Requests',
+                    'The user has sent too many requests in a given time.')
+
   def setup(self):
     self.connection = self.request
     self.rfile = socket._fileobject(self.request, 'rb', self.rbufsize)
     self.wfile = socket._fileobject(self.request, 'wb', self.wbufsize)
-    self.user_data = UserData()
-    self.user_data.LoadUserCredentials(os.path.join(CONFIGURATION_DIRECTORY,
-                                                    USER_DATA_FILENAME))
-    self.user_data.LoadPermissionsMap(os.path.join(CONFIGURATION_DIRECTORY,
-                                                   PERMISSIONS_DATA_FILENAME))
-    self.data_store = DataStore(RESOURCE_DIRECTORY, DEFAULT_RESOURCE_FILENAME)
+    # Take one snapshot of the user data so that the whole request sees
+    # consistent credentials and permissions even if a reload happens.
+    self.user_data = self.server.GetUserData()
+    self.data_store = self.server.data_store
+    self.compressed_variants = self.server.compressed_variants
+    self.watch_hub = self.server.watch_hub
+    metrics.active_connections.Inc()
+
+  def finish(self):
+    metrics.active_connections.Dec()
+    SimpleHTTPRequestHandler.finish(self)
+
+  def handle_one_request(self):
+    self.request_start = time.time()
+    self.command = None
+    self.request_user = None
+    self.user_checked = False
+    self.response_status = None
+    self.response_bytes = 0
+    self.request_bytes = 0
+    self.held_slots = []
+    self.rate_limit_key = None
+    self.request_messages = []
+    metrics.active_requests.Inc()
+    try:
+      SimpleHTTPRequestHandler.handle_one_request(self)
+    except _DISCONNECT_ERRORS:
+      # The client went away, which is routine for idle keep-alive
+      # connections, so just close our end.
+      self.close_connection = 1
+    finally:
+      for slots in self.held_slots:
+        slots.Release()
+      if self.rate_limit_key is not None:
+        self.server.rate_limiter.Charge(
+            self.rate_limit_key, self.rate_limit,
+            self.request_bytes + self.response_bytes)
+      metrics.active_requests.Dec()
+    if self.command or self.request_messages:
+      latency = time.time() - self.request_start
+      if self.command:
+        if self.command in METRICS_METHODS:
+          method = self.command
+        else:
+          method = 'other'
+        metrics.request_seconds.Observe(latency, method,
+                                        self.response_status)
+      metrics.sent_bytes.Inc(self.response_bytes)
+      # A request line which could not be parsed leaves no command or path,
+      # but the error sent for it is still recorded.
+      log.LogRequest(self.command, getattr(self, 'path', None),
+                     self.request_user, self.response_status,
+                     self.response_bytes, latency, self.client_address[0],
+                     self.request_messages or None)
+
+  def parse_request(self):
+    if not SimpleHTTPRequestHandler.parse_request(self):
+      return False
+    return self._AdmitRequest()
+
+  def _AdmitRequest(self):
+    """Decides whether to handle a request before its body is read.
+
+    Sends a 503 if the server is already handling as many requests, or
+    uploads, as it allows, and a 429 if the user has used up its rate
+    limit. Only logins which are already cached count as users here, since
+    checking a password is slow. Other requests are held to the anonymous
+    limit for the client address, and their credentials are only checked
+    once they have been admitted.
+
+    Returns:
+      True if the request should be handled.
+    """
+    for slots, wanted in ((self.server.request_slots, True),
+                          (self.server.upload_slots, self.command == 'POST')):
+      if not wanted:
+        continue
+      if not slots.Acquire():
+        metrics.rejected_requests.Inc(1, 'overloaded')
+        # Reading the body would be the work we are trying to shed.
+        self.close_connection = 1
+        self._SendRetryLater(503, 1)
+        return False
+      self.held_slots.append(slots)
+    user = self.user_data.FindCachedUser(
+        self.headers.getheader('Authorization'))
+    if user:
+      key = ('user', user)
+    else:
+      key = ('address', self.client_address[0])
+    limit = self.user_data.RateLimitFor(user)
+    try:
+      upload_bytes = max(int(self.headers.getheader('content-length', 0)), 0)
+    except ValueError:
+      upload_bytes = 0
+    wait = self.server.rate_limiter.Admit(key, limit, upload_bytes)
+    if wait:
+      metrics.rejected_requests.Inc(1, 'rate_limited')
+      self._DiscardRequestBody()
+      self._SendRetryLater(429, wait)
+      return False
+    self.rate_limit_key = key
+    self.rate_limit = limit
+    return True
+
+  def _SendRetryLater(self, code, wait):
+    content = self.responses[code][0]
+    self.send_response(code)
+    self.send_header('Retry-After', RetryAfter(wait))
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self._WriteBody(content)
+    # BaseHTTPRequestHandler does not flush after a rejected request.
+    self.wfile.flush()
+
+  def _AuthenticatedUser(self):
+    """Checks the request's credentials, once, and returns the user.
+
+    Returns:
+      The username, '' for an anonymous request, or None if the
+      credentials are bad.
+    """
+    if not self.user_checked:
+      started = time.time()
+      self.request_user = self.user_data.FindUserFromAuthHeader(
+          self.headers.getheader('Authorization'))
+      metrics.ObservePhase('auth', time.time() - started)
+      self.user_checked = True
+    return self.request_user
+
+  def log_request(self, code='-', size='-'):
+    # Requests are recorded by handle_one_request once they finish.
+    pass
+
+  def log_message(self, format, *args):
+    # Messages are kept with the request's record in the log, so that every
+    # line of the log is a JSON record.
+    self.request_messages.append(format % args)
+
+  def _WriteBody(self, data):
+    self.wfile.write(data)
+    self.response_bytes += len(data)
+
+  def handle(self):
+    """Serves requests on the connection until it is closed or goes idle.
+
+    Between requests an idle connection is handed back to the event loop
+    if the server has one. Otherwise this worker waits up to
+    KEEPALIVE_TIMEOUT seconds for the next request, unless the server
+    gives the connection up sooner so that another client can be served.
+    """
+    self.close_connection = 1
+    self.requests_on_connection = 1
+    if getattr(self.server, 'keep_alive', False):
+      # Carry on counting on a connection which the event loop handed back.
+      self.requests_on_connection += self.server.RequestsServed(self.request)
+    self.handle_one_request()
+    while not self.close_connection:
+      # BaseHTTPRequestHandler does not flush the error it sends for a
+      # request it can not handle, such as one with an unknown method.
+      self.wfile.flush()
+      if not self._RequestIsBuffered():
+        if self.server.KeepAlive(self.request, self.requests_on_connection):
+          return
+        if not self.server.WaitForData(self.connection, KEEPALIVE_TIMEOUT):
+          return
+      self.requests_on_connection += 1
+      self.handle_one_request()
+
+  def _RequestIsBuffered(self):
+    """Returns True if the next request has already been read in part.
+
+    Data which has already been read from the socket will not wake select.
+    """
+    read_buffer = getattr(self.rfile, '_rbuf', None)
+    if read_buffer is not None and read_buffer.tell():
+      return True
+    return hasattr(self.connection, 'pending') and self.connection.pending()
+
+  def send_response(self, code, message=None):
+    self.response_status = code
+    SimpleHTTPRequestHandler.send_response(self, code, message)
+    if (not getattr(self.server, 'keep_alive', False) or
+        self.requests_on_connection >= MAX_KEEPALIVE_REQUESTS or
+        self.close_connection):
+      # Sending this header also sets self.close_connection.
+      self.send_header('Connection', 'close')
+
+  def send_error(self, code, message=None):
+    """Sends an error page with a Content-Length so keep-alive can continue."""
+    try:
+      short, explain = self.responses[code]
+    except KeyError:
+      short, explain = '???', '???'
+    if message is None:
+      message = short
+    self.log_error('code %d, message %s', code, message)
+    content = self.error_message_format % {'code': code,
+                                           'message': cgi.escape(message),
+                                           'explain': explain}
+    self.send_response(code, message)
+    self.send_header('Content-Type', self.error_content_type)
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self._WriteBody(content)
     
   def _RemoveUrlParameters(self, url):
     """Strips all URL parameters from the request. 
@@ -230,80 +643,681 @@ class ScorpionResourceRequestHandler(SimpleHTTPRequestHandler):
           permisisons of the user on the resource. This is usually
           either self.user_data.UserCanReadResource or
           self.user_data.UserCanWriteResource.
-      resource: str The resource which is to be read or written.
-          This is usually self.path.
+      resource: str The resource which is to be read or written, without
+          any URL parameters.
     """
     # Validate the credentials sent by the user.
-    auth_header = self.headers.getheader('Authorization')
-    user = self.user_data.FindUserFromAuthHeader(auth_header)
+    user = self._AuthenticatedUser()
     # If the user's credentials were bad, send a 401 response.
     if user is None:
       self.AskUserToAuthenticate()
-      log.writeln('User sent bad credentials.')
+      self.log_message('User sent bad credentials.')
       return False
     # Check to see if the user has permissions to read the resource.
-    if not user_may_do_action(user, self.path):
+    started = time.time()
+    allowed = user_may_do_action(user, resource)
+    metrics.ObservePhase('acl', time.time() - started)
+    if not allowed:
       # If the user does not have permission but they are not logged in, send
       # a 401 to ask for credentials.
       if user == '':
         self.AskUserToAuthenticate()
-        log.writeln('User could not read' + resource +
-            'because they were not logged in.')
+        self.log_message('User could not read %s because they were not '
+                         'logged in.', resource)
         return False
       else:
         # If the user does not have permission and they are logged in, send 
         # a 403.
         self.send_error(403)
-        log.writeln('User does not have permissions to read %s.' % ( 
-            resource))
+        self.log_message('User does not have permissions to read %s.',
+                         resource)
         return False
     return True
   
   def do_GET(self):
     resource = self._RemoveUrlParameters(self.path)
+    if resource == METRICS_RESOURCE:
+      self._SendMetrics()
+      return
+    if (resource == WATCH_RESOURCE or
+        resource.startswith(WATCH_RESOURCE + '/')):
+      self._Watch(resource[len(WATCH_RESOURCE):] or '/')
+      return
+    if (resource == LISTING_RESOURCE or
+        resource.startswith(LISTING_RESOURCE + '/')):
+      self._SendListing(resource[len(LISTING_RESOURCE):] or '/')
+      return
     if self._UserHasReadPermissions(resource):
       # The user has permissions to read the resource.
       # Check to make sure that the resource is valid.
-      if self.data_store.ResourceExists(resource):
-        # If the resource exists, send it!
-        resource_data = self.data_store.ReadResource(resource)
-        self.wfile.write(resource_data)
-        log.writeln('Sent the resource %s' % resource)
-        return
-      else:
+      started = time.time()
+      try:
+        handle = self.data_store.OpenResource(resource)
+      except IOError:
         # The resource does not exist, so send a 404.
-        log.writeln('Resource %s not found.' % resource)
         self.send_error(404)
         return
+      finally:
+        metrics.ObservePhase('open', time.time() - started)
+      # If the resource exists, send it!
+      try:
+        self._SendResource(handle)
+      finally:
+        handle.Close()
+
+  def _SendResource(self, handle):
+    """Sends a resource in full, encoded, as a byte range, or as a 304."""
+    etag = MakeETag(handle.size, handle.mtime)
+    last_modified = self.date_time_string(int(handle.mtime))
+    content_type = self._GuessContentType(handle)
+    range_header = self.headers.getheader('range')
+    compressible = self._IsCompressible(handle, content_type)
+    coding = None
+    if compressible and not range_header:
+      # Byte ranges always refer to the unencoded content.
+      coding = ChooseContentEncoding(self.headers.getheader('accept-encoding'),
+                                     AvailableEncodings())
+    if coding:
+      identity_etag = etag
+      etag = VariantETag(etag, coding)
+    if IsNotModified(self.headers.getheader('if-none-match'),
+                     self.headers.getheader('if-modified-since'),
+                     etag, handle.mtime):
+      self.send_response(304)
+      self._SendValidators(etag, last_modified)
+      if compressible:
+        self.send_header('Vary', 'Accept-Encoding')
+      self.end_headers()
+      return
+    if coding:
+      started = time.time()
+      content = self.compressed_variants.GetVariant(
+          handle.file_name, identity_etag, coding, handle.Read)
+      metrics.ObservePhase('compress', time.time() - started)
+      self.send_response(200)
+      self.send_header('Content-Type', content_type)
+      self.send_header('Content-Encoding', coding)
+      self.send_header('Content-Length', str(len(content)))
+      self.send_header('Vary', 'Accept-Encoding')
+      self._SendValidators(etag, last_modified)
+      self.end_headers()
+      started = time.time()
+      self._WriteBody(content)
+      metrics.ObservePhase('send', time.time() - started)
+      return
+    status = 200
+    start, end = 0, handle.size
+    if range_header and RangeIsCurrent(self.headers.getheader('if-range'),
+                                       etag, handle.mtime):
+      try:
+        byte_range = ParseRange(range_header, handle.size)
+      except UnsatisfiableRangeError:
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % handle.size)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      if byte_range is not None:
+        status = 206
+        start, end = byte_range
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(end - start))
+    if status == 206:
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+          start, end - 1, handle.size))
+    self.send_header('Accept-Ranges', 'bytes')
+    if compressible:
+      self.send_header('Vary', 'Accept-Encoding')
+    self._SendValidators(etag, last_modified)
+    self.end_headers()
+    started = time.time()
+    for chunk in handle.Chunks(start, end, STREAM_CHUNK_SIZE):
+      self._WriteBody(chunk)
+    metrics.ObservePhase('send', time.time() - started)
+
+  def _IsCompressible(self, handle, content_type):
+    if COMPRESSION_MIN_BYTES is None:
+      return False
+    return (COMPRESSION_MIN_BYTES <= handle.size <= COMPRESSION_MAX_BYTES and
+            IsCompressible(content_type))
+
+  def _Watch(self, prefix):
+    """Streams changes to resources under prefix as Server-Sent Events.
+
+    A user who may read the prefix may read every resource under it, so
+    the permissions are only checked once. After the headers are sent the
+    connection is handed to the watch hub and this thread is freed.
+    """
+    if not self.server.watch_enabled:
+      self.send_error(501, 'Watching is not available in the prefork mode')
+      return
+    if not self._UserHasReadPermissions(prefix):
+      return
+    if self.watch_hub.IsFull():
+      self.send_error(503, 'Too many watchers')
+      return
+    # The stream has no length, so it ends when the connection is closed.
+    self.close_connection = 1
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+    self.wfile.flush()
+    self.server.DetachRequest(self.request)
+    self.watch_hub.Attach(self.request, prefix,
+                          self.headers.getheader('last-event-id'))
+
+  def _SendListing(self, prefix):
+    """Sends one page of the resources under prefix which the user may read.
+
+    A user who may read the prefix may read everything under it, so only
+    listings of other prefixes check each resource.
+    """
+    user = self._AuthenticatedUser()
+    if user is None:
+      self.AskUserToAuthenticate()
+      return
+    query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+    after = query.get('after', [None])[0]
+    try:
+      limit = int(query.get('limit', [LISTING_DEFAULT_LIMIT])[0])
+    except ValueError:
+      limit = 0
+    if limit < 1:
+      self.send_error(400, 'Invalid limit')
+      return
+    limit = min(limit, LISTING_MAX_LIMIT)
+    is_visible = None
+    if not self.user_data.UserCanReadResource(user, prefix):
+      is_visible = lambda name: self.user_data.UserCanReadResource(user, name)
+    started = time.time()
+    entries, next_after = self.server.resource_index.List(
+        prefix, after, limit, is_visible)
+    metrics.ObservePhase('list', time.time() - started)
+    content = json.dumps({'prefix': prefix,
+                          'resources': [{'name': name, 'size': size,
+                                         'mtime': mtime}
+                                        for name, size, mtime in entries],
+                          'next_after': next_after}, sort_keys=True)
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(content)))
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+    self._WriteBody(content)
+
+  def _SendMetrics(self):
+    if not self._UserHasReadPermissions(METRICS_RESOURCE):
+      return
+    if not self.request_user:
+      # Metrics are never served to anonymous users.
+      self.AskUserToAuthenticate()
+      return
+    process_metrics = []
+    for name, value in sorted(self.data_store.CacheStats().items()):
+      gauge = Gauge('scorpion_resource_cache_%s' % name,
+                    'Resource cache %s.' % name)
+      gauge.Set(value)
+      process_metrics.append(gauge)
+    for name, value in sorted(self.data_store.JournalStats().items()):
+      gauge = Gauge('scorpion_journal_%s' % name, 'Write journal %s.' % name)
+      gauge.Set(value)
+      process_metrics.append(gauge)
+    for name, value in sorted(self.compressed_variants.Stats().items()):
+      gauge = Gauge('scorpion_compression_cache_%s' % name,
+                    'Compressed variant cache %s.' % name)
+      gauge.Set(value)
+      process_metrics.append(gauge)
+    watchers = Gauge('scorpion_watchers', 'Open watch streams.')
+    watchers.Set(self.watch_hub.WatcherCount())
+    process_metrics.append(watchers)
+    indexed = Gauge('scorpion_indexed_resources',
+                    'Resources in the listing index.')
+    indexed.Set(len(self.server.resource_index))
+    process_metrics.append(indexed)
+    dropped = Gauge('scorpion_log_dropped_lines',
+                    'Log lines dropped because the log queue was full.')
+    dropped.Set(log.dropped)
+    process_metrics.append(dropped)
+    content = metrics.Render(process_metrics)
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(content)))
+    self.send_header('Cache-Control', 'no-store')
+    self.end_headers()
+    self._WriteBody(content)
+
+  def _SendValidators(self, etag, last_modified):
+    self.send_header('ETag', etag)
+    self.send_header('Last-Modified', last_modified)
+    # Clients may keep a copy but must revalidate it before each use, which
+    # turns repeated polls into small 304 responses.
+    self.send_header('Cache-Control', 'no-cache')
+
+  def _GuessContentType(self, handle):
+    if os.path.splitext(handle.file_name)[1]:
+      return self.guess_type(handle.file_name)
+    return DEFAULT_CONTENT_TYPE
       
   def do_POST(self):
-    if self._UserHasWritePermissions(self.path):
-      data_length = int(self.headers.getheader('content-length'))
-      request_body = self.rfile.read(data_length)
-      log.writeln('The request body was: %s' % request_body)
-      resource_data = self.data_store.WriteResource(self.path, request_body)
-      self.wfile.write(resource_data)
-      log.writeln('Wrote the resource %s to disk.' % self.path)
+    resource = self._RemoveUrlParameters(self.path)
+    if resource == BATCH_RESOURCE:
+      self._HandleBatch()
+      return
+    if not self._UserHasWritePermissions(resource):
+      self._DiscardRequestBody()
+    else:
+      started = time.time()
+      try:
+        file_stat = self.data_store.WriteResourceStream(
+            resource, self._RequestBodyChunks())
+      except RequestBodyError, e:
+        # The rest of the body may still be unread, so the connection can
+        # not be reused.
+        self.close_connection = 1
+        self.log_message('Could not write %s: %s', resource, e)
+        self.send_error(e.code, str(e))
+        return
+      except (IOError, OSError), e:
+        self.close_connection = 1
+        self.log_message('Could not write %s: %s', resource, e)
+        # Writing below a directory which does not exist.
+        if e.errno == errno.ENOENT:
+          self.send_error(404)
+        else:
+          self.send_error(500)
+        return
+      finally:
+        metrics.ObservePhase('store', time.time() - started)
+      etag = MakeETag(file_stat.st_size, file_stat.st_mtime)
+      acknowledgement = json.dumps({'size': file_stat.st_size, 
+                                    'etag': etag})
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(acknowledgement)))
+      self.send_header('ETag', etag)
+      self.end_headers()
+      self._WriteBody(acknowledgement)
+
+  def _HandleBatch(self):
+    """Reads and writes a list of resources in one request.
+
+    The credentials are checked once for the whole batch, but each item is
+    checked against the permissions on its own, so a forbidden or missing
+    resource only fails its own item. Items are read from the body and
+    handled one at a time, and their results are streamed back with a
+    chunked response. Each item after the first takes a request from the
+    client's rate limit, and gets a 429 frame once the limit is used up.
+    """
+    user = self._AuthenticatedUser()
+    if user is None:
+      self._DiscardRequestBody()
+      self.AskUserToAuthenticate()
+      return
+    try:
+      items = ReadBatchRequest(self._RequestBodyChunks(), BATCH_MAX_ITEMS)
+      # A body which is malformed from the start gets an ordinary error.
+      first_item = next(items, None)
+    except RequestBodyError, e:
+      self.close_connection = 1
+      self.send_error(e.code, str(e))
+      return
+    except BatchFormatError, e:
+      self.send_error(400, str(e))
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', BATCH_CONTENT_TYPE)
+    self.send_header('Cache-Control', 'no-store')
+    # HTTP/1.0 clients have already been sent Connection: close, so their
+    # response simply ends when the connection does.
+    chunked = self.request_version == 'HTTP/1.1'
+    if chunked:
+      self.send_header('Transfer-Encoding', 'chunked')
+    self.end_headers()
+    if first_item is not None:
+      # The first item was admitted along with the request.
+      self._HandleBatchItem(user, first_item, chunked)
+      try:
+        for item in items:
+          wait = self.server.rate_limiter.Admit(self.rate_limit_key,
+                                                self.rate_limit)
+          if wait:
+            metrics.rejected_requests.Inc(1, 'rate_limited')
+            self._WriteBatchFrame(429, item[1], self.responses[429][0],
+                                  chunked)
+          else:
+            self._HandleBatchItem(user, item, chunked)
+      except (RequestBodyError, BatchFormatError), e:
+        # The rest of the body can not be read, so the connection can not
+        # be reused.
+        self.close_connection = 1
+        self.log_message('Could not read the batch: %s', e)
+        self._WriteBatchFrame(getattr(e, 'code', 400), '*', str(e), chunked)
+    if chunked:
+      self.wfile.write('0\r\n\r\n')
+
+  def _HandleBatchItem(self, user, item, chunked):
+    method, resource, data = item
+    resource = self._RemoveUrlParameters(resource)
+    if method == 'GET':
+      user_may_do_action = self.user_data.UserCanReadResource
+    else:
+      user_may_do_action = self.user_data.UserCanWriteResource
+    started = time.time()
+    allowed = user_may_do_action(user, resource)
+    metrics.ObservePhase('acl', time.time() - started)
+    if not allowed:
+      # As for single requests, anonymous users are asked to log in.
+      status = user == '' and 401 or 403
+      self._WriteBatchFrame(status, resource, self.responses[status][0],
+                            chunked)
+      return
+    if method == 'POST':
+      started = time.time()
+      try:
+        file_stat = self.data_store.WriteResourceStream(resource, [data])
+      except (IOError, OSError), e:
+        self.log_message('Could not write %s: %s', resource, e)
+        self._WriteBatchFrame(500, resource, self.responses[500][0], chunked)
+        return
+      finally:
+        metrics.ObservePhase('store', time.time() - started)
+      self._WriteBatchFrame(200, resource, json.dumps(
+          {'size': file_stat.st_size,
+           'etag': MakeETag(file_stat.st_size, file_stat.st_mtime)}),
+          chunked)
+      return
+    started = time.time()
+    try:
+      handle = self.data_store.OpenResource(resource)
+    except IOError:
+      self._WriteBatchFrame(404, resource, self.responses[404][0], chunked)
+      return
+    finally:
+      metrics.ObservePhase('open', time.time() - started)
+    try:
+      # Large resources are streamed into the frame rather than read whole.
+      self._WriteBatchData(FormatBatchFrameHeader(200, resource, handle.size),
+                           chunked)
+      for chunk in handle.Chunks(0, handle.size, STREAM_CHUNK_SIZE):
+        self._WriteBatchData(chunk, chunked)
+      self._WriteBatchData('\n', chunked)
+    finally:
+      handle.Close()
+
+  def _WriteBatchFrame(self, status, resource, content, chunked):
+    self._WriteBatchData(FormatBatchFrame(status, resource, content), chunked)
+
+  def _WriteBatchData(self, data, chunked):
+    if chunked:
+      self.wfile.write('%x\r\n' % len(data))
+      self._WriteBody(data)
+      self.wfile.write('\r\n')
+    else:
+      self._WriteBody(data)
+
+  def _DiscardRequestBody(self):
+    """Skips an unwanted request body so the next request can be read."""
+    try:
+      data_length = int(self.headers.getheader('content-length', 0))
+    except ValueError:
+      data_length = -1
+    if (self.headers.getheader('transfer-encoding') or data_length < 0 or
+        data_length > MAX_DISCARDED_BODY_BYTES):
+      self.close_connection = 1
+    elif data_length:
+      self.rfile.read(data_length)
+
+  def _RequestBodyChunks(self):
+    """Returns an iterator over the request body in STREAM_CHUNK_SIZE pieces.
+
+    Both Content-Length and chunked Transfer-Encoding bodies are supported.
+    The size is checked against MAX_UPLOAD_BYTES before any of the body is
+    read when the length is known up front.
+
+    Raises:
+      RequestBodyError if the body is missing a length, is too large or is
+      malformed. When iterating over a chunked body the error may be raised
+      part of the way through.
+    """
+    transfer_encoding = self.headers.getheader('transfer-encoding', '')
+    if transfer_encoding.lower() == 'chunked':
+      return self._ReadChunkedBody()
+    content_length = self.headers.getheader('content-length')
+    if content_length is None:
+      raise RequestBodyError(411, 'Content-Length required')
+    try:
+      data_length = int(content_length)
+    except ValueError:
+      raise RequestBodyError(400, 'Invalid Content-Length')
+    if data_length < 0:
+      raise RequestBodyError(400, 'Invalid Content-Length')
+    if data_length > MAX_UPLOAD_BYTES:
+      raise RequestBodyError(413, 'Request body is too large')
+    return self._ReadFixedLengthBody(data_length)
+
+  def _ReadFixedLengthBody(self, data_length):
+    remaining = data_length
+    while remaining > 0:
+      chunk = self.rfile.read(min(STREAM_CHUNK_SIZE, remaining))
+      if not chunk:
+        raise RequestBodyError(400, 'Request body was incomplete')
+      remaining -= len(chunk)
+      self.request_bytes += len(chunk)
+      metrics.received_bytes.Inc(len(chunk))
+      yield chunk
+
+  def _ReadChunkedBody(self):
+    total_length = 0
+    while True:
+      size_line = self.rfile.readline(1024)
+      try:
+        chunk_length = int(size_line.split(';')[0].strip(), 16)
+      except ValueError:
+        raise RequestBodyError(400, 'Invalid chunk size')
+      if chunk_length == 0:
+        break
+      total_length += chunk_length
+      if total_length > MAX_UPLOAD_BYTES:
+        raise RequestBodyError(413, 'Request body is too large')
+      for chunk in self._ReadFixedLengthBody(chunk_length):
+        yield chunk
+      # Every chunk is followed by a CRLF.
+      self.rfile.readline(1024)
+    # Skip any trailer headers up to the blank line which ends the body.
+    while self.rfile.readline(1024).strip():
+      pass
       
   def AskUserToAuthenticate(self):
     realm = SERVER_AUTH_REALM
-    self.wfile.write('HTTP/1.0 401 Authentication Required\n'
-                       'Server: %s\n'
-                       'Date: %s\n'
-                       'WWW-Authenticate: Basic realm="%s"\n\n' % (
-                            self.version_string(),
-                            self.date_time_string(), realm))
+    content = 'Authentication Required'
+    self.send_response(401, content)
+    self.send_header('WWW-Authenticate', 'Basic realm="%s"' % realm)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self._WriteBody(content)
+
+
+# The module settings which ServerConfig reads from configuration files and
+# the command line.
+CONFIG_SETTINGS = (
+    'CONFIGURATION_DIRECTORY', 'USER_DATA_FILENAME',
+    'PERMISSIONS_DATA_FILENAME', 'RATE_LIMITS_FILENAME', 'SSL_PEM_FILENAME',
+    'RESOURCE_DIRECTORY', 'STORAGE_BACKEND', 'JOURNAL_DIRECTORY',
+    'JOURNAL_FSYNC_POLICY', 'JOURNAL_SYNC_INTERVAL', 'JOURNAL_MAX_BYTES',
+    'DEFAULT_RESOURCE_FILENAME',
+    'SERVER_PORT', 'SERVER_AUTH_REALM', 'LOG_FILE_NAME', 'LOG_MAX_BYTES',
+    'LOG_BACKUP_COUNT', 'CONCURRENCY_MODE', 'WORKER_THREADS',
+    'WORKER_PROCESSES', 'MAX_CONNECTIONS', 'CONNECTION_WAIT_TIMEOUT',
+    'RESOURCE_CACHE_BYTES', 'RESOURCE_CACHE_MAX_ENTRY_BYTES',
+    'STREAM_CHUNK_SIZE', 'DEFAULT_CONTENT_TYPE', 'COMPRESSION_MIN_BYTES',
+    'COMPRESSION_MAX_BYTES', 'COMPRESSION_CACHE_BYTES', 'MAX_UPLOAD_BYTES',
+    'KEEPALIVE_TIMEOUT', 'MAX_KEEPALIVE_REQUESTS', 'TLS_SESSION_TIMEOUT',
+    'MAX_DISCARDED_BODY_BYTES', 'METRICS_RESOURCE', 'BATCH_RESOURCE',
+    'BATCH_MAX_ITEMS', 'WATCH_RESOURCE', 'WATCH_MAX_WATCHERS',
+    'WATCH_HISTORY_SIZE', 'WATCH_HEARTBEAT_INTERVAL', 'LISTING_RESOURCE',
+    'LISTING_DEFAULT_LIMIT', 'LISTING_MAX_LIMIT', 'LISTING_RESCAN_INTERVAL',
+    'RATE_LIMIT_MAX_CLIENTS', 'MAX_CONCURRENT_REQUESTS',
+    'MAX_CONCURRENT_UPLOADS', 'AUTH_CACHE_SIZE', 'AUTH_CACHE_TTL',
+    'PREWARM_RESOURCES', 'PREWARM_LOG_BYTES')
+# Settings which hold a number, or None for no limit.
+_NUMERIC_SETTINGS = ('JOURNAL_SYNC_INTERVAL', 'JOURNAL_MAX_BYTES',
+                     'SERVER_PORT', 'LOG_MAX_BYTES', 'LOG_BACKUP_COUNT',
+                     'WORKER_THREADS', 'WORKER_PROCESSES', 'MAX_CONNECTIONS',
+                     'CONNECTION_WAIT_TIMEOUT', 'RESOURCE_CACHE_BYTES',
+                     'RESOURCE_CACHE_MAX_ENTRY_BYTES', 'STREAM_CHUNK_SIZE',
+                     'COMPRESSION_MIN_BYTES', 'COMPRESSION_MAX_BYTES',
+                     'COMPRESSION_CACHE_BYTES', 'MAX_UPLOAD_BYTES',
+                     'KEEPALIVE_TIMEOUT', 'MAX_KEEPALIVE_REQUESTS',
+                     'TLS_SESSION_TIMEOUT', 'MAX_DISCARDED_BODY_BYTES',
+                     'BATCH_MAX_ITEMS', 'WATCH_MAX_WATCHERS',
+                     'WATCH_HISTORY_SIZE', 'WATCH_HEARTBEAT_INTERVAL',
+                     'LISTING_DEFAULT_LIMIT', 'LISTING_MAX_LIMIT',
+                     'LISTING_RESCAN_INTERVAL', 'RATE_LIMIT_MAX_CLIENTS',
+                     'MAX_CONCURRENT_REQUESTS', 'MAX_CONCURRENT_UPLOADS',
+                     'AUTH_CACHE_SIZE', 'AUTH_CACHE_TTL', 'PREWARM_RESOURCES',
+                     'PREWARM_LOG_BYTES')
+
+
+class ServerConfig(object):
+  """The settings used by StartServer.
+
+  A new ServerConfig starts from the current module settings, so code which
+  still assigns to scorpion_server.server globals keeps working. Each
+  setting is an attribute named after the lower case global, for example
+  config.server_port for SERVER_PORT, and may be changed directly, read
+  from a configuration file or given on the command line. Apply copies the
+  settings back to the module globals which the server reads.
+
+  A configuration file holds a [server] section:
+
+    [server]
+    server_port = 8443
+    resource_directory = resources
+    concurrency_mode = threaded
+    max_concurrent_uploads = none
+  """
+
+  section = 'server'
+
+  def __init__(self, **settings):
+    module_globals = globals()
+    for name in CONFIG_SETTINGS:
+      setattr(self, name.lower(), module_globals[name])
+    for key, value in settings.iteritems():
+      self.Set(key, value)
+
+  def Set(self, key, value):
+    """Changes one setting, converting strings for numeric settings.
+
+    Raises:
+      ValueError if key is not a setting or value is not valid for it.
+    """
+    name = key.replace('-', '_').upper()
+    if name not in CONFIG_SETTINGS:
+      raise ValueError('Unknown setting: %s' % key)
+    if name in _NUMERIC_SETTINGS and isinstance(value, basestring):
+      if value.strip().lower() in ('', 'none'):
+        value = None
+      else:
+        try:
+          value = int(value)
+        except ValueError:
+          raise ValueError('%s must be a number or none, not %r' % (key,
+                                                                   value))
+    setattr(self, name.lower(), value)
+
+  def ReadFile(self, file_name):
+    """Reads settings from the [server] section of a configuration file.
+
+    Raises:
+      IOError if the file can not be read.
+      ValueError if the file names an unknown setting or an invalid value.
+    """
+    parser = RawConfigParser()
+    if not parser.read(file_name):
+      raise IOError('Unable to read configuration file %s' % file_name)
+    if parser.has_section(self.section):
+      for key, value in parser.items(self.section):
+        self.Set(key, value)
+
+  def ParseArgs(self, args):
+    """Reads a --config file and then settings from command line options.
+
+    Every setting has an option named after it, such as --server-port for
+    SERVER_PORT. Options override settings from the --config file.
+
+    Args:
+      args: list of str The command line arguments, without the program.
+
+    Raises:
+      ValueError if an option or configuration file is not valid.
+    """
+    parser = optparse.OptionParser(usage='%prog [--config FILE] [options]')
+    parser.add_option('--config', metavar='FILE',
+                      help='read settings from the [server] section of FILE')
+    for name in CONFIG_SETTINGS:
+      parser.add_option('--' + name.lower().replace('_', '-'),
+                        dest=name.lower(), metavar='VALUE',
+                        help='default: %r' % (getattr(self, name.lower()),))
+    options, remaining = parser.parse_args(args)
+    if remaining:
+      raise ValueError('Unexpected arguments: %s' % ' '.join(remaining))
+    if options.config:
+      self.ReadFile(options.config)
+    for name in CONFIG_SETTINGS:
+      value = getattr(options, name.lower())
+      if value is not None:
+        self.Set(name, value)
+
+  def Apply(self):
+    """Copies the settings to the module globals used by the server."""
+    module_globals = globals()
+    for name in CONFIG_SETTINGS:
+      module_globals[name] = getattr(self, name.lower())
 
 
 def StartServer(HandlerClass=ScorpionResourceRequestHandler,
-                ServerClass=ScorpionResourceServer):
+                ServerClass=None, mode=None, config=None):
+    if config is not None:
+      config.Apply()
+    mode = mode or CONCURRENCY_MODE
+    if not SERVER_CLASSES.has_key(mode):
+      raise ValueError('Unknown concurrency mode: %s' % mode)
+    ServerClass = ServerClass or SERVER_CLASSES[mode]
     server_address = ('', SERVER_PORT) # (address, port)
     httpd = ServerClass(server_address, HandlerClass)
     sa = httpd.socket.getsockname()
-    log.openLog()
-    print 'Serving HTTPS on', sa[0], 'port', sa[1]
-    httpd.serve_forever()
+    if hasattr(signal, 'SIGHUP'):
+      signal.signal(signal.SIGHUP, lambda signum, frame:
+                    httpd.user_data_source.RequestReload())
+    # Warm the caches before the log is reopened for this run and before
+    # prefork children are started, so that they all share the result.
+    httpd.Prewarm(ReadHotPaths(LOG_FILE_NAME, PREWARM_RESOURCES,
+                               PREWARM_LOG_BYTES))
+    OpenLog(log)
+    if httpd.replayed_writes:
+      print 'Replayed %d journaled write(s).' % httpd.replayed_writes
+    print 'Serving HTTPS on', sa[0], 'port', sa[1], '(%s)' % mode
+    if mode == 'prefork':
+      httpd.watch_enabled = False
+      ServePreforked(httpd, WORKER_PROCESSES)
+    else:
+      httpd.serve_forever()
+
+
+def main(argv):
+  config = ServerConfig()
+  try:
+    config.ParseArgs(argv[1:])
+  except (IOError, ValueError), e:
+    print >> sys.stderr, '%s: %s' % (argv[0], e)
+    return 2
+  StartServer(config=config)
+  return 0
 
 
 if __name__ == '__main__':
-    StartServer()
\ No newline at end of file
+  sys.exit(main(sys.argv))
@@ -0,0 +1,778 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Storage backends which hold the content of resources.
+
+Every backend implements the StorageBackend interface. The DataStore used
+by the server adds caching, change notifications and an optional write
+journal (see journal.py) on top of whichever backend is configured. To copy
+every resource from one backend to another, run:
+
+  python -m scorpion_server.storage SOURCE_KIND SOURCE_DIR DEST_KIND DEST_DIR
+
+where the kinds are 'filesystem', 'sharded' or 'sqlite'.
+"""
+
+import errno
+import hashlib
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import Queue
+from collections import namedtuple
+
+from scorpion_server.cache import LruCache
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# The name of the database file used by the SQLite backend inside its
+# resource directory.
+SQLITE_DATABASE_FILENAME = 'resources.db'
+# Prefix of the temporary files used while writing resources to disk.
+TEMP_FILE_PREFIX = '.upload-'
+# The sqlite3 module, imported when the first SqliteBackend is created so
+# that servers which keep resources in files do not need it.
+sqlite3 = None
+
+# The size and modification time of a stored resource. os.stat results
+# have the same attributes and may be used wherever one is expected.
+ResourceStat = namedtuple('ResourceStat', ['st_size', 'st_mtime'])
+
+
+class ResourceHandle(object):
+  """An open resource which can be sent to a client in chunks.
+
+  The content comes either from a string already in memory (for cached
+  resources) or from an open file, which is read one chunk at a time.
+  file_name identifies where the backend stored the resource and is also
+  used to guess its content type.
+  """
+
+  def __init__(self, file_name, size, mtime, data=None, resource_file=None):
+    self.file_name = file_name
+    self.size = size
+    self.mtime = mtime
+    self.data = data
+    self.resource_file = resource_file
+
+  def Chunks(self, start=0, end=None, chunk_size=None):
+    """Yields the content from byte start up to, but not including, end."""
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    if end is None or end > self.size:
+      end = self.size
+    if self.data is not None:
+      for position in xrange(start, end, chunk_size):
+        yield self.data[position:min(position + chunk_size, end)]
+      return
+    self.resource_file.seek(start)
+    remaining = end - start
+    while remaining > 0:
+      chunk = self.resource_file.read(min(chunk_size, remaining))
+      if not chunk:
+        break
+      remaining -= len(chunk)
+      yield chunk
+
+  def Read(self):
+    """Returns the whole content as a string."""
+    if self.data is not None:
+      return self.data
+    return ''.join(self.Chunks())
+
+  def Close(self):
+    if self.resource_file is not None:
+      self.resource_file.close()
+      self.resource_file = None
+
+
+class StorageBackend(object):
+  """The operations the DataStore needs from a place to keep resources."""
+
+  def OpenResource(self, resource):
+    """Returns a ResourceHandle, or raises IOError if it does not exist."""
+    raise NotImplementedError
+
+  def StatLocation(self, file_name):
+    """Returns (mtime, size) for a ResourceHandle's file_name, or None.
+
+    The DataStore uses this to check that a cached copy is still current.
+    """
+    raise NotImplementedError
+
+  def ResourceExists(self, resource):
+    raise NotImplementedError
+
+  def WriteResourceStream(self, resource, chunks):
+    """Atomically replaces a resource with the content from chunks.
+
+    Readers see either the old content or the new content. If reading the
+    chunks raises an exception the resource is left unchanged.
+
+    Returns:
+      A ResourceStat (or os.stat result) for the new content.
+    """
+    raise NotImplementedError
+
+  def ListResources(self):
+    """Yields the name of every stored resource."""
+    raise NotImplementedError
+
+  def ListResourceStats(self):
+    """Yields (name, size, mtime) for every stored resource."""
+    for name in self.ListResources():
+      try:
+        handle = self.OpenResource(name)
+      except IOError:
+        # Removed since it was listed.
+        continue
+      handle.Close()
+      yield name, handle.size, handle.mtime
+
+  def ResourceName(self, resource):
+    """Returns the name ListResources uses for a requested resource."""
+    return self._ResolveName(resource)
+
+  def _ResolveName(self, resource):
+    """Maps a resource to the name it is stored under.
+
+    As in the file system layout, a resource which names a directory maps
+    to the default file in that directory.
+    """
+    name = _NormalizeResourceName(resource, self.default_file)
+    if not name.endswith('/' + self.default_file) and self._IsDirectory(name):
+      name += '/' + self.default_file
+    return name
+
+  def _IsDirectory(self, name):
+    """Returns True if other resources are stored under name + '/'."""
+    return False
+
+  def Sync(self, resources):
+    """Makes sure the content of the given resources is on disk.
+
+    Called before the write journal is truncated, since the journal may
+    hold the only durable copy of recent writes. Backends which sync every
+    write as it is made need not do anything.
+    """
+    pass
+
+  def Close(self):
+    pass
+
+
+def _LoadSqlite():
+  global sqlite3
+  if sqlite3 is None:
+    import sqlite3
+  return sqlite3
+
+
+def _ReplaceFile(source, destination):
+  """Renames source to destination, replacing destination if it exists."""
+  if os.name == 'nt' and os.path.exists(destination):
+    # Windows will not rename over an existing file.
+    os.remove(destination)
+  os.rename(source, destination)
+
+
+def _MakeParentDirectory(file_name):
+  try:
+    os.makedirs(os.path.dirname(file_name))
+  except OSError, e:
+    if e.errno != errno.EEXIST:
+      raise
+
+
+def _WriteFileAtomically(file_name, chunks):
+  """Writes chunks to a temporary file and renames it over file_name."""
+  fd, temp_name = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX,
+                                   dir=os.path.dirname(file_name))
+  try:
+    temp_file = os.fdopen(fd, 'wb')
+    try:
+      for chunk in chunks:
+        temp_file.write(chunk)
+    finally:
+      temp_file.close()
+    os.chmod(temp_name, _NewFileMode(file_name))
+    _ReplaceFile(temp_name, file_name)
+  except:
+    if os.path.exists(temp_name):
+      os.remove(temp_name)
+    raise
+  return os.stat(file_name)
+
+
+def _NewFileMode(file_name):
+  """Returns the mode for a file which is about to replace file_name.
+
+  mkstemp always creates files readable only by their owner. A file which
+  is being replaced keeps its mode, and a new file gets the mode open()
+  would have given it.
+  """
+  try:
+    return stat.S_IMODE(os.stat(file_name).st_mode)
+  except OSError:
+    return 0666 & ~_UMASK
+
+
+# The process umask. Reading it means setting it, so this is done once
+# while the module is imported rather than while other threads write files.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class FileSystemBackend(StorageBackend):
+  """Stores each resource as the file with the same path.
+
+  A resource which names a directory maps to the default file inside that
+  directory. This is the original layout of the hosted directory.
+  """
+
+  # Writing to a resource in a missing directory fails unless this is set.
+  create_directories = False
+
+  def __init__(self, resource_directory, default_file):
+    self.resource_directory = resource_directory
+    # The file name to rea from or write to if the resource points
+    # to a directory. Example: 'index' or 'index.html'
+    self.default_file = default_file
+
+  def _ConvertResourceToFileName(self, resource):
+    file_parts = resource.split('/')
+    full_path = self.resource_directory
+    for part in file_parts:
+      full_path = os.path.join(full_path, part)
+    if os.path.exists(full_path):
+      if os.path.isdir(full_path):
+        full_path = os.path.join(full_path, self.default_file)
+    return full_path
+
+  def OpenResource(self, resource):
+    file_name = self._ConvertResourceToFileName(resource)
+    resource_file = open(file_name, 'rb')
+    file_stat = os.fstat(resource_file.fileno())
+    return ResourceHandle(file_name, file_stat.st_size, file_stat.st_mtime,
+                          resource_file=resource_file)
+
+  def StatLocation(self, file_name):
+    try:
+      file_stat = os.stat(file_name)
+    except OSError:
+      return None
+    return (file_stat.st_mtime, file_stat.st_size)
+
+  def ResourceExists(self, resource):
+    return os.path.exists(self._ConvertResourceToFileName(resource))
+
+  def WriteResourceStream(self, resource, chunks):
+    file_name = self._ConvertResourceToFileName(resource)
+    if self.create_directories:
+      _MakeParentDirectory(file_name)
+    return _WriteFileAtomically(file_name, chunks)
+
+  def ListResources(self):
+    for directory, dir_names, file_names in os.walk(self.resource_directory):
+      relative = os.path.relpath(directory, self.resource_directory)
+      for file_name in file_names:
+        if file_name.startswith(TEMP_FILE_PREFIX):
+          continue
+        if relative == os.curdir:
+          parts = [file_name]
+        else:
+          parts = relative.split(os.sep) + [file_name]
+        yield '/' + '/'.join(parts)
+
+  def ListResourceStats(self):
+    for name in self.ListResources():
+      location = self.StatLocation(self._ConvertResourceToFileName(name))
+      if location is not None:
+        yield name, location[1], location[0]
+
+  def ResourceName(self, resource):
+    # A resource which names a directory is stored in its default file.
+    relative = os.path.relpath(self._ConvertResourceToFileName(resource),
+                               self.resource_directory)
+    return '/' + '/'.join(relative.split(os.sep))
+
+  def Sync(self, resources):
+    directories = set()
+    for resource in resources:
+      file_name = self._ConvertResourceToFileName(resource)
+      directories.add(os.path.dirname(file_name))
+      _FsyncPath(file_name)
+    # The renames which replaced the files are only durable once their
+    # directories have been synced too.
+    for directory in directories:
+      _FsyncPath(directory)
+
+
+def _FsyncPath(path):
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError:
+    # The resource is gone, or this platform can not open directories.
+    return
+  try:
+    os.fsync(fd)
+  except OSError:
+    pass
+  finally:
+    os.close(fd)
+
+
+def _NormalizeResourceName(resource, default_file):
+  """Maps directory style names such as '/' or '/docs/' to a default file."""
+  if not resource.startswith('/'):
+    resource = '/' + resource
+  if resource.endswith('/'):
+    resource += default_file
+  return resource
+
+
+class ShardedFileSystemBackend(FileSystemBackend):
+  """Spreads resources over a fixed tree of hashed directories.
+
+  The file for a resource is stored at ab/cd/<quoted name>, where abcd are
+  the first hex digits of the MD5 of the resource name. Even a flat
+  namespace with millions of resources then keeps every directory small.
+  Resource names are percent-quoted into a single file name, so they are
+  limited to the file system's maximum file name length.
+  """
+
+  def __init__(self, resource_directory, default_file, levels=2):
+    FileSystemBackend.__init__(self, resource_directory, default_file)
+    self.levels = levels
+
+  def _ShardPath(self, name):
+    digest = hashlib.md5(name).hexdigest()
+    shards = [digest[2 * level:2 * level + 2]
+              for level in xrange(self.levels)]
+    return os.path.join(self.resource_directory,
+                        *(shards + [urllib.quote(name, safe='')]))
+
+  def _ConvertResourceToFileName(self, resource):
+    return self._ShardPath(self._ResolveName(resource))
+
+  def _IsDirectory(self, name):
+    return os.path.exists(self._ShardPath(name + '/'))
+
+  def ResourceName(self, resource):
+    return self._ResolveName(resource)
+
+  def WriteResourceStream(self, resource, chunks):
+    name = self._ResolveName(resource)
+    file_name = self._ShardPath(name)
+    _MakeParentDirectory(file_name)
+    file_stat = _WriteFileAtomically(file_name, chunks)
+    self._MarkDirectories(name)
+    return file_stat
+
+  def _MarkDirectories(self, name):
+    """Records each directory above name as an empty file, '<dir>/'.
+
+    Names ending in '/' are never stored as resources, so the markers can
+    not clash with one. They let a resource which names a directory map to
+    its default file, as it does in the file system layout.
+    """
+    markers = []
+    end = name.rfind('/')
+    while end > 0:
+      marker = self._ShardPath(name[:end + 1])
+      if os.path.exists(marker):
+        break
+      markers.append(marker)
+      end = name.rfind('/', 0, end)
+    # Outermost first, so that an existing marker means that the
+    # directories above it are marked too.
+    for marker in reversed(markers):
+      _MakeParentDirectory(marker)
+      open(marker, 'wb').close()
+
+  def ListResources(self):
+    for directory, dir_names, file_names in os.walk(self.resource_directory):
+      for file_name in file_names:
+        if file_name.startswith(TEMP_FILE_PREFIX):
+          continue
+        name = urllib.unquote(file_name)
+        if not name.endswith('/'):
+          yield name
+
+
+class SqliteBackend(StorageBackend):
+  """Stores every resource as a row in a single SQLite database file.
+
+  The database runs in WAL mode so that readers are not blocked by a
+  writer. Writes are handed to a single writer thread, which commits all of
+  the writes waiting at that moment in one transaction and then wakes each
+  of their callers. Content is held in memory while it is written, so this
+  backend suits many small resources rather than very large ones.
+  """
+
+  def __init__(self, resource_directory, default_file,
+               database_filename=SQLITE_DATABASE_FILENAME, max_batch=100):
+    _LoadSqlite()
+    if not os.path.isdir(resource_directory):
+      os.makedirs(resource_directory)
+    self.database_file = os.path.join(resource_directory, database_filename)
+    self.default_file = default_file
+    self.max_batch = max_batch
+    self._lock = threading.Lock()
+    self._pid = None
+    connection = sqlite3.connect(self.database_file, timeout=30)
+    try:
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('CREATE TABLE IF NOT EXISTS resources ('
+                         'name TEXT PRIMARY KEY, data BLOB NOT NULL, '
+                         'size INTEGER NOT NULL, mtime REAL NOT NULL)')
+      connection.commit()
+    finally:
+      connection.close()
+
+  def _StartInThisProcess(self):
+    """Starts the writer thread the first time a process uses the backend.
+
+    Neither threads nor SQLite connections survive a fork, so a preforked
+    worker gets its own writer and connections rather than the parent's.
+    """
+    if self._pid == os.getpid():
+      return
+    self._lock.acquire()
+    try:
+      if self._pid == os.getpid():
+        return
+      self._local = threading.local()
+      self._write_queue = Queue.Queue()
+      writer = threading.Thread(target=self._WriterLoop,
+                                name='scorpion-sqlite')
+      writer.setDaemon(True)
+      writer.start()
+      self._pid = os.getpid()
+    finally:
+      self._lock.release()
+
+  def _Connection(self):
+    """Returns this thread's connection to the database."""
+    self._StartInThisProcess()
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.database_file, timeout=30)
+      connection.text_factory = str
+      # WAL mode keeps the database consistent after a crash even though
+      # commits do not wait for a full sync.
+      connection.execute('PRAGMA synchronous=NORMAL')
+      self._local.connection = connection
+    return connection
+
+  def OpenResource(self, resource):
+    name = self._ResolveName(resource)
+    row = self._Connection().execute(
+        'SELECT data, size, mtime FROM resources WHERE name = ?',
+        (name,)).fetchone()
+    if row is None:
+      raise IOError(errno.ENOENT, 'No such resource', resource)
+    return ResourceHandle(name, row[1], row[2], data=str(row[0]))
+
+  def StatLocation(self, file_name):
+    row = self._Connection().execute(
+        'SELECT mtime, size FROM resources WHERE name = ?',
+        (file_name,)).fetchone()
+    if row is None:
+      return None
+    return (row[0], row[1])
+
+  def ResourceExists(self, resource):
+    name = self._ResolveName(resource)
+    return self.StatLocation(name) is not None
+
+  def WriteResourceStream(self, resource, chunks):
+    name = self._ResolveName(resource)
+    data = ''.join(chunks)
+    resource_stat = ResourceStat(len(data), time.time())
+    write = [name, data, resource_stat, threading.Event(), None]
+    self._StartInThisProcess()
+    self._write_queue.put(write)
+    write[3].wait()
+    if write[4] is not None:
+      raise write[4]
+    return resource_stat
+
+  def _WriterLoop(self):
+    while True:
+      batch = [self._write_queue.get()]
+      while len(batch) < self.max_batch:
+        try:
+          batch.append(self._write_queue.get_nowait())
+        except Queue.Empty:
+          break
+      error = None
+      try:
+        self._WriteBatch(batch)
+      except Exception, e:
+        # Whatever went wrong, every caller in the batch is woken with the
+        # error, and the loop carries on with the next batch.
+        error = IOError(str(e))
+      for write in batch:
+        write[4] = error
+        write[3].set()
+
+  def _WriteBatch(self, batch):
+    connection = self._Connection()
+    try:
+      connection.executemany(
+          'INSERT OR REPLACE INTO resources (name, data, size, mtime) '
+          'VALUES (?, ?, ?, ?)',
+          [(name, sqlite3.Binary(data), resource_stat.st_size,
+            resource_stat.st_mtime)
+           for name, data, resource_stat, done, unused in batch])
+      connection.commit()
+    except:
+      connection.rollback()
+      raise
+
+  def _IsDirectory(self, name):
+    # Names are compared byte by byte, and '0' follows '/'.
+    return self._Connection().execute(
+        'SELECT 1 FROM resources WHERE name > ? AND name < ? LIMIT 1',
+        (name + '/', name + '0')).fetchone() is not None
+
+  def Sync(self, resources):
+    # With synchronous=NORMAL the last commits in the WAL may not be on
+    # disk yet. A full checkpoint syncs the WAL and copies it into the
+    # database file, which is synced as well.
+    self._Connection().execute('PRAGMA wal_checkpoint(FULL)').fetchall()
+
+  def ListResources(self):
+    cursor = self._Connection().execute(
+        'SELECT name FROM resources ORDER BY name')
+    for row in cursor:
+      yield row[0]
+
+  def ListResourceStats(self):
+    cursor = self._Connection().execute(
+        'SELECT name, size, mtime FROM resources ORDER BY name')
+    for row in cursor:
+      yield row[0], row[1], row[2]
+
+  def Close(self):
+    if self._pid != os.getpid():
+      return
+    connection = getattr(self._local, 'connection', None)
+    if connection is not None:
+      connection.close()
+      self._local.connection = None
+
+
+class DataStore(object):
+  
+  def __init__(self, resource_directory, default_file, cache_size=0,
+               max_cached_resource_size=None, backend=None, journal=None):
+    """Reads and writes resources held by a storage backend.
+
+    Args:
+      resource_directory: str The directory which holds all resources.
+      default_file: str The file name used when a resource is a directory.
+      cache_size: int (optional) The number of bytes of resource content
+          to keep in memory. The cache is disabled when this is 0.
+      max_cached_resource_size: int (optional) Resources larger than this
+          are always read from the backend.
+      backend: StorageBackend (optional) Where resources are kept. Defaults
+          to a FileSystemBackend for resource_directory.
+      journal: journal.Journal (optional) If given, every write is appended
+          to the journal before it is applied to the backend. Call
+          ReplayJournal before the first write.
+    """
+    self.resource_directory = resource_directory
+    self.default_file = default_file
+    self.backend = backend or FileSystemBackend(resource_directory,
+                                                default_file)
+    self.cache = None
+    if cache_size:
+      self.cache = LruCache(cache_size, max_cached_resource_size)
+    self.listeners = []
+    self.journal = journal
+
+  def AddListener(self, listener):
+    """Calls listener(resource, resource_stat) after each write."""
+    self.listeners.append(listener)
+  
+  def _ConvertResourceToFileName(self, resource):
+    return self.backend._ConvertResourceToFileName(resource)
+
+  def _GetCachedResource(self, resource):
+    """Returns a (file_name, mtime, size, data) tuple for a cached resource.
+
+    A cached entry is only returned if the backend reports the same
+    modification time and size as when it was read (a single stat for the
+    file system backends), so changes made outside of the server are picked
+    up on the next read.
+    """
+    if self.cache is None:
+      return None
+    return self.cache.Get(resource, self._CachedEntryIsCurrent)
+
+  def _CachedEntryIsCurrent(self, entry):
+    return self.backend.StatLocation(entry[0]) == (entry[1], entry[2])
+
+  def CacheStats(self):
+    """Returns the hit, miss and eviction counters of the resource cache."""
+    if self.cache is None:
+      return {}
+    return self.cache.Stats()
+
+  def OpenResource(self, resource):
+    """Opens a resource for streaming and returns a ResourceHandle.
+
+    Small resources are read in full and added to the cache. Resources
+    which are too large to cache are left open so that the caller can send
+    them in chunks. The caller should Close the handle when done.
+
+    Raises:
+      IOError if the resource does not exist.
+    """
+    cached = self._GetCachedResource(resource)
+    if cached is not None:
+      return ResourceHandle(cached[0], cached[2], cached[1], data=cached[3])
+    handle = self.backend.OpenResource(resource)
+    if self.cache is None or handle.size > self.cache.max_entry_bytes:
+      return handle
+    try:
+      data = handle.Read()
+    finally:
+      handle.Close()
+    self.cache.Put(resource, (handle.file_name, handle.mtime, handle.size,
+                              data),
+                   len(data))
+    return ResourceHandle(handle.file_name, len(data), handle.mtime, 
+                          data=data)
+
+  def ReadResource(self, resource):
+    handle = self.OpenResource(resource)
+    try:
+      return handle.Read()
+    finally:
+      handle.Close()
+    
+  def ResourceExists(self, resource):
+    if self._GetCachedResource(resource) is not None:
+      return True
+    return self.backend.ResourceExists(resource)
+  
+  def WriteResource(self, resource, data):
+    self.WriteResourceStream(resource, [data])
+    return data
+
+  def WriteResourceStream(self, resource, chunks):
+    """Atomically replaces a resource with the content from chunks.
+
+    Readers see either the old content or the new content, never a
+    partial write. If reading the chunks raises an exception the resource
+    is left unchanged.
+
+    Args:
+      resource: str The resource to write.
+      chunks: An iterable of strings which make up the new content.
+
+    Returns:
+      An object with st_size and st_mtime attributes for the new content.
+    """
+    if self.journal is None:
+      return self._Apply(resource, chunks)
+    record = self.journal.Append(resource, chunks)
+    succeeded = False
+    try:
+      resource_stat = self._Apply(resource, record.Chunks())
+      succeeded = True
+    finally:
+      self.journal.Applied(record, succeeded)
+    if self.journal.NeedsCheckpoint():
+      self.journal.Checkpoint(self.backend.Sync)
+    return resource_stat
+
+  def _Apply(self, resource, chunks):
+    resource_stat = self.backend.WriteResourceStream(resource, chunks)
+    if self.cache is not None:
+      self.cache.Remove(resource)
+    for listener in self.listeners:
+      listener(resource, resource_stat)
+    return resource_stat
+
+  def ReplayJournal(self):
+    """Applies the writes which were journaled but may not have been applied.
+
+    Returns:
+      The number of writes which were replayed.
+    """
+    if self.journal is None:
+      return 0
+    return self.journal.Replay(self._Apply, self.backend.Sync)
+
+  def JournalStats(self):
+    if self.journal is None:
+      return {}
+    return self.journal.Stats()
+
+
+# Maps the STORAGE_BACKEND setting to the backend class.
+BACKENDS = {'filesystem': FileSystemBackend,
+            'sharded': ShardedFileSystemBackend,
+            'sqlite': SqliteBackend}
+
+
+def CreateBackend(kind, resource_directory, default_file):
+  if not BACKENDS.has_key(kind):
+    raise ValueError('Unknown storage backend: %s' % kind)
+  return BACKENDS[kind](resource_directory, default_file)
+
+
+def MigrateResources(source, destination):
+  """Copies every resource from one backend to another.
+
+  Returns:
+    The number of resources copied.
+  """
+  copied = 0
+  for resource in list(source.ListResources()):
+    handle = source.OpenResource(resource)
+    try:
+      destination.WriteResourceStream(resource, handle.Chunks())
+    finally:
+      handle.Close()
+    copied += 1
+  return copied
+
+
+def main(argv):
+  if len(argv) not in (5, 6):
+    print ('Usage: %s SOURCE_KIND SOURCE_DIR DEST_KIND DEST_DIR '
+           '[DEFAULT_FILE]' % argv[0])
+    return 2
+  default_file = 'index'
+  if len(argv) == 6:
+    default_file = argv[5]
+  source = CreateBackend(argv[1], argv[2], default_file)
+  destination = CreateBackend(argv[3], argv[4], default_file)
+  destination.create_directories = True
+  print 'Copied %d resource(s).' % MigrateResources(source, destination)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Users, their credentials and what they may read and write.
+
+This module only needs the standard library, so scripts which audit users
+or permissions can use it without loading the HTTP server or pyOpenSSL.
+"""
+
+import base64
+import hashlib
+import os
+import sys
+import threading
+
+from scorpion_server.cache import ExpiringCache
+from scorpion_server.passwords import VerifyPassword
+from scorpion_server.ratelimit import LoadRateLimits
+
+
+# Successful logins are remembered, keyed by the Authorization header, so
+# the slow password hash only runs once per client session. By default at
+# most AUTH_CACHE_SIZE logins are kept, each for AUTH_CACHE_TTL seconds.
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 300
+
+# Permission bits stored in the compiled permission index. A write grant
+# also allows reading, so it is stored as READ_PERMISSION | WRITE_PERMISSION.
+READ_PERMISSION = 1
+WRITE_PERMISSION = 2
+
+
+class UserData(object):
+  
+  def __init__(self, credentials_file=None, permissions_file=None,
+               rate_limits_file=None, auth_cache_size=None,
+               auth_cache_ttl=None):
+    self.user_credentials = {}
+    self.permissions = {}
+    self.rate_limits = {}
+    self.permission_index = _NewPermissionNode()
+    # A new UserData is built whenever the users file changes, so cached
+    # logins never outlive the credentials they were checked against.
+    # A size of 0 turns the cache off.
+    if auth_cache_size is None:
+      auth_cache_size = AUTH_CACHE_SIZE
+    if auth_cache_ttl is None:
+      auth_cache_ttl = AUTH_CACHE_TTL
+    self.auth_cache = ExpiringCache(auth_cache_size, auth_cache_ttl)
+    if credentials_file:
+      self.LoadUserCredentials(credentials_file)
+    if permissions_file:
+      self.LoadPermissionsMap(permissions_file)
+    if rate_limits_file:
+      self.rate_limits = LoadRateLimits(rate_limits_file)
+    
+  def LoadUserCredentials(self, file_name):
+    if file_name and os.path.exists(file_name):
+      self.user_credentials = {}
+      user_file = open(file_name, 'r')
+      for line in user_file.readlines():
+        line_parts = line.strip().split('\t')
+        self.user_credentials[line_parts[0]] = line_parts[1]
+    
+  def LoadPermissionsMap(self, file_name):
+    if file_name and os.path.exists(file_name):
+      self.permissions = {}
+      permissions_file = open(file_name, 'r')
+      for line in permissions_file.readlines():
+        line_parts = line.strip().split('\t')
+        mode = line_parts[0]
+        username = line_parts[1]
+        resource = line_parts[2]
+        if not self.permissions.has_key(mode):
+          self.permissions[mode] = {}
+        if not self.permissions[mode].has_key(username):
+          self.permissions[mode][username] = []
+        self.permissions[mode][username].append(resource)
+      self._BuildPermissionIndex()
+
+  def _BuildPermissionIndex(self):
+    """Compiles self.permissions into a character trie of resource prefixes.
+
+    Each node of the trie is a two item list: a dict mapping the next
+    character to the child node, and a dict mapping usernames to the
+    permission bits granted for the prefix which ends at that node. Grants
+    follow the same plain string prefix rules as startswith, so '/jeff' also
+    grants '/jeffrey'.
+    """
+    index = _NewPermissionNode()
+    for mode, bits in (('r', READ_PERMISSION),
+                       ('w', READ_PERMISSION | WRITE_PERMISSION)):
+      for username, prefixes in self.permissions.get(mode, {}).iteritems():
+        for prefix in prefixes:
+          node = index
+          for char in prefix:
+            children = node[0]
+            if char not in children:
+              children[char] = _NewPermissionNode()
+            node = children[char]
+          node[1][username] = node[1].get(username, 0) | bits
+    self.permission_index = index
+
+  def _UserHasPermission(self, username, resource, permission):
+    """Walks the permission index along resource looking for a grant.
+
+    Grants for the anonymous user '' apply to every user, so both are
+    checked at each node. The cost is bounded by the length of resource
+    rather than by the number of permission entries.
+    """
+    node = self.permission_index
+    position = 0
+    length = len(resource)
+    while True:
+      grants = node[1]
+      if grants and ((grants.get(username, 0) | grants.get('', 0)) &
+                     permission):
+        return True
+      if position == length:
+        return False
+      node = node[0].get(resource[position])
+      if node is None:
+        return False
+      position += 1
+    
+  def AuthenticateUser(self, username, password):
+    if username is None:
+      return ''
+    if (self.user_credentials.has_key(username) and 
+        VerifyPassword(password, self.user_credentials[username])):
+      return username
+    else:
+      return None
+      
+  def UserCanReadResource(self, username, resource):
+    return self._UserHasPermission(username, resource, READ_PERMISSION)
+      
+  def UserCanWriteResource(self, username, resource):
+    return self._UserHasPermission(username, resource, WRITE_PERMISSION)
+    
+  def RateLimitFor(self, username):
+    """Returns the RateLimit for a user, or None if they are unlimited.
+
+    Anonymous users and users with bad credentials share the '' limits.
+    """
+    if not username:
+      return self.rate_limits.get('')
+    return self.rate_limits.get(username, self.rate_limits.get('*'))
+
+  def FindCachedUser(self, auth_header):
+    """Returns the user for a cached login without checking a password.
+
+    Returns:
+      The username, '' if there is no auth header, or None if the login is
+      not in the cache.
+    """
+    if not auth_header:
+      return ''
+    return self.auth_cache.Get(self._AuthCacheKey(auth_header))
+
+  def _AuthCacheKey(self, auth_header):
+    # Only a digest of the header is kept in memory as the cache key.
+    return hashlib.sha256(auth_header).digest()
+
+  def FindUserFromAuthHeader(self, auth_header):
+    if auth_header:
+      cache_key = self._AuthCacheKey(auth_header)
+      username = self.auth_cache.Get(cache_key)
+      if username is not None:
+        return username
+      auth_string = base64.decodestring(auth_header.split(' ')[-1])
+      user_pass_list = auth_string.split(':')
+      username = user_pass_list[0]
+      password = user_pass_list[-1]
+      username = self.AuthenticateUser(username, password)
+      if username:
+        self.auth_cache.Put(cache_key, username)
+      return username
+    else:
+      # If there was no auth header, this is the empty anonymous user.
+      return ''
+
+
+def _NewPermissionNode():
+  return [{}, {}]
+
+
+class SharedUserData(object):
+  """Holds a process wide UserData snapshot for all request handlers.
+
+  The users and permissions files are parsed once and the resulting UserData
+  is reused until the size or modification time of either file changes, or
+  until RequestReload is called (for example from a SIGHUP handler). A
+  reload builds a complete new UserData before swapping it in, so a request
+  which already holds the old snapshot keeps a consistent view while new
+  requests see the update. If a changed file can not be parsed, the error
+  is written to stderr and the previous snapshot stays in use.
+  """
+
+  def __init__(self, credentials_file, permissions_file,
+               rate_limits_file=None, auth_cache_size=None,
+               auth_cache_ttl=None):
+    self.credentials_file = credentials_file
+    self.permissions_file = permissions_file
+    self.rate_limits_file = rate_limits_file
+    self.auth_cache_size = auth_cache_size
+    self.auth_cache_ttl = auth_cache_ttl
+    self.reload_requested = False
+    self._lock = threading.Lock()
+    self._signatures = None
+    self._snapshot = None
+
+  def _FileSignature(self, file_name):
+    if not file_name:
+      return None
+    try:
+      file_stat = os.stat(file_name)
+    except OSError:
+      return None
+    return (file_stat.st_mtime, file_stat.st_size)
+
+  def _CurrentSignatures(self):
+    return (self._FileSignature(self.credentials_file),
+            self._FileSignature(self.permissions_file),
+            self._FileSignature(self.rate_limits_file))
+
+  def RequestReload(self):
+    """Forces the files to be re-read on the next call to GetUserData."""
+    self.reload_requested = True
+
+  def GetUserData(self):
+    signatures = self._CurrentSignatures()
+    if (self._snapshot is None or self.reload_requested or
+        signatures != self._signatures):
+      self._lock.acquire()
+      try:
+        # Another thread may have reloaded while this one was waiting.
+        signatures = self._CurrentSignatures()
+        if (self._snapshot is None or self.reload_requested or
+            signatures != self._signatures):
+          self.reload_requested = False
+          try:
+            self._snapshot = UserData(self.credentials_file,
+                                      self.permissions_file,
+                                      self.rate_limits_file,
+                                      self.auth_cache_size,
+                                      self.auth_cache_ttl)
+          except (IndexError, ValueError, IOError, OSError), e:
+            # Without a good snapshot to fall back on there is nothing
+            # safe to serve with.
+            if self._snapshot is None:
+              raise
+            print >> sys.stderr, (
+                'Could not reload the user data, keeping the previous '
+                'version: %s' % e)
+          # A broken file is only read again once it changes.
+          self._signatures = signatures
+      finally:
+        self._lock.release()
+    return self._snapshot
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2007 Jeffrey Scudder
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pushes resource change notifications to watching clients.
+
+A client watches a resource prefix by requesting it as a Server-Sent Events
+stream. Once the response headers have been sent, the request handler
+gives the connection to the WatchHub and returns, so an idle watcher does
+not hold a worker thread. A single hub thread multiplexes every watching
+connection with select and writes an event to each watcher whose prefix
+matches a changed resource:
+
+  id: 5e1f3a2b9c-42
+  event: change
+  data: {"etag": "\"5-4a1b\"", "resource": "/user/notes", "size": 5}
+
+Each stream starts with a "ready" event carrying the id of the latest
+change. A client which reconnects with a Last-Event-ID header is first
+sent the changes it missed, or a "reset" event if they are no longer
+remembered and it should read the resources again.
+"""
+
+import collections
+import errno
+import json
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+from scorpion_server.httputil import MakeETag
+
+def _ErrorClasses():
+  """Returns the would-block and connection error classes to catch.
+
+  pyOpenSSL is only consulted if something else has already imported it,
+  so that this module can be used without loading the TLS stack.
+  """
+  SSL = sys.modules.get('OpenSSL.SSL')
+  if SSL is None:
+    return (), (socket.error,)
+  return (SSL.WantReadError, SSL.WantWriteError), (SSL.Error, socket.error)
+
+
+def FormatEvent(event_type, event_id=None, data=None):
+  """Returns one Server-Sent Event as a string."""
+  lines = []
+  if event_id is not None:
+    lines.append('id: %s' % event_id)
+  lines.append('event: %s' % event_type)
+  lines.append('data: %s' % json.dumps(data or {}, sort_keys=True))
+  return '\n'.join(lines) + '\n\n'
+
+
+class Watcher(object):
+  """A connection which is waiting for changes under a prefix."""
+
+  def __init__(self, connection, prefix):
+    self.connection = connection
+    self.prefix = prefix
+    self.pending = []
+    self.pending_bytes = 0
+    # A write which could not complete must be retried with the same
+    # string, so it is kept apart from the pending text.
+    self.sending = None
+    self.last_sent = time.time()
+
+  def Queue(self, text):
+    self.pending.append(text)
+    self.pending_bytes += len(text)
+
+  def HasPending(self):
+    return bool(self.pending or self.sending)
+
+
+class WatchHub(object):
+  """Sends change events to watching connections from one thread.
+
+  Connections are written without blocking, so a slow client can not hold
+  up the others. A client which falls more than max_pending_bytes behind
+  is disconnected and can catch up by reconnecting with Last-Event-ID.
+  """
+
+  def __init__(self, close_connection, max_watchers=1000, history_size=1000,
+               heartbeat_interval=15, max_pending_bytes=1024 * 1024):
+    """
+    Args:
+      close_connection: function Called with a connection to shut it down
+          when its watcher is dropped.
+      max_watchers: int (optional) The number of watchers at which IsFull
+          starts returning True.
+      history_size: int (optional) The number of recent changes kept for
+          clients which reconnect with Last-Event-ID.
+      heartbeat_interval: int (optional) Seconds between comment lines sent
+          to idle watchers, which also finds clients which have gone away.
+      max_pending_bytes: int (optional) The most unsent event data held for
+          one watcher.
+    """
+    self.close_connection = close_connection
+    self.max_watchers = max_watchers
+    self.history_size = history_size
+    self.heartbeat_interval = heartbeat_interval
+    self.max_pending_bytes = max_pending_bytes
+    self._would_block_errors, self._connection_errors = _ErrorClasses()
+    self._lock = threading.Lock()
+    self._pid = None
+    self._thread = None
+
+  def _CheckProcess(self):
+    """Starts afresh in a new process. Must be called holding the lock.
+
+    Neither the hub thread nor the parent's watchers survive a fork, and
+    each process numbers its changes separately, so event ids include a
+    token which is unique to the process.
+    """
+    if self._pid == os.getpid():
+      return
+    self._pid = os.getpid()
+    self._token = '%x%x' % (int(time.time() * 1000), self._pid)
+    self._last_change = 0
+    self._history = collections.deque(maxlen=self.history_size)
+    self._watchers = {}
+    self._thread = None
+    self._wake_read = self._wake_write = None
+
+  def WatcherCount(self):
+    if self._pid != os.getpid():
+      return 0
+    return len(self._watchers)
+
+  def IsFull(self):
+    return self.WatcherCount() >= self.max_watchers
+
+  def Notify(self, resource, resource_stat):
+    """Records a change to a resource and queues it for matching watchers.
+
+    Args:
+      resource: str The resource which was written.
+      resource_stat: An object with st_size and st_mtime attributes for the
+          new content.
+    """
+    self._lock.acquire()
+    try:
+      self._CheckProcess()
+      self._last_change += 1
+      change = (self._last_change, resource,
+                MakeETag(resource_stat.st_size, resource_stat.st_mtime),
+                resource_stat.st_size)
+      self._history.append(change)
+      if not self._watchers:
+        return
+      text = self._FormatChange(change)
+      for watcher in self._watchers.itervalues():
+        if resource.startswith(watcher.prefix):
+          watcher.Queue(text)
+    finally:
+      self._lock.release()
+    self._Wake()
+
+  def _FormatChange(self, change):
+    change_id, resource, etag, size = change
+    return FormatEvent('change', '%s-%d' % (self._token, change_id),
+                       {'resource': resource, 'etag': etag, 'size': size})
+
+  def Attach(self, connection, prefix, last_event_id=None):
+    """Takes over a connection whose response headers have been sent.
+
+    Args:
+      connection: The client's socket or SSL connection. The hub closes it
+          when the client goes away.
+      prefix: str Changes to resources starting with this are sent.
+      last_event_id: str (optional) The id of the last event the client
+          received before reconnecting.
+    """
+    connection.setblocking(0)
+    watcher = Watcher(connection, prefix)
+    self._lock.acquire()
+    try:
+      self._CheckProcess()
+      if last_event_id is not None:
+        self._QueueMissedChanges(watcher, last_event_id)
+      watcher.Queue(FormatEvent('ready', '%s-%d' % (self._token,
+                                                     self._last_change)))
+      self._watchers[connection] = watcher
+      if self._thread is None:
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = threading.Thread(target=self._Loop,
+                                        name='scorpion-watch')
+        self._thread.setDaemon(True)
+        self._thread.start()
+    finally:
+      self._lock.release()
+    self._Wake()
+
+  def _QueueMissedChanges(self, watcher, last_event_id):
+    token, _, change_id = last_event_id.strip().rpartition('-')
+    try:
+      change_id = int(change_id)
+    except ValueError:
+      change_id = None
+    if self._history:
+      oldest = self._history[0][0]
+    else:
+      oldest = self._last_change + 1
+    if (token != self._token or change_id is None or
+        change_id > self._last_change or change_id + 1 < oldest):
+      watcher.Queue(FormatEvent('reset'))
+      return
+    for change in self._history:
+      if change[0] > change_id and change[1].startswith(watcher.prefix):
+        watcher.Queue(self._FormatChange(change))
+
+  def _Wake(self):
+    if self._wake_write is not None and self._pid == os.getpid():
+      try:
+        os.write(self._wake_write, 'x')
+      except OSError:
+        pass
+
+  def _Loop(self):
+    wake_read = self._wake_read
+    while True:
+      now = time.time()
+      self._lock.acquire()
+      try:
+        watchers = self._watchers.values()
+        for watcher in watchers:
+          if (not watcher.HasPending() and
+              now - watcher.last_sent >= self.heartbeat_interval):
+            watcher.Queue(': keep-alive\n\n')
+      finally:
+        self._lock.release()
+      try:
+        readable, writable, unused = select.select(
+            [wake_read] + [watcher.connection for watcher in watchers],
+            [watcher.connection for watcher in watchers
+             if watcher.HasPending()],
+            [], 1.0)
+      except (select.error, ValueError), e:
+        if isinstance(e, select.error) and e.args[0] == errno.EINTR:
+          continue
+        # A connection was closed underneath us, so find and drop it.
+        for watcher in watchers:
+          try:
+            select.select([watcher.connection], [], [], 0)
+          except (select.error, ValueError):
+            self._Drop(watcher)
+        continue
+      for ready in readable:
+        if ready is wake_read:
+          os.read(wake_read, 4096)
+        else:
+          self._ReadFromClient(self._watchers.get(ready))
+      for ready in writable:
+        self._Send(self._watchers.get(ready))
+
+  def _ReadFromClient(self, watcher):
+    """Watchers send nothing after their request, so this finds closes."""
+    if watcher is None:
+      return
+    try:
+      if not watcher.connection.recv(4096):
+        self._Drop(watcher)
+    except self._would_block_errors:
+      pass
+    except self._connection_errors, e:
+      if getattr(e, 'errno', None) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        self._Drop(watcher)
+
+  def _Send(self, watcher):
+    if watcher is None:
+      return
+    if watcher.pending_bytes > self.max_pending_bytes:
+      self._Drop(watcher)
+      return
+    while True:
+      if watcher.sending is None:
+        self._lock.acquire()
+        try:
+          if not watcher.pending:
+            return
+          watcher.sending = ''.join(watcher.pending)
+          watcher.pending = []
+        finally:
+          self._lock.release()
+      try:
+        sent = watcher.connection.send(watcher.sending)
+      except self._would_block_errors:
+        return
+      except self._connection_errors, e:
+        if getattr(e, 'errno', None) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+          self._Drop(watcher)
+        return
+      watcher.last_sent = time.time()
+      self._lock.acquire()
+      try:
+        watcher.pending_bytes -= sent
+      finally:
+        self._lock.release()
+      if sent < len(watcher.sending):
+        watcher.sending = watcher.sending[sent:]
+      else:
+        watcher.sending = None
+
+  def _Drop(self, watcher):
+    self._lock.acquire()
+    try:
+      if self._watchers.pop(watcher.connection, None) is None:
+        return
+    finally:
+      self._lock.release()
+    try:
+      self.close_connection(watcher.connection)
+    except self._connection_errors:
+      pass
@@ -14,15 +14,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import gzip
+import httplib
 import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import SocketServer
+import json
+from cStringIO import StringIO
+import scorpion_server.accesslog
+import scorpion_server.batch
+import scorpion_server.client
+import scorpion_server.compression
+import scorpion_server.concurrency
+import scorpion_server.httputil
+import scorpion_server.journal
+import scorpion_server.listing
+import scorpion_server.metrics
+import scorpion_server.passwords
+import scorpion_server.ratelimit
 import scorpion_server.server
+import scorpion_server.storage
+import scorpion_server.users
+import scorpion_server.watch
 
 
 class UserDataTest(unittest.TestCase):
 
   def setUp(self):
-    self.user_data = scorpion_server.server.UserData()
+    self.user_data = scorpion_server.users.UserData()
     self.user_data.LoadUserCredentials(os.path.join('test_config', 
                                                     'good_users'))
     self.user_data.LoadPermissionsMap(os.path.join('test_config', 
@@ -79,6 +108,29 @@ class UserDataTest(unittest.TestCase):
     self.assertEquals(self.user_data.UserCanReadResource('jeff', '/index'),
                       True)
     
+  def testPermissionIndexMatchesPrefixRules(self):
+    user_data = scorpion_server.users.UserData()
+    user_data.permissions = {'r': {'': ['/pub', '/a/b'], 'ann': ['/x']},
+                             'w': {'ann': ['/x/y', '/a'], 'bob': ['']}}
+    user_data._BuildPermissionIndex()
+    for resource in ['', '/', '/pub', '/public', '/pu', '/a', '/a/b/c', 
+                     '/x', '/x/', '/x/y', '/x/yz', '/b']:
+      for username in ['', 'ann', 'bob', 'nobody']:
+        can_write = False
+        can_read = False
+        for user in (username, ''):
+          for prefix in user_data.permissions['w'].get(user, []):
+            if resource.startswith(prefix):
+              can_write = True
+          for prefix in user_data.permissions['r'].get(user, []):
+            if resource.startswith(prefix):
+              can_read = True
+        self.assertEquals(
+            user_data.UserCanWriteResource(username, resource), can_write)
+        self.assertEquals(
+            user_data.UserCanReadResource(username, resource), 
+            can_read or can_write)
+    
   def testLoadNormalUserCredentials(self):
     self.user_data.LoadUserCredentials(os.path.join('test_config', 'good_users'))
     self.assertEquals(self.user_data.user_credentials.has_key('jeff'), True)
@@ -109,12 +161,119 @@ class UserDataTest(unittest.TestCase):
         'Basic amVmOnRlc3Q=') is None)
     
     
+class PasswordsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testVerifyPassword(self):
+    stored = scorpion_server.passwords.HashPassword('test', iterations=10)
+    self.assert_(stored.startswith('pbkdf2_sha256$10$'))
+    self.assertEquals(scorpion_server.passwords.VerifyPassword('test', 
+                                                               stored), True)
+    self.assertEquals(scorpion_server.passwords.VerifyPassword('test2', 
+                                                               stored), False)
+    # Plain text passwords from old users files still work.
+    self.assertEquals(scorpion_server.passwords.VerifyPassword('test', 
+                                                               'test'), True)
+
+  def testMigrateUsersFile(self):
+    users_file = os.path.join(self.temp_dir, 'users')
+    shutil.copy(os.path.join('test_config', 'good_users'), users_file)
+    self.assertEquals(scorpion_server.passwords.MigrateUsersFile(
+        users_file, iterations=10), 4)
+    # Running the migration again leaves the hashes alone.
+    self.assertEquals(scorpion_server.passwords.MigrateUsersFile(
+        users_file, iterations=10), 0)
+    user_data = scorpion_server.users.UserData(users_file)
+    self.assert_(scorpion_server.passwords.IsHashed(
+        user_data.user_credentials['jim']))
+    self.assertEquals(user_data.AuthenticateUser('jim', 'p4s5\\/\\/0rd'), 
+                      'jim')
+    self.assertEquals(user_data.AuthenticateUser('jeff', 'test'), 'jeff')
+    self.assertEquals(user_data.AuthenticateUser('jeff', 'wrong'), None)
+
+  def testSuccessfulLoginsAreCached(self):
+    user_data = scorpion_server.users.UserData(
+        os.path.join('test_config', 'good_users'))
+    self.assertEquals(user_data.FindUserFromAuthHeader('Basic amVmZjp0ZXN0'),
+                      'jeff')
+    # A cached login does not check the password again.
+    user_data.user_credentials['jeff'] = 'changed'
+    self.assertEquals(user_data.FindUserFromAuthHeader('Basic amVmZjp0ZXN0'),
+                      'jeff')
+    user_data.auth_cache.Clear()
+    self.assert_(user_data.FindUserFromAuthHeader('Basic amVmZjp0ZXN0') 
+                 is None)
+
+  def testLoginCacheCanBeTurnedOff(self):
+    user_data = scorpion_server.users.UserData(
+        os.path.join('test_config', 'good_users'), auth_cache_size=0)
+    self.assertEquals(user_data.FindUserFromAuthHeader('Basic amVmZjp0ZXN0'),
+                      'jeff')
+    user_data.user_credentials['jeff'] = 'changed'
+    self.assert_(user_data.FindUserFromAuthHeader('Basic amVmZjp0ZXN0')
+                 is None)
+
+
+class SharedUserDataTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.users_file = os.path.join(self.temp_dir, 'users')
+    self.permissions_file = os.path.join(self.temp_dir, 'permissions')
+    shutil.copy(os.path.join('test_config', 'good_users'), self.users_file)
+    shutil.copy(os.path.join('test_config', 'good_permissions'),
+                self.permissions_file)
+    self.source = scorpion_server.users.SharedUserData(self.users_file,
+                                                        self.permissions_file)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testSnapshotIsReusedUntilFilesChange(self):
+    first = self.source.GetUserData()
+    self.assert_(self.source.GetUserData() is first)
+    self.assertEquals(first.AuthenticateUser('jeff', 'test'), 'jeff')
+    users_file = open(self.users_file, 'a')
+    users_file.write('\nnew\tuser')
+    users_file.close()
+    second = self.source.GetUserData()
+    self.assert_(second is not first)
+    self.assertEquals(second.AuthenticateUser('new', 'user'), 'new')
+    # The old snapshot is unchanged for requests which still hold it.
+    self.assertEquals(first.AuthenticateUser('new', 'user'), None)
+
+  def testRequestReload(self):
+    first = self.source.GetUserData()
+    self.source.RequestReload()
+    self.assert_(self.source.GetUserData() is not first)
+
+  def testMalformedFileKeepsPreviousSnapshot(self):
+    first = self.source.GetUserData()
+    permissions_file = open(self.permissions_file, 'a')
+    permissions_file.write('\nw-no-tabs')
+    permissions_file.close()
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+      self.assert_(self.source.GetUserData() is first)
+      self.assert_('Could not reload' in sys.stderr.getvalue())
+    finally:
+      sys.stderr = stderr
+    shutil.copy(os.path.join('test_config', 'good_permissions'),
+                self.permissions_file)
+    self.source.RequestReload()
+    self.assert_(self.source.GetUserData() is not first)
     
     
 class DataStoreTest(unittest.TestCase):
 
   def setUp(self):
-    self.data = scorpion_server.server.DataStore('test_hosted', 'index')
+    self.data = scorpion_server.storage.DataStore('test_hosted', 'index')
     
   def testConvertingResourceToFileName(self):
     self.assertEquals(self.data._ConvertResourceToFileName('/'), 
@@ -137,7 +296,1677 @@ class DataStoreTest(unittest.TestCase):
     self.assertEquals(self.data.WriteResource('testfile', 'This is a test'), 
                       'This is a test')
     self.assertEquals(self.data.ReadResource('testfile'), 'This is a test')
-    
-    
+
+
+class DataStoreCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.data = scorpion_server.storage.DataStore(self.temp_dir, 'index', 
+                                                 cache_size=100)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testRepeatedReadsAreCached(self):
+    self.data.WriteResource('/a', 'first')
+    self.assertEquals(self.data.ReadResource('/a'), 'first')
+    self.assertEquals(self.data.ReadResource('/a'), 'first')
+    self.assertEquals(self.data.ResourceExists('/a'), True)
+    stats = self.data.CacheStats()
+    self.assertEquals(stats['hits'], 2)
+    self.assertEquals(stats['entries'], 1)
+
+  def testWriteInvalidatesCache(self):
+    self.data.WriteResource('/a', 'first')
+    self.data.ReadResource('/a')
+    self.data.WriteResource('/a', 'second')
+    self.assertEquals(self.data.ReadResource('/a'), 'second')
+
+  def testChangedFileIsReread(self):
+    self.data.WriteResource('/a', 'first')
+    self.data.ReadResource('/a')
+    resource_file = open(os.path.join(self.temp_dir, 'a'), 'wb')
+    resource_file.write('changed on disk')
+    resource_file.close()
+    self.assertEquals(self.data.ReadResource('/a'), 'changed on disk')
+
+  def testLargeResourcesAreStreamed(self):
+    self.data.WriteResource('/big', '0123456789' * 20)
+    handle = self.data.OpenResource('/big')
+    try:
+      self.assert_(handle.data is None)
+      self.assertEquals(handle.size, 200)
+      chunks = list(handle.Chunks(chunk_size=64))
+      self.assertEquals([len(chunk) for chunk in chunks], [64, 64, 64, 8])
+      self.assertEquals(''.join(chunks), '0123456789' * 20)
+      self.assertEquals(''.join(handle.Chunks(5, 15, chunk_size=4)), 
+                        '5678901234')
+    finally:
+      handle.Close()
+    self.assertEquals(self.data.CacheStats()['entries'], 0)
+
+  def testFailedStreamingWriteLeavesResourceUnchanged(self):
+    self.data.WriteResource('/a', 'original')
+
+    def BrokenUpload():
+      yield 'partial'
+      raise IOError('client went away')
+
+    self.assertRaises(IOError, self.data.WriteResourceStream, '/a', 
+                      BrokenUpload())
+    self.assertEquals(self.data.ReadResource('/a'), 'original')
+    self.assertEquals(os.listdir(self.temp_dir), ['a'])
+
+  def testWriteKeepsFileMode(self):
+    self.data.WriteResource('/a', 'first')
+    umask = os.umask(0)
+    os.umask(umask)
+    file_name = os.path.join(self.temp_dir, 'a')
+    self.assertEquals(os.stat(file_name).st_mode & 0777, 0666 & ~umask)
+    os.chmod(file_name, 0600)
+    self.data.WriteResource('/a', 'second')
+    self.assertEquals(os.stat(file_name).st_mode & 0777, 0600)
+
+  def testLeastRecentlyUsedEntriesAreEvicted(self):
+    for name in ('a', 'b', 'c'):
+      self.data.WriteResource('/' + name, name * 40)
+      self.data.ReadResource('/' + name)
+    stats = self.data.CacheStats()
+    self.assertEquals(stats['evictions'], 1)
+    self.assertEquals(stats['bytes'], 80)
+
+
+
+class StorageBackendTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _CheckBackend(self, backend):
+    data = scorpion_server.storage.DataStore(self.temp_dir, 'index',
+                                            cache_size=100, backend=backend)
+    self.assertEquals(data.ResourceExists('/a/b'), False)
+    self.assertRaises(IOError, data.ReadResource, '/a/b')
+    resource_stat = data.WriteResourceStream('/a/b', ['one', 'two'])
+    self.assertEquals(resource_stat.st_size, 6)
+    self.assertEquals(data.ResourceExists('/a/b'), True)
+    self.assertEquals(data.ReadResource('/a/b'), 'onetwo')
+    data.WriteResource('/a/b', 'three')
+    self.assertEquals(data.ReadResource('/a/b'), 'three')
+    data.WriteResource('/', 'home')
+    self.assertEquals(sorted(backend.ListResources()), ['/a/b', '/index'])
+
+  def testShardedBackend(self):
+    backend = scorpion_server.storage.ShardedFileSystemBackend(self.temp_dir,
+                                                               'index')
+    self._CheckBackend(backend)
+    # Shards for '/a/b', '/index' and the marker which records '/a/' as a
+    # directory.
+    self.assertEquals(len(os.listdir(self.temp_dir)), 3)
+
+  def testSqliteBackend(self):
+    backend = scorpion_server.storage.SqliteBackend(self.temp_dir, 'index')
+    self._CheckBackend(backend)
+    self.assertEquals(os.path.exists(os.path.join(self.temp_dir, 
+                                                  'resources.db')), True)
+
+  def testFailedSqliteBatchDoesNotStopLaterWrites(self):
+    backend = scorpion_server.storage.SqliteBackend(self.temp_dir, 'index')
+    connection = backend._Connection
+    failures = [RuntimeError('could not connect')]
+    def FailingConnection():
+      # Only the writer thread's first connection fails.
+      if failures and threading.currentThread().getName() == 'scorpion-sqlite':
+        raise failures.pop()
+      return connection()
+    backend._Connection = FailingConnection
+
+    def Write(data):
+      # Returns the write's error, if any, or fails if it never finishes.
+      errors = []
+      def Run():
+        try:
+          backend.WriteResourceStream('/a', [data])
+          errors.append(None)
+        except IOError, e:
+          errors.append(e)
+      writer = threading.Thread(target=Run)
+      writer.setDaemon(True)
+      writer.start()
+      writer.join(5)
+      self.assertEquals(len(errors), 1)
+      return errors[0]
+
+    self.assert_(isinstance(Write('one'), IOError))
+    self.assertEquals(Write('two'), None)
+    self.assertEquals(backend.OpenResource('/a').Read(), 'two')
+
+  def testMigrateResources(self):
+    source = scorpion_server.storage.SqliteBackend(
+        os.path.join(self.temp_dir, 'db'), 'index')
+    source.WriteResourceStream('/x/y', ['why'])
+    source.WriteResourceStream('/z', ['zed'])
+    destination = scorpion_server.storage.FileSystemBackend(
+        os.path.join(self.temp_dir, 'files'), 'index')
+    destination.create_directories = True
+    self.assertEquals(scorpion_server.storage.MigrateResources(
+        source, destination), 2)
+    self.assertEquals(destination.OpenResource('/x/y').Read(), 'why')
+    self.assertEquals(sorted(destination.ListResources()), ['/x/y', '/z'])
+
+  def testDirectoryNamesAfterMigration(self):
+    source = scorpion_server.storage.FileSystemBackend(
+        os.path.join(self.temp_dir, 'files'), 'index')
+    source.create_directories = True
+    source.WriteResourceStream('/public/index', ['home'])
+    source.WriteResourceStream('/public/app.js', ['js'])
+    source.WriteResourceStream('/docs/guide/intro', ['intro'])
+    for kind in ('sharded', 'sqlite'):
+      destination = scorpion_server.storage.CreateBackend(
+          kind, os.path.join(self.temp_dir, kind), 'index')
+      scorpion_server.storage.MigrateResources(source, destination)
+      self.assertEquals(destination.OpenResource('/public').Read(), 'home')
+      self.assertEquals(destination.ResourceExists('/docs'), False)
+      self.assertEquals(destination.ResourceName('/docs'), '/docs/index')
+      self.assertEquals(destination.ResourceExists('/docs/guide/intro'),
+                        True)
+      # Writing to a directory replaces its default file, as it does on the
+      # file system.
+      destination.WriteResourceStream('/docs', ['docs'])
+      self.assertEquals(destination.OpenResource('/docs/').Read(), 'docs')
+      self.assertEquals(sorted(destination.ListResources()),
+                        ['/docs/guide/intro', '/docs/index',
+                         '/public/app.js', '/public/index'])
+
+
+class JournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.hosted = os.path.join(self.temp_dir, 'hosted')
+    self.journal_dir = os.path.join(self.temp_dir, 'journal')
+    os.mkdir(self.hosted)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _NewStore(self, fsync_policy='group', max_bytes=1024 * 1024):
+    journal = scorpion_server.journal.Journal(self.journal_dir, fsync_policy,
+                                              max_bytes=max_bytes)
+    data = scorpion_server.storage.DataStore(self.hosted, 'index',
+                                            journal=journal)
+    return data, journal
+
+  def _Records(self, journal):
+    return [record[3] for record in
+            scorpion_server.journal._ReadRecords(journal.file_name)]
+
+  def testWritesAreJournaledAndReplayed(self):
+    data, journal = self._NewStore()
+    data.WriteResourceStream('/a', ['one', 'two'])
+    data.WriteResource('/b', 'bee')
+    self.assertEquals(data.ReadResource('/a'), 'onetwo')
+    self.assertEquals(self._Records(journal), ['/a', '/b'])
+    # Lose the applied content, as if the machine stopped before it was
+    # written out, and cut the last record in half.
+    os.remove(os.path.join(self.hosted, 'a'))
+    os.remove(os.path.join(self.hosted, 'b'))
+    journal_file = open(journal.file_name, 'r+b')
+    journal_file.truncate(os.path.getsize(journal.file_name) - 2)
+    journal_file.close()
+    data, journal = self._NewStore()
+    self.assertEquals(data.ReplayJournal(), 1)
+    self.assertEquals(data.ReadResource('/a'), 'onetwo')
+    self.assertEquals(data.ResourceExists('/b'), False)
+    self.assertEquals(journal.JournalFiles(), [])
+
+  def testFailedWriteIsCancelled(self):
+    data, journal = self._NewStore('always')
+    self.assertRaises(OSError, data.WriteResource, '/missing/a', 'x')
+    os.mkdir(os.path.join(self.hosted, 'missing'))
+    data, journal = self._NewStore()
+    self.assertEquals(data.ReplayJournal(), 0)
+    self.assertEquals(data.ResourceExists('/missing/a'), False)
+
+  def testGroupCommitSharesFsyncs(self):
+    data, journal = self._NewStore('group')
+    threads = [threading.Thread(target=data.WriteResource,
+                                args=('/r%d' % i, 'x' * 100))
+               for i in range(20)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(journal.Stats()['records'], 20)
+    self.assert_(1 <= journal.Stats()['fsyncs'] <= 20)
+    data, journal = self._NewStore('none')
+    data.WriteResource('/n', 'x')
+    self.assertEquals(journal.Stats()['fsyncs'], 0)
+
+  def testFailedWriteDoesNotStallGroupCommit(self):
+    journal = scorpion_server.journal.Journal(self.journal_dir, 'group')
+    failed = journal.Append('/a', ['x'])
+    appended = []
+    writer = threading.Thread(
+        target=lambda: appended.append(journal.Append('/b', ['y'])))
+    writer.setDaemon(True)
+    # Holding the sync condition keeps the second write waiting for its
+    # fsync while the first one is cancelled.
+    journal._sync_condition.acquire()
+    try:
+      writer.start()
+      deadline = time.time() + 5
+      while journal.Stats()['records'] < 2 and time.time() < deadline:
+        time.sleep(0.01)
+      journal.Applied(failed, succeeded=False)
+    finally:
+      journal._sync_condition.release()
+    writer.join(5)
+    self.assertEquals(len(appended), 1)
+    journal.Applied(appended[0])
+    self.assertEquals(self._Records(journal), ['/a', '/b', '/a'])
+
+  def testCheckpointTruncatesJournal(self):
+    data, journal = self._NewStore(max_bytes=200)
+    data.WriteResource('/a', 'x' * 150)
+    self.assertEquals(self._Records(journal), ['/a'])
+    data.WriteResource('/b', 'y' * 150)
+    self.assertEquals(self._Records(journal), [])
+    self.assertEquals(journal.Stats()['checkpoints'], 1)
+    self.assertEquals(data.ReadResource('/b'), 'y' * 150)
+
+  def testCheckpointTruncatesOtherProcessesFiles(self):
+    pid = os.fork()
+    if pid == 0:
+      data, journal = self._NewStore()
+      data.WriteResource('/x', 'one')
+      os._exit(0)
+    os.waitpid(pid, 0)
+    data, journal = self._NewStore(max_bytes=40)
+    data.WriteResource('/x', 'two')
+    self.assertEquals(journal.Stats()['checkpoints'], 1)
+    for file_name in journal.JournalFiles():
+      self.assertEquals(os.path.getsize(file_name), 0)
+    # Replaying must not roll /x back to the child's older write.
+    data, journal = self._NewStore()
+    data.ReplayJournal()
+    self.assertEquals(data.ReadResource('/x'), 'two')
+
+  def testCheckpointSyncsSqliteBackend(self):
+    journal = scorpion_server.journal.Journal(self.journal_dir,
+                                              max_bytes=100)
+    backend = scorpion_server.storage.SqliteBackend(self.hosted, 'index')
+    data = scorpion_server.storage.DataStore(self.hosted, 'index',
+                                            backend=backend, journal=journal)
+    synced = []
+    backend_sync = backend.Sync
+    backend.Sync = lambda resources: synced.append(sorted(resources)) or (
+        backend_sync(resources))
+    data.WriteResource('/a', 'x' * 150)
+    self.assertEquals(journal.Stats()['checkpoints'], 1)
+    self.assertEquals(synced, [['/a']])
+    self.assertEquals(data.ReadResource('/a'), 'x' * 150)
+
+
+class ResourceIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.data = scorpion_server.storage.DataStore(self.temp_dir, 'index')
+    self.index = scorpion_server.listing.ResourceIndex(self.data.backend)
+    self.data.AddListener(self.index.Update)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _Names(self, *args, **kwargs):
+    entries, next_after = self.index.List(*args, **kwargs)
+    return [entry[0] for entry in entries], next_after
+
+  def testRescanAndIncrementalUpdates(self):
+    os.mkdir(os.path.join(self.temp_dir, 'docs'))
+    self.data.WriteResource('/docs/b', 'bee')
+    self.data.WriteResource('/top', 'top')
+    self.index.Rescan()
+    self.assertEquals(len(self.index), 2)
+    self.data.WriteResource('/docs/a', 'a')
+    # Writing to a directory stores its default file.
+    self.data.WriteResource('/docs', 'home')
+    self.assertEquals(self._Names('/docs/'),
+                      (['/docs/a', '/docs/b', '/docs/index'], None))
+    self.assertEquals(self.index.List('/docs/b')[0], [
+        ('/docs/b', 3, os.path.getmtime(os.path.join(self.temp_dir, 'docs',
+                                                     'b')))])
+    self.assertEquals(self._Names('/'),
+                      (['/docs/a', '/docs/b', '/docs/index', '/top'], None))
+    self.assertEquals(self._Names('/none'), ([], None))
+
+  def testPaginationAndFiltering(self):
+    for name in 'abcde':
+      self.data.WriteResource('/' + name, name)
+    self.assertEquals(self._Names('/', limit=2), (['/a', '/b'], '/b'))
+    self.assertEquals(self._Names('/', after='/b', limit=2),
+                      (['/c', '/d'], '/d'))
+    self.assertEquals(self._Names('/', after='/d', limit=2), (['/e'], None))
+    visible = lambda name: name in ('/b', '/e')
+    self.assertEquals(self._Names('/', limit=1, is_visible=visible),
+                      (['/b'], '/b'))
+    self.assertEquals(self._Names('/', after='/b', limit=1,
+                                  is_visible=visible), (['/e'], None))
+
+  def testSqliteBackendNames(self):
+    backend = scorpion_server.storage.SqliteBackend(self.temp_dir, 'index')
+    backend.WriteResourceStream('/x/', ['one'])
+    backend.WriteResourceStream('/x/y', ['two'])
+    index = scorpion_server.listing.ResourceIndex(backend)
+    index.Rescan()
+    self.assertEquals([entry[:2] for entry in index.List('/x/')[0]],
+                      [('/x/index', 3), ('/x/y', 3)])
+
+
+class LoggerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.log_name = os.path.join(self.temp_dir, 'log')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testLogAppendsStructuredLines(self):
+    existing = open(self.log_name, 'w')
+    existing.write('old line\n')
+    existing.close()
+    logger = scorpion_server.accesslog.Logger()
+    logger.openLog(self.log_name)
+    logger.LogRequest('GET', '/index', '', 200, 12, 0.005, '127.0.0.1')
+    logger.Flush(5)
+    lines = open(self.log_name).readlines()
+    self.assertEquals(lines[0], 'old line\n')
+    entry = json.loads(lines[1])
+    self.assertEquals(entry['path'], '/index')
+    self.assertEquals(entry['status'], 200)
+    self.assertEquals(entry['bytes'], 12)
+    self.assertEquals(entry['ms'], 5.0)
+
+  def testLogIsRotated(self):
+    logger = scorpion_server.accesslog.Logger()
+    logger.openLog(self.log_name, max_bytes=100, backup_count=2)
+    for i in range(10):
+      logger.writeln('x' * 60)
+      logger.Flush(5)
+    self.assertEquals(sorted(os.listdir(self.temp_dir)), 
+                      ['log', 'log.1', 'log.2'])
+
+  def testRecordHoldsMessages(self):
+    logger = scorpion_server.accesslog.Logger()
+    logger.openLog(self.log_name)
+    logger.LogRequest('GET', '/a', '', 200, 1, 0.001)
+    logger.LogRequest('POST', '/b', 'jeff', 500, 1, 0.001, '127.0.0.1',
+                      ['Could not write /b'])
+    logger.Flush(5)
+    entries = [json.loads(line) for line in open(self.log_name)]
+    self.assertEquals(entries[0].has_key('messages'), False)
+    self.assertEquals(entries[1]['messages'], ['Could not write /b'])
+
+  def testOnlyTheOpeningProcessRotates(self):
+    logger = scorpion_server.accesslog.Logger()
+    logger.rotate_check_interval = 60
+    logger.openLog(self.log_name, max_bytes=100, backup_count=2)
+    pid = os.fork()
+    if pid == 0:
+      try:
+        for text in ('a' * 60, 'b' * 60):
+          logger.writeln(text)
+          logger.Flush(5)
+        deadline = time.time() + 5
+        while (not os.path.exists(self.log_name + '.1') and
+               time.time() < deadline):
+          time.sleep(0.01)
+        # The child carries on in the new file.
+        logger.writeln('c')
+        logger.Flush(5)
+      finally:
+        os._exit(0)
+    try:
+      deadline = time.time() + 5
+      while (os.path.getsize(self.log_name) < 122 and
+             time.time() < deadline):
+        time.sleep(0.01)
+      self.assertEquals(os.listdir(self.temp_dir), ['log'])
+      logger.writeln('d')
+      logger.Flush(5)
+    finally:
+      os.waitpid(pid, 0)
+    self.assertEquals(open(self.log_name + '.1').read(),
+                      '%s\n%s\nd\n' % ('a' * 60, 'b' * 60))
+    self.assertEquals(open(self.log_name).read(), 'c\n')
+
+  def testLogFilledByOtherProcessesIsRotated(self):
+    logger = scorpion_server.accesslog.Logger()
+    logger.rotate_check_interval = 0.01
+    logger.openLog(self.log_name, max_bytes=100)
+    child_log = open(self.log_name, 'a')
+    child_log.write('x' * 150)
+    child_log.close()
+    deadline = time.time() + 5
+    while os.path.getsize(self.log_name) and time.time() < deadline:
+      time.sleep(0.01)
+    # Let the writer thread go back to sleep.
+    logger.rotate_check_interval = 60
+    self.assertEquals(os.path.getsize(self.log_name), 0)
+
+  def testReadHotPaths(self):
+    logger = scorpion_server.accesslog.Logger()
+    logger.openLog(self.log_name)
+    for path, status in (('/a', 200), ('/b?x=1', 200), ('/b', 200),
+                         ('/c', 404), ('/c', 404), ('/a', 304)):
+      logger.LogRequest('GET', path, '', status, 1, 0.001)
+    logger.LogRequest('POST', '/d', '', 200, 1, 0.001)
+    logger.writeln('not json')
+    logger.Flush(5)
+    read = scorpion_server.accesslog.ReadHotPaths
+    self.assertEquals(read(self.log_name, 10), ['/b', '/a'])
+    self.assertEquals(read(self.log_name, 1), ['/b'])
+    self.assertEquals(read(self.log_name, 0), [])
+    self.assertEquals(read(os.path.join(self.temp_dir, 'missing'), 10), [])
+
+
+class MetricsTest(unittest.TestCase):
+
+  def testRender(self):
+    registry = scorpion_server.metrics.MetricsRegistry()
+    requests = registry.Add(scorpion_server.metrics.Counter(
+        'requests_total', 'Requests.', ('method',)))
+    latency = registry.Add(scorpion_server.metrics.Histogram(
+        'latency_seconds', 'Latency.', buckets=(0.1, 1.0)))
+    requests.Inc(1, 'GET')
+    requests.Inc(2, 'GET')
+    latency.Observe(0.05)
+    latency.Observe(0.5)
+    latency.Observe(5)
+    lines = registry.Render().splitlines()
+    self.assertEquals(lines[:3], ['# HELP requests_total Requests.',
+                                  '# TYPE requests_total counter',
+                                  'requests_total{method="GET"} 3'])
+    self.assert_('latency_seconds_bucket{le="0.1"} 1' in lines)
+    self.assert_('latency_seconds_bucket{le="1.0"} 2' in lines)
+    self.assert_('latency_seconds_bucket{le="+Inf"} 3' in lines)
+    self.assert_('latency_seconds_count 3' in lines)
+
+
+class HttpUtilTest(unittest.TestCase):
+
+  def testParseRange(self):
+    parse = scorpion_server.httputil.ParseRange
+    self.assertEquals(parse('bytes=0-499', 1000), (0, 500))
+    self.assertEquals(parse('bytes=500-', 1000), (500, 1000))
+    self.assertEquals(parse('bytes=-100', 1000), (900, 1000))
+    self.assertEquals(parse('bytes=-2000', 1000), (0, 1000))
+    self.assertEquals(parse('bytes=900-5000', 1000), (900, 1000))
+    self.assertEquals(parse('bytes=0-1,5-6', 1000), None)
+    self.assertEquals(parse('bytes=5-1', 1000), None)
+    self.assertEquals(parse('items=0-1', 1000), None)
+    self.assertRaises(scorpion_server.httputil.UnsatisfiableRangeError,
+                      parse, 'bytes=1000-', 1000)
+
+  def testIsNotModified(self):
+    not_modified = scorpion_server.httputil.IsNotModified
+    self.assertEquals(not_modified('"a", W/"b"', None, '"b"', 10), True)
+    self.assertEquals(not_modified('"a"', None, '"b"', 10), False)
+    self.assertEquals(not_modified('*', None, '"b"', 10), True)
+    self.assertEquals(not_modified(None, 'Thu, 01 Jan 1970 00:00:10 GMT', 
+                                   '"b"', 10.5), True)
+    self.assertEquals(not_modified(None, 'Thu, 01 Jan 1970 00:00:09 GMT', 
+                                   '"b"', 10.5), False)
+    # If-None-Match wins over If-Modified-Since.
+    self.assertEquals(not_modified('"a"', 'Thu, 01 Jan 1970 00:00:10 GMT', 
+                                   '"b"', 10), False)
+    self.assertEquals(not_modified(None, None, '"b"', 10), False)
+
+  def testRangeIsCurrent(self):
+    is_current = scorpion_server.httputil.RangeIsCurrent
+    self.assertEquals(is_current(None, '"a"', 10), True)
+    self.assertEquals(is_current('"a"', '"a"', 10), True)
+    self.assertEquals(is_current('"b"', '"a"', 10), False)
+    self.assertEquals(is_current('W/"a"', '"a"', 10), False)
+
+
+class BatchTest(unittest.TestCase):
+
+  def testRequestRoundTrip(self):
+    items = [('GET', '/public/a', None), ('POST', '/user/b', 'two\nlines'),
+             ('POST', '/user/empty', ''), ('GET', '/public/c', None)]
+    body = scorpion_server.batch.FormatBatchRequest(items)
+    self.assertEquals(scorpion_server.batch.ParseBatchRequest(body), items)
+
+  def testInvalidRequests(self):
+    parse = scorpion_server.batch.ParseBatchRequest
+    error = scorpion_server.batch.BatchFormatError
+    self.assertRaises(error, parse, 'DELETE /a\n')
+    self.assertRaises(error, parse, 'POST /a 10\nshort\n')
+    self.assertRaises(error, parse, 'POST /a x\n')
+    self.assertRaises(error, parse, 'GET /a\nGET /b\n', 1)
+
+  def testResponseFrames(self):
+    body = ''.join([scorpion_server.batch.FormatBatchFrame(200, '/a', 'abc'),
+                    scorpion_server.batch.FormatBatchFrame(404, '/b', ''),
+                    scorpion_server.batch.FormatBatchFrame(200, '/c', '\n')])
+    self.assertEquals(scorpion_server.batch.ParseBatchResponse(body),
+                      [(200, '/a', 'abc'), (404, '/b', ''), (200, '/c', '\n')])
+    self.assertRaises(scorpion_server.batch.BatchFormatError,
+                      scorpion_server.batch.ParseBatchResponse, '200 /a 5\nab')
+
+  def testNamesWithSpacesAreQuoted(self):
+    items = [('GET', '/jeff/something else', None),
+             ('POST', '/jeff/a%b c', 'x y')]
+    body = scorpion_server.batch.FormatBatchRequest(items)
+    self.assertEquals(body.splitlines()[0], 'GET /jeff/something%20else')
+    self.assertEquals(scorpion_server.batch.ParseBatchRequest(body), items)
+    frame = scorpion_server.batch.FormatBatchFrame(404, '/jeff/a%b c', '')
+    self.assertEquals(scorpion_server.batch.ParseBatchResponse(frame),
+                      [(404, '/jeff/a%b c', '')])
+
+  def testItemsAreReadAsTheyArrive(self):
+    read_chunks = []
+    def Chunks():
+      for chunk in ('GET /a\nPOST /b 1', '0\n01234', '56789\nGET', ' /c\n',
+                    'BAD\n'):
+        read_chunks.append(chunk)
+        yield chunk
+    items = scorpion_server.batch.ReadBatchRequest(Chunks())
+    self.assertEquals(items.next(), ('GET', '/a', None))
+    self.assertEquals(len(read_chunks), 1)
+    self.assertEquals(items.next(), ('POST', '/b', '0123456789'))
+    self.assertEquals(items.next(), ('GET', '/c', None))
+    self.assertEquals(len(read_chunks), 4)
+    self.assertRaises(scorpion_server.batch.BatchFormatError, items.next)
+
+
+class RateLimitTest(unittest.TestCase):
+
+  def testTokenBucket(self):
+    bucket = scorpion_server.ratelimit.TokenBucket(2.0, 4.0, 100.0)
+    self.assertEquals(bucket.WaitTime(4, 100.0), 0)
+    bucket.Take(6)
+    self.assertEquals(bucket.WaitTime(1, 100.0), 1.5)
+    self.assertEquals(bucket.WaitTime(1, 101.5), 0)
+    # The bucket never holds more than its burst.
+    self.assertEquals(bucket.WaitTime(5, 1000.0), 0.5)
+
+  def testRequestBudget(self):
+    limiter = scorpion_server.ratelimit.RateLimiter()
+    limit = scorpion_server.ratelimit.RateLimit(0.001, 2, 0, 0)
+    self.assertEquals(limiter.Admit('a', limit), 0)
+    self.assertEquals(limiter.Admit('a', limit), 0)
+    self.assert_(limiter.Admit('a', limit) > 0)
+    # Each client has its own buckets, and None means unlimited.
+    self.assertEquals(limiter.Admit('b', limit), 0)
+    self.assertEquals(limiter.Admit('a', None), 0)
+
+  def testByteBudget(self):
+    limiter = scorpion_server.ratelimit.RateLimiter()
+    limit = scorpion_server.ratelimit.RateLimit(0, 0, 0.001, 100)
+    # A body larger than the bucket is let through when the bucket is full.
+    self.assertEquals(limiter.Admit('a', limit, 1000), 0)
+    limiter.Charge('a', limit, 1000)
+    self.assert_(limiter.Admit('a', limit, 0) > 0)
+
+  def testLeastRecentlyUsedClientsAreForgotten(self):
+    limiter = scorpion_server.ratelimit.RateLimiter(max_clients=1)
+    limit = scorpion_server.ratelimit.RateLimit(0.001, 1, 0, 0)
+    self.assertEquals(limiter.Admit('a', limit), 0)
+    self.assertEquals(limiter.Admit('b', limit), 0)
+    self.assertEquals(limiter.Admit('a', limit), 0)
+
+  def testLoadRateLimits(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      file_name = os.path.join(temp_dir, 'ratelimits')
+      limits_file = open(file_name, 'w')
+      limits_file.write('# user\trequests\tburst\tbytes\tburst\n'
+                        '\t5\t10\t0\t0\n*\t50\t100\t1000\t5000\n')
+      limits_file.close()
+      user_data = scorpion_server.users.UserData(rate_limits_file=file_name)
+      self.assertEquals(user_data.RateLimitFor(''),
+                        scorpion_server.ratelimit.RateLimit(5, 10, 0, 0))
+      self.assertEquals(user_data.RateLimitFor(None),
+                        user_data.RateLimitFor(''))
+      self.assertEquals(user_data.RateLimitFor('jeff'),
+                        scorpion_server.ratelimit.RateLimit(50, 100, 1000, 5000))
+    finally:
+      shutil.rmtree(temp_dir)
+    self.assertEquals(scorpion_server.users.UserData().RateLimitFor('jeff'),
+                      None)
+
+  def testConcurrencyLimit(self):
+    slots = scorpion_server.ratelimit.ConcurrencyLimit(1)
+    self.assertEquals(slots.Acquire(), True)
+    self.assertEquals(slots.Acquire(), False)
+    slots.Release()
+    self.assertEquals(slots.Acquire(), True)
+
+
+class CompressionTest(unittest.TestCase):
+
+  def testChooseContentEncoding(self):
+    choose = scorpion_server.httputil.ChooseContentEncoding
+    self.assertEquals(choose('gzip, deflate', ['br', 'gzip']), 'gzip')
+    self.assertEquals(choose('gzip;q=0.5, br', ['br', 'gzip']), 'br')
+    self.assertEquals(choose('gzip;q=0', ['gzip']), None)
+    self.assertEquals(choose('*', ['gzip']), 'gzip')
+    self.assertEquals(choose('identity', ['gzip']), None)
+    self.assertEquals(choose(None, ['gzip']), None)
+
+  def testIsCompressible(self):
+    compressible = scorpion_server.compression.IsCompressible
+    self.assertEquals(compressible('text/html; charset=utf-8'), True)
+    self.assertEquals(compressible('application/json'), True)
+    self.assertEquals(compressible('image/svg+xml'), True)
+    self.assertEquals(compressible('image/png'), False)
+    self.assertEquals(compressible('application/zip'), False)
+
+  def testVariantsAreCachedByETag(self):
+    variants = scorpion_server.compression.CompressedVariantCache(1 << 20)
+    reads = []
+    def ReadData():
+      reads.append(1)
+      return 'abc' * 1000
+    first = variants.GetVariant('f', '"1-1"', 'gzip', ReadData)
+    second = variants.GetVariant('f', '"1-1"', 'gzip', ReadData)
+    self.assertEquals(first, second)
+    self.assertEquals(len(reads), 1)
+    self.assertEquals(gzip.GzipFile(fileobj=StringIO(first)).read(),
+                      'abc' * 1000)
+    # A changed resource has a new ETag and is compressed again.
+    variants.GetVariant('f', '"1-2"', 'gzip', ReadData)
+    self.assertEquals(len(reads), 2)
+    self.assertEquals(scorpion_server.compression.VariantETag('"1-2"', 'gzip'),
+                      '"1-2-gzip"')
+
+
+class WatchHubTest(unittest.TestCase):
+
+  def setUp(self):
+    self.closed = []
+    self.hub = scorpion_server.watch.WatchHub(self.closed.append)
+    self.sockets = []
+
+  def tearDown(self):
+    for sock in self.sockets:
+      sock.close()
+
+  def Watch(self, prefix, last_event_id=None):
+    server_end, client_end = socket.socketpair()
+    self.sockets.extend([server_end, client_end])
+    client_end.settimeout(5)
+    self.hub.Attach(server_end, prefix, last_event_id)
+    return socket._fileobject(client_end, 'rb')
+
+  def ReadEvent(self, stream):
+    lines = []
+    while True:
+      line = stream.readline().rstrip('\n')
+      if not line:
+        break
+      lines.append(line)
+    event = dict([line.split(': ', 1) for line in lines])
+    event['data'] = json.loads(event['data'])
+    return event
+
+  def testChangesAreSentToMatchingWatchers(self):
+    stream = self.Watch('/user/')
+    ready = self.ReadEvent(stream)
+    self.assertEquals(ready['event'], 'ready')
+    self.hub.Notify('/other', scorpion_server.storage.ResourceStat(1, 10.0))
+    self.hub.Notify('/user/a', scorpion_server.storage.ResourceStat(3, 10.0))
+    change = self.ReadEvent(stream)
+    self.assertEquals(change['event'], 'change')
+    self.assertEquals(change['data'], {'resource': '/user/a', 'size': 3,
+                                       'etag': '"3-989680"'})
+    self.assertNotEquals(change['id'], ready['id'])
+    self.assertEquals(self.hub.WatcherCount(), 1)
+
+  def testReconnectingReplaysMissedChanges(self):
+    stream = self.Watch('/user/')
+    last_event_id = self.ReadEvent(stream)['id']
+    self.hub.Notify('/user/a', scorpion_server.storage.ResourceStat(1, 1.0))
+    self.hub.Notify('/user/b', scorpion_server.storage.ResourceStat(2, 1.0))
+    stream = self.Watch('/user/b', last_event_id)
+    self.assertEquals(self.ReadEvent(stream)['data']['resource'], '/user/b')
+    self.assertEquals(self.ReadEvent(stream)['event'], 'ready')
+    stream = self.Watch('/user/', 'unknown-1')
+    self.assertEquals(self.ReadEvent(stream)['event'], 'reset')
+
+  def testClosedWatchersAreDropped(self):
+    self.hub.max_watchers = 1
+    stream = self.Watch('/')
+    self.ReadEvent(stream)
+    self.assertEquals(self.hub.IsFull(), True)
+    stream.close()
+    self.sockets[-1].close()
+    for i in xrange(50):
+      if self.closed:
+        break
+      time.sleep(0.1)
+    self.assertEquals(self.closed, [self.sockets[-2]])
+    self.assertEquals(self.hub.WatcherCount(), 0)
+
+
+class ServerConfigTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testDefaultsComeFromModule(self):
+    config = scorpion_server.server.ServerConfig(server_port='8443')
+    self.assertEquals(config.server_port, 8443)
+    self.assertEquals(config.resource_directory,
+                      scorpion_server.server.RESOURCE_DIRECTORY)
+    self.assertRaises(ValueError, config.Set, 'no_such_setting', 1)
+    self.assertRaises(ValueError, config.Set, 'worker_threads', 'many')
+
+  def testFileAndCommandLine(self):
+    file_name = os.path.join(self.temp_dir, 'server.cfg')
+    config_file = open(file_name, 'w')
+    config_file.write('[server]\nserver_port = 8443\n'
+                      'resource_directory = resources\n'
+                      'max_concurrent_uploads = none\n')
+    config_file.close()
+    config = scorpion_server.server.ServerConfig(max_concurrent_uploads=4)
+    config.ParseArgs(['--config', file_name, '--server-port', '9443'])
+    self.assertEquals(config.server_port, 9443)
+    self.assertEquals(config.resource_directory, 'resources')
+    self.assertEquals(config.max_concurrent_uploads, None)
+    self.assertRaises(ValueError, config.ParseArgs, ['extra'])
+
+  def testApply(self):
+    original = scorpion_server.server.SERVER_PORT
+    config = scorpion_server.server.ServerConfig(server_port=8443)
+    try:
+      config.Apply()
+      self.assertEquals(scorpion_server.server.SERVER_PORT, 8443)
+    finally:
+      scorpion_server.server.SERVER_PORT = original
+
+
+class ImportTest(unittest.TestCase):
+
+  def testUsersAndStorageDoNotLoadTheServer(self):
+    # Run in a new interpreter since this one has already imported them.
+    script = ('import sys\n'
+              'import scorpion_server.users\n'
+              'import scorpion_server.storage\n'
+              'print sorted(name for name in ("BaseHTTPServer", "OpenSSL", '
+              '"scorpion_server.server", "sqlite3") if name in sys.modules)'
+              '\n')
+    child = subprocess.Popen([sys.executable, '-c', script],
+                             stdout=subprocess.PIPE)
+    output = child.communicate()[0]
+    self.assertEquals(child.returncode, 0)
+    self.assertEquals(output.strip(), '[]')
+
+
+class ThreadPoolMixInTest(unittest.TestCase):
+
+  def testConnectionsAreHandledConcurrently(self):
+    arrived = []
+    all_arrived = threading.Event()
+
+    class WaitingHandler(SocketServer.BaseRequestHandler):
+      def handle(self):
+        arrived.append(1)
+        if len(arrived) == 3:
+          all_arrived.set()
+        # Only returns early if the other handlers run at the same time.
+        all_arrived.wait(5)
+        self.request.sendall(str(all_arrived.isSet()))
+
+    class PooledServer(scorpion_server.concurrency.ThreadPoolMixIn, 
+                       SocketServer.TCPServer):
+      worker_threads = 3
+
+    server = PooledServer(('127.0.0.1', 0), WaitingHandler)
+    server_thread = threading.Thread(target=server.serve_forever, 
+                                     args=(0.05,))
+    server_thread.setDaemon(True)
+    server_thread.start()
+    try:
+      clients = [socket.create_connection(server.server_address) 
+                 for i in range(3)]
+      for client in clients:
+        self.assertEquals(client.recv(10), 'True')
+        client.close()
+    finally:
+      server.shutdown()
+      server.server_close()
+
+
+class PlainServerMixIn:
+  """Serves plain HTTP, so that handlers can be tested without TLS."""
+
+  def _CreateSocket(self):
+    return socket.socket(self.address_family, self.socket_type)
+
+  def _ShutdownConnection(self, request):
+    try:
+      request.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+
+
+class ServerTestCase(unittest.TestCase):
+  """Runs a server on a loopback port in a temporary directory."""
+
+  JEFF = 'Basic ' + base64.b64encode('jeff:test')
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.hosted = os.path.join(self.temp_dir, 'hosted')
+    self.config_dir = os.path.join(self.temp_dir, 'config')
+    os.mkdir(self.hosted)
+    os.mkdir(self.config_dir)
+    shutil.copy(os.path.join('test_config', 'good_users'),
+                os.path.join(self.config_dir, 'users'))
+    permissions_file = open(os.path.join(self.config_dir, 'permissions'),
+                            'w')
+    permissions_file.write('r\t\t/\nw\tjeff\t/\n')
+    permissions_file.close()
+    self.saved_settings = {}
+    self._Configure(CONFIGURATION_DIRECTORY=self.config_dir,
+                    RESOURCE_DIRECTORY=self.hosted, WORKER_THREADS=4,
+                    LISTING_RESCAN_INTERVAL=None)
+    self.servers = []
+
+  def tearDown(self):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+    for name, value in self.saved_settings.items():
+      setattr(scorpion_server.server, name, value)
+    shutil.rmtree(self.temp_dir)
+
+  def _Configure(self, **settings):
+    """Changes scorpion_server.server settings until the test finishes."""
+    for name, value in settings.items():
+      if not self.saved_settings.has_key(name):
+        self.saved_settings[name] = getattr(scorpion_server.server, name)
+      setattr(scorpion_server.server, name, value)
+
+  def _CreateServer(self, mode='threaded', tls=False):
+    server_class = scorpion_server.server.SERVER_CLASSES[mode]
+    if not tls:
+      class PlainServer(PlainServerMixIn, server_class):
+        pass
+      server_class = PlainServer
+    return server_class(('127.0.0.1', 0),
+                        scorpion_server.server.ScorpionResourceRequestHandler)
+
+  def _StartServer(self, mode='threaded', tls=False):
+    server = self._CreateServer(mode, tls)
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     args=(0.05,))
+    server_thread.setDaemon(True)
+    server_thread.start()
+    self.servers.append(server)
+    return server
+
+  def _Connect(self, server):
+    return httplib.HTTPConnection('127.0.0.1', server.server_address[1],
+                                  timeout=10)
+
+  def _Request(self, connection, method, path, body=None, headers=None):
+    connection.request(method, path, body, headers or {})
+    response = connection.getresponse()
+    return response.status, response.read(), response
+
+  def _RawRequest(self, server, request):
+    """Sends request as it is and returns the response to it."""
+    client = socket.create_connection(server.server_address, 10)
+    client.sendall(request)
+    response = httplib.HTTPResponse(client)
+    response.begin()
+    body = response.read()
+    client.close()
+    return response.status, body
+
+
+class RequestHandlerTest(ServerTestCase):
+
+  def testGetStreamsResourcesInChunks(self):
+    # Too large for the cache, so it is read from the file as it is sent.
+    self._Configure(RESOURCE_CACHE_MAX_ENTRY_BYTES=100,
+                    STREAM_CHUNK_SIZE=1000)
+    content = ''.join([chr(i % 256) for i in range(10000)])
+    open(os.path.join(self.hosted, 'large'), 'wb').write(content)
+    open(os.path.join(self.hosted, 'small.css'), 'w').write('a {}')
+    server = self._StartServer()
+    connection = self._Connect(server)
+    status, body, response = self._Request(connection, 'GET', '/large')
+    self.assertEquals((status, body), (200, content))
+    self.assertEquals(response.getheader('content-length'), '10000')
+    self.assertEquals(response.getheader('content-type'), 'text/html')
+    connection.close()
+    connection = self._Connect(server)
+    status, body, response = self._Request(connection, 'GET', '/small.css')
+    self.assertEquals((status, body), (200, 'a {}'))
+    self.assertEquals(response.getheader('content-type'), 'text/css')
+    connection.close()
+
+  def testMissingResourceIsNotFound(self):
+    server = self._StartServer()
+    connection = self._Connect(server)
+    self.assertEquals(self._Request(connection, 'GET', '/missing')[0], 404)
+    connection.close()
+
+  def testChunkedUpload(self):
+    server = self._StartServer()
+    status, body = self._RawRequest(server,
+        'POST /a HTTP/1.1\r\nHost: test\r\nAuthorization: %s\r\n'
+        'Transfer-Encoding: chunked\r\n\r\n'
+        '5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n' % self.JEFF)
+    self.assertEquals(status, 200)
+    self.assertEquals(open(os.path.join(self.hosted, 'a')).read(),
+                      'hello world')
+
+  def testUploadWithoutLengthIsRefused(self):
+    server = self._StartServer()
+    status, body = self._RawRequest(server,
+        'POST /a HTTP/1.1\r\nHost: test\r\nAuthorization: %s\r\n\r\n'
+        % self.JEFF)
+    self.assertEquals(status, 411)
+    self.assertEquals(os.listdir(self.hosted), [])
+
+  def testLargeUploadIsRefusedBeforeItsBodyIsRead(self):
+    self._Configure(MAX_UPLOAD_BYTES=10)
+    server = self._StartServer()
+    # None of the body is sent, so the reply can only come from the headers.
+    status, body = self._RawRequest(server,
+        'POST /a HTTP/1.1\r\nHost: test\r\nAuthorization: %s\r\n'
+        'Content-Length: 11\r\n\r\n' % self.JEFF)
+    self.assertEquals(status, 413)
+    self.assertEquals(os.listdir(self.hosted), [])
+
+  def testFailedPostIsReported(self):
+    server = self._StartServer()
+    connection = self._Connect(server)
+    status, body, response = self._Request(
+        connection, 'POST', '/missing/a', 'x', {'Authorization': self.JEFF})
+    self.assertEquals(status, 404)
+    connection.close()
+    # The parent is a file rather than a directory.
+    open(os.path.join(self.hosted, 'file'), 'w').close()
+    connection = self._Connect(server)
+    status, body, response = self._Request(
+        connection, 'POST', '/file/a', 'x', {'Authorization': self.JEFF})
+    self.assertEquals(status, 500)
+    connection.close()
+
+  def testLogHoldsOnlyRequestRecords(self):
+    saved_log = scorpion_server.server.log
+    scorpion_server.server.log = scorpion_server.accesslog.Logger()
+    log_name = os.path.join(self.temp_dir, 'log')
+    scorpion_server.server.log.openLog(log_name)
+    try:
+      server = self._StartServer()
+      connection = self._Connect(server)
+      self._Request(connection, 'POST', '/missing/a', 'x',
+                    {'Authorization': self.JEFF})
+      connection.close()
+      connection = self._Connect(server)
+      self._Request(connection, 'GET', '/missing')
+      connection.close()
+      scorpion_server.server.log.Flush(5)
+    finally:
+      scorpion_server.server.log = saved_log
+    entries = [json.loads(line) for line in open(log_name)]
+    self.assertEquals([(entry['method'], entry['status'])
+                       for entry in entries], [('POST', 404), ('GET', 404)])
+    self.assertEquals(
+        entries[0]['messages'][0].startswith('Could not write /missing/a'),
+        True)
+
+  def testMalformedBatchItemEndsTheResponse(self):
+    open(os.path.join(self.hosted, 'a'), 'w').write('content')
+    server = self._StartServer()
+    connection = self._Connect(server)
+    status, body, response = self._Request(
+        connection, 'POST', '/_batch', 'GET /a\nBAD\nGET /a\n',
+        {'Authorization': self.JEFF})
+    self.assertEquals(status, 200)
+    frames = scorpion_server.batch.ParseBatchResponse(body)
+    self.assertEquals([frame[:2] for frame in frames],
+                      [(200, '/a'), (400, '*')])
+    # The rest of the body was not read, so the connection is closed.
+    self.assertEquals(connection.sock.recv(1), '')
+    connection.close()
+
+  def testRateLimitIsCheckedBeforePasswords(self):
+    # Anonymous clients, and logins which are not cached yet, may make one
+    # request.
+    limits_file = open(os.path.join(self.config_dir, 'ratelimits'), 'w')
+    limits_file.write('\t0.001\t1\t0\t0\n')
+    limits_file.close()
+    server = self._StartServer()
+    user_data = server.GetUserData()
+    checked = []
+    authenticate = user_data.AuthenticateUser
+    user_data.AuthenticateUser = lambda username, password: (
+        checked.append(username) or authenticate(username, password))
+    wrong_password = {'Authorization': 'Basic ' +
+                      base64.b64encode('jeff:wrong')}
+    for expected_status in (401, 429, 429):
+      connection = self._Connect(server)
+      status, body, response = self._Request(connection, 'GET', '/a', None,
+                                             wrong_password)
+      self.assertEquals(status, expected_status)
+      if status == 429:
+        # One request per thousand seconds.
+        self.assert_(900 <= int(response.getheader('retry-after')) <= 1000)
+      connection.close()
+    # Rejected requests never reach the password hash.
+    self.assertEquals(checked, ['jeff'])
+
+  def testBatchItemsAreRateLimited(self):
+    limits_file = open(os.path.join(self.config_dir, 'ratelimits'), 'w')
+    limits_file.write('\t0.001\t2\t0\t0\n')
+    limits_file.close()
+    open(os.path.join(self.hosted, 'a'), 'w').write('content')
+    server = self._StartServer()
+    connection = self._Connect(server)
+    status, body, response = self._Request(
+        connection, 'POST', '/_batch', 'GET /a\nGET /a\nGET /a\n',
+        {'Authorization': self.JEFF})
+    self.assertEquals(status, 200)
+    self.assertEquals(
+        [frame[0] for frame in scorpion_server.batch.ParseBatchResponse(body)],
+        [200, 200, 429])
+    connection.close()
+
+  def testUploadsBeyondTheLimitAreShed(self):
+    self._Configure(MAX_CONCURRENT_UPLOADS=1)
+    server = self._StartServer()
+    # An upload which has been admitted and is waiting for its body.
+    slow = socket.create_connection(server.server_address, 10)
+    slow.sendall('POST /a HTTP/1.1\r\nHost: test\r\nAuthorization: %s\r\n'
+                 'Content-Length: 10\r\n\r\nabc' % self.JEFF)
+    deadline = time.time() + 5
+    while not server.upload_slots.active and time.time() < deadline:
+      time.sleep(0.01)
+    connection = self._Connect(server)
+    status, body, response = self._Request(connection, 'POST', '/b', 'x',
+                                           {'Authorization': self.JEFF})
+    self.assertEquals(status, 503)
+    self.assertEquals(response.getheader('retry-after'), '1')
+    self.assertEquals(os.path.exists(os.path.join(self.hosted, 'b')), False)
+    connection.close()
+    # Reads are not uploads, so they are still served.
+    connection = self._Connect(server)
+    self.assertEquals(self._Request(connection, 'GET', '/missing')[0], 404)
+    connection.close()
+    slow.sendall('defghij')
+    response = httplib.HTTPResponse(slow)
+    response.begin()
+    self.assertEquals(response.status, 200)
+    slow.close()
+
+  def testMetricsAreOnlyServedToUsers(self):
+    server = self._StartServer()
+    connection = self._Connect(server)
+    status, body, response = self._Request(connection, 'GET', '/_metrics')
+    self.assertEquals(status, 401)
+    self.assertEquals(body.find('scorpion_'), -1)
+    connection.close()
+    connection = self._Connect(server)
+    self._Request(connection, 'BREW', '/pot')
+    connection.close()
+    connection = self._Connect(server)
+    status, body, response = self._Request(connection, 'GET', '/_metrics',
+                                           None, {'Authorization': self.JEFF})
+    self.assertEquals(status, 200)
+    self.assert_('# TYPE scorpion_request_seconds histogram' in body)
+    # Made up methods do not get a label value of their own.
+    self.assert_('method="other"' in body)
+    self.assertEquals(body.find('BREW'), -1)
+    connection.close()
+
+
+class ConditionalRequestTest(ServerTestCase):
+
+  def setUp(self):
+    ServerTestCase.setUp(self)
+    open(os.path.join(self.hosted, 'a'), 'w').write('0123456789')
+    self.server = self._StartServer()
+
+  def _Get(self, headers):
+    connection = self._Connect(self.server)
+    try:
+      return self._Request(connection, 'GET', '/a', None, headers)
+    finally:
+      connection.close()
+
+  def testIfNoneMatchIsAnsweredWithNotModified(self):
+    status, body, response = self._Get({})
+    etag = response.getheader('etag')
+    status, body, response = self._Get({'If-None-Match': etag})
+    self.assertEquals((status, body), (304, ''))
+    self.assertEquals(response.getheader('etag'), etag)
+    status, body, response = self._Get({'If-None-Match': '"other"'})
+    self.assertEquals((status, body), (200, '0123456789'))
+
+  def testRangeIsAnsweredWithPartialContent(self):
+    status, body, response = self._Get({'Range': 'bytes=2-5'})
+    self.assertEquals((status, body), (206, '2345'))
+    self.assertEquals(response.getheader('content-range'), 'bytes 2-5/10')
+    self.assertEquals(response.getheader('content-length'), '4')
+
+  def testUnsatisfiableRange(self):
+    status, body, response = self._Get({'Range': 'bytes=20-'})
+    self.assertEquals(status, 416)
+    self.assertEquals(response.getheader('content-range'), 'bytes */10')
+
+  def testIfRange(self):
+    etag = self._Get({})[2].getheader('etag')
+    status, body, response = self._Get({'Range': 'bytes=-3',
+                                        'If-Range': etag})
+    self.assertEquals((status, body), (206, '789'))
+    # The client's copy is out of date, so it gets the whole resource.
+    status, body, response = self._Get({'Range': 'bytes=-3',
+                                        'If-Range': '"stale"'})
+    self.assertEquals((status, body), (200, '0123456789'))
+    self.assertEquals(response.getheader('content-range'), None)
+
+
+class ContentEncodingTest(ServerTestCase):
+
+  CONTENT = '<p>compress me</p>\n' * 200
+
+  def setUp(self):
+    ServerTestCase.setUp(self)
+    open(os.path.join(self.hosted, 'page.html'), 'w').write(self.CONTENT)
+    self.server = self._StartServer()
+
+  def _Get(self, headers):
+    connection = self._Connect(self.server)
+    try:
+      return self._Request(connection, 'GET', '/page.html', None, headers)
+    finally:
+      connection.close()
+
+  def testGzipVariantHasItsOwnETag(self):
+    status, body, identity = self._Get({})
+    self.assertEquals((status, body), (200, self.CONTENT))
+    self.assertEquals(identity.getheader('vary'), 'Accept-Encoding')
+    status, body, response = self._Get({'Accept-Encoding': 'gzip'})
+    self.assertEquals(status, 200)
+    self.assertEquals(response.getheader('content-encoding'), 'gzip')
+    self.assertEquals(response.getheader('vary'), 'Accept-Encoding')
+    self.assertEquals(gzip.GzipFile(fileobj=StringIO(body)).read(),
+                      self.CONTENT)
+    etag = response.getheader('etag')
+    self.assertEquals(etag, identity.getheader('etag')[:-1] + '-gzip"')
+    # Each variant is only revalidated by its own ETag.
+    status, body, response = self._Get({'Accept-Encoding': 'gzip',
+                                        'If-None-Match': etag})
+    self.assertEquals(status, 304)
+    self.assertEquals(response.getheader('vary'), 'Accept-Encoding')
+    status, body, response = self._Get({'If-None-Match': etag})
+    self.assertEquals((status, body), (200, self.CONTENT))
+
+  def testRangeIsServedUnencoded(self):
+    status, body, response = self._Get({'Accept-Encoding': 'gzip',
+                                        'Range': 'bytes=0-9'})
+    self.assertEquals((status, body), (206, self.CONTENT[:10]))
+    self.assertEquals(response.getheader('content-encoding'), None)
+    self.assertEquals(response.getheader('content-range'),
+                      'bytes 0-9/%d' % len(self.CONTENT))
+
+
+class KeepAliveTest(ServerTestCase):
+
+  def setUp(self):
+    ServerTestCase.setUp(self)
+    open(os.path.join(self.hosted, 'a'), 'w').write('content')
+
+  def _ReadResponse(self, client):
+    response = httplib.HTTPResponse(client)
+    response.begin()
+    return response.status, response.read(), response
+
+  def testPipelinedRequests(self):
+    for mode in ('threaded', 'event'):
+      server = self._StartServer(mode)
+      client = socket.create_connection(server.server_address, 10)
+      # The second request arrives in the same packet as the first, so it
+      # is already buffered when the first response has been sent.
+      client.sendall('GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+                     'GET /missing HTTP/1.1\r\nHost: x\r\n\r\n'
+                     'POST /b HTTP/1.1\r\nHost: x\r\nAuthorization: %s\r\n'
+                     'Content-Length: 3\r\n\r\nnew' % self.JEFF)
+      status, body, response = self._ReadResponse(client)
+      self.assertEquals((status, body), (200, 'content'))
+      self.assertEquals(response.getheader('content-length'), '7')
+      status, body, response = self._ReadResponse(client)
+      self.assertEquals(status, 404)
+      self.assertEquals(len(body), int(response.getheader('content-length')))
+      status, body, response = self._ReadResponse(client)
+      self.assertEquals(status, 200)
+      self.assertEquals(response.getheader('connection'), None)
+      client.close()
+      self.assertEquals(open(os.path.join(self.hosted, 'b')).read(), 'new')
+
+  def testUnknownMethodIsAnswered(self):
+    for mode in ('threaded', 'event'):
+      server = self._StartServer(mode)
+      connection = self._Connect(server)
+      self.assertEquals(self._Request(connection, 'BREW', '/a')[0], 501)
+      self.assertEquals(self._Request(connection, 'GET', '/a')[0], 200)
+      connection.close()
+
+  def testRequestLimitPerConnection(self):
+    self._Configure(MAX_KEEPALIVE_REQUESTS=2)
+    for mode in ('threaded', 'event'):
+      server = self._StartServer(mode)
+      connection = self._Connect(server)
+      response = self._Request(connection, 'GET', '/a')[2]
+      self.assertEquals(response.getheader('connection'), None)
+      # In the event mode the connection went back to the loop in between,
+      # and the count carries on.
+      response = self._Request(connection, 'GET', '/a')[2]
+      self.assertEquals(response.getheader('connection'), 'close')
+      connection.close()
+
+  def _CheckIdleConnectionsDoNotStarve(self, mode):
+    self._Configure(WORKER_THREADS=2, KEEPALIVE_TIMEOUT=10)
+    server = self._StartServer(mode)
+    idle = []
+    for i in range(2):
+      connection = self._Connect(server)
+      self.assertEquals(self._Request(connection, 'GET', '/a')[0], 200)
+      idle.append(connection)
+    started = time.time()
+    connection = self._Connect(server)
+    self.assertEquals(self._Request(connection, 'GET', '/a')[0], 200)
+    self.assert_(time.time() - started < 2)
+    connection.close()
+    return idle
+
+  def testIdleConnectionsWaitInEventLoop(self):
+    idle = self._CheckIdleConnectionsDoNotStarve('event')
+    # Both idle connections are still open and can be used again.
+    for connection in idle:
+      self.assertEquals(self._Request(connection, 'GET', '/a')[0], 200)
+      connection.close()
+
+  def testOldestIdleConnectionIsGivenUp(self):
+    oldest, newest = self._CheckIdleConnectionsDoNotStarve('threaded')
+    oldest.sock.settimeout(5)
+    self.assertEquals(oldest.sock.recv(1), '')
+    oldest.close()
+    newest.close()
+
+
+class TlsSessionTest(ServerTestCase):
+
+  def setUp(self):
+    try:
+      from OpenSSL import crypto
+      from OpenSSL import SSL
+    except ImportError:
+      self.skipTest('pyOpenSSL is not installed')
+    ServerTestCase.setUp(self)
+    self.SSL = SSL
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    certificate = crypto.X509()
+    certificate.get_subject().CN = 'localhost'
+    certificate.set_serial_number(1)
+    certificate.gmtime_adj_notBefore(0)
+    certificate.gmtime_adj_notAfter(3600)
+    certificate.set_issuer(certificate.get_subject())
+    certificate.set_pubkey(key)
+    certificate.sign(key, 'sha256')
+    pem_file = open(os.path.join(self.config_dir, 'server.pem'), 'w')
+    pem_file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    pem_file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, certificate))
+    pem_file.close()
+
+  def _Handshake(self, context, address, session=None):
+    SSL = self.SSL
+    client = SSL.Connection(context, socket.create_connection(address))
+    if session is not None:
+      client.set_session(session)
+    client.set_connect_state()
+    client.do_handshake()
+    client.sendall('GET /missing HTTP/1.1\r\nHost: x\r\n'
+                   'Connection: close\r\n\r\n')
+    response = ''
+    while True:
+      try:
+        data = client.recv(4096)
+      except (SSL.ZeroReturnError, SSL.SysCallError):
+        break
+      if not data:
+        break
+      response += data
+    reused = SSL._lib.SSL_session_reused(client._ssl)
+    session = client.get_session()
+    # OpenSSL will not resume a session which was not shut down cleanly.
+    client.shutdown()
+    client.close()
+    return response, reused, session
+
+  def testSessionIsResumed(self):
+    server = self._StartServer(tls=True)
+    SSL = self.SSL
+    context = SSL.Context(SSL.TLSv1_2_METHOD)
+    # Without tickets the session can only be resumed from the server's
+    # session cache.
+    context.set_options(SSL.OP_NO_TICKET)
+    response, reused, session = self._Handshake(context,
+                                                server.server_address)
+    self.assert_(response.startswith('HTTP/1.1 404'))
+    self.assertEquals(reused, 0)
+    response, reused, session = self._Handshake(
+        context, server.server_address, session)
+    self.assert_(response.startswith('HTTP/1.1 404'))
+    self.assertEquals(reused, 1)
+
+
+class ClientTest(ServerTestCase):
+
+  def setUp(self):
+    ServerTestCase.setUp(self)
+    self.server = self._StartServer()
+    self.client = scorpion_server.client.ScorpionClient(
+        username='jeff', password='test', etag_cache_size=4)
+    self.new_connections = []
+    new_connection = self.client.pool._NewConnection
+    def CountingNewConnection(scheme, netloc):
+      self.new_connections.append(netloc)
+      return new_connection(scheme, netloc)
+    self.client.pool._NewConnection = CountingNewConnection
+
+  def tearDown(self):
+    self.client.pool.CloseAll()
+    ServerTestCase.tearDown(self)
+
+  def _Url(self, resource):
+    return 'http://127.0.0.1:%d%s' % (self.server.server_address[1],
+                                      resource)
+
+  def testConnectionIsReused(self):
+    self.client.Write(self._Url('/a'), 'first')
+    self.assertEquals(self.client.Read(self._Url('/a')), 'first')
+    self.client.Write(self._Url('/a'), 'second')
+    self.assertEquals(self.client.Read(self._Url('/a')), 'second')
+    self.assertEquals(len(self.new_connections), 1)
+
+  def testClosedPooledConnectionIsReplaced(self):
+    self.client.Write(self._Url('/a'), 'content')
+    # Close the idle connection as if the server had timed it out.
+    netloc = '127.0.0.1:%d' % self.server.server_address[1]
+    connection, reused = self.client.pool.Get('http', netloc)
+    self.assertEquals(reused, True)
+    connection.sock.shutdown(socket.SHUT_RDWR)
+    connection.sock.close()
+    self.client.pool.Put('http', netloc, connection)
+    self.assertEquals(self.client.Read(self._Url('/a')), 'content')
+    self.assertEquals(len(self.new_connections), 2)
+
+  def testOnlyReadsAreRetried(self):
+    # A server which reads each request and then drops the connection.
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(5)
+    methods = []
+    def DropConnections():
+      while True:
+        try:
+          connection = listener.accept()[0]
+        except socket.error:
+          return
+        data = ''
+        while '\r\n\r\n' not in data:
+          received = connection.recv(4096)
+          if not received:
+            break
+          data += received
+        methods.append(data.split(' ', 1)[0])
+        connection.close()
+    dropper = threading.Thread(target=DropConnections)
+    dropper.setDaemon(True)
+    dropper.start()
+    netloc = '127.0.0.1:%d' % listener.getsockname()[1]
+    url = 'http://%s/a' % netloc
+    errors = (httplib.HTTPException, socket.error)
+    try:
+      for method, operation, args in (('POST', self.client.Write, ('x',)),
+                                      ('GET', self.client.Read, ())):
+        connection = httplib.HTTPConnection(netloc, timeout=10)
+        connection.connect()
+        self.client.pool.Put('http', netloc, connection)
+        del methods[:]
+        self.assertRaises(errors, operation, url, *args)
+        # The read is sent again on a new connection, the write is not.
+        self.assertEquals(methods, [method] * (1 + (method == 'GET')))
+    finally:
+      listener.close()
+
+  def testUnchangedResourceIsReadFromCache(self):
+    statuses = []
+    request = self.client._Request
+    def RecordingRequest(*args):
+      response, body = request(*args)
+      statuses.append(response.status)
+      return response, body
+    self.client._Request = RecordingRequest
+    self.client.Write(self._Url('/a'), 'content')
+    for i in range(2):
+      self.assertEquals(self.client.Read(self._Url('/a')), 'content')
+    self.assertEquals(statuses, [200, 200, 304])
+    # A changed resource is downloaded again.
+    self.client.Write(self._Url('/a'), 'changed!')
+    self.assertEquals(self.client.Read(self._Url('/a')), 'changed!')
+    self.assertEquals(statuses[-1], 200)
+
+  def testBatchNamesWithSpaces(self):
+    self.client.BatchWrite([(self._Url('/some thing'), 'spaced')])
+    self.assertEquals(
+        open(os.path.join(self.hosted, 'some thing')).read(), 'spaced')
+    self.assertEquals(self.client.BatchRead([self._Url('/some thing')]),
+                      ['spaced'])
+
+  def testReadManyAndWriteMany(self):
+    urls = [self._Url('/%d' % i) for i in range(6)]
+    acknowledgements = self.client.WriteMany(
+        [(url, 'data %s' % url) for url in urls])
+    self.assertEquals([json.loads(ack)['size'] for ack in acknowledgements],
+                      [len('data %s' % url) for url in urls])
+    self.assertEquals(self.client.ReadMany(urls),
+                      ['data %s' % url for url in urls])
+    results = self.client.ReadMany([urls[0], self._Url('/missing')],
+                                   raise_errors=False)
+    self.assertEquals(results[0], 'data %s' % urls[0])
+    self.assertEquals(results[1].code, 404)
+    self.assertRaises(urllib2.HTTPError, self.client.ReadMany,
+                      [self._Url('/missing')])
+
+  def testBatchReadAndWrite(self):
+    acknowledgements = self.client.BatchWrite(
+        [(self._Url('/a'), 'one'), (self._Url('/b'), 'two\nlines')])
+    self.assertEquals([json.loads(ack)['size'] for ack in acknowledgements],
+                      [3, 9])
+    self.assertEquals(len(self.new_connections), 1)
+    self.assertEquals(
+        self.client.BatchRead([self._Url('/b'), self._Url('/a')]),
+        ['two\nlines', 'one'])
+    results = self.client.BatchRead([self._Url('/a'), self._Url('/missing')],
+                                    raise_errors=False)
+    self.assertEquals(results[0], 'one')
+    self.assertEquals(results[1].code, 404)
+    self.assertRaises(urllib2.HTTPError, self.client.BatchRead,
+                      [self._Url('/missing')])
+    self.assertRaises(ValueError, self.client.BatchRead,
+                      [self._Url('/a'), 'http://127.0.0.2:1/a'])
+
+
+class WatchTest(ServerTestCase):
+
+  def setUp(self):
+    ServerTestCase.setUp(self)
+    os.mkdir(os.path.join(self.hosted, 'notes'))
+    self.server = self._StartServer()
+    self.client = scorpion_server.client.ScorpionClient(
+        username='jeff', password='test')
+    self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+  def tearDown(self):
+    self.client.pool.CloseAll()
+    ServerTestCase.tearDown(self)
+
+  def testWriteIsSentToWatcher(self):
+    events = self.client.Watch(self.url + '/notes', timeout=10)
+    self.assertEquals(events.next()['event'], 'ready')
+    connection = self._Connect(self.server)
+    status = self._Request(connection, 'POST', '/notes/a', 'content',
+                           {'Authorization': self.JEFF})[0]
+    self.assertEquals(status, 200)
+    connection.close()
+    event = events.next()
+    self.assertEquals((event['event'], event['resource'], event['size']),
+                      ('change', '/notes/a', 7))
+    events.close()
+
+  def testWatchEndsAtTimeout(self):
+    started = time.time()
+    events = list(self.client.Watch(self.url + '/notes', timeout=0.5))
+    self.assertEquals([event['event'] for event in events], ['ready'])
+    self.assert_(time.time() - started < 5)
+
+  def testWatchIsRefusedWhenDisabled(self):
+    self.server.watch_enabled = False
+    connection = self._Connect(self.server)
+    status = self._Request(connection, 'GET', '/_watch/notes', None,
+                           {'Authorization': self.JEFF})[0]
+    self.assertEquals(status, 501)
+    connection.close()
+
+
+class ListingTest(ServerTestCase):
+
+  def setUp(self):
+    ServerTestCase.setUp(self)
+    for directory in ('public', 'private'):
+      os.mkdir(os.path.join(self.hosted, directory))
+    for name in ('public/a', 'public/b', 'private/c'):
+      open(os.path.join(self.hosted, name), 'w').write(name)
+    permissions_file = open(os.path.join(self.config_dir, 'permissions'),
+                            'w')
+    permissions_file.write('r\t\t/public\nw\tjeff\t/\n')
+    permissions_file.close()
+    self.server = self._StartServer()
+
+  def _List(self, path, headers=None):
+    connection = self._Connect(self.server)
+    status, body, response = self._Request(connection, 'GET', path, None,
+                                           headers)
+    connection.close()
+    self.assertEquals(status, 200)
+    listing = json.loads(body)
+    return ([entry['name'] for entry in listing['resources']],
+            listing['next_after'])
+
+  def testUnreadableResourcesAreHidden(self):
+    self.assertEquals(self._List('/_list/'),
+                      (['/public/a', '/public/b'], None))
+    self.assertEquals(self._List('/_list/private/'), ([], None))
+    self.assertEquals(self._List('/_list/', {'Authorization': self.JEFF}),
+                      (['/private/c', '/public/a', '/public/b'], None))
+
+  def testPages(self):
+    self.assertEquals(self._List('/_list/public/?limit=1'),
+                      (['/public/a'], '/public/a'))
+    self.assertEquals(self._List('/_list/public/?limit=1&after=/public/a'),
+                      (['/public/b'], None))
+
+
+class ConcurrencyModeTest(ServerTestCase):
+
+  def _CheckServes(self, server):
+    open(os.path.join(self.hosted, 'a'), 'w').write('content')
+    connection = self._Connect(server)
+    for i in range(2):
+      status, body, response = self._Request(connection, 'GET', '/a')
+      self.assertEquals((status, body), (200, 'content'))
+    connection.close()
+
+  def _WaitForConnections(self, server, count):
+    deadline = time.time() + 5
+    while server.ActiveConnections() != count and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEquals(server.ActiveConnections(), count)
+
+  def testEventLoopShutdown(self):
+    server = self._StartServer('event')
+    self._CheckServes(server)
+    # A connection which never sends a request is closed by the shutdown.
+    self._WaitForConnections(server, 0)
+    idle = socket.create_connection(server.server_address)
+    self._WaitForConnections(server, 1)
+    self.servers.remove(server)
+    stopper = threading.Thread(target=server.shutdown)
+    stopper.setDaemon(True)
+    stopper.start()
+    stopper.join(5)
+    self.assertEquals(stopper.isAlive(), False)
+    idle.settimeout(5)
+    self.assertEquals(idle.recv(1), '')
+    idle.close()
+    server.server_close()
+
+  def testPreforkedServer(self):
+    server = self._CreateServer('prefork')
+    pid = os.fork()
+    if pid == 0:
+      try:
+        scorpion_server.concurrency.ServePreforked(server, 2)
+      finally:
+        os._exit(0)
+    try:
+      self._CheckServes(server)
+    finally:
+      os.kill(pid, signal.SIGTERM)
+      os.waitpid(pid, 0)
+      server.server_close()
+
+  def testChildrenWhichExitAtOnceAreRestartedWithBackoff(self):
+    starts_file = os.path.join(self.temp_dir, 'starts')
+
+    class ExitingServer(object):
+      def serve_forever(self):
+        open(starts_file, 'a').write('.')
+
+    pid = os.fork()
+    if pid == 0:
+      try:
+        scorpion_server.concurrency.ServePreforked(ExitingServer(), 1)
+      finally:
+        os._exit(0)
+    time.sleep(1)
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    # Restarting at once would start thousands of children in a second.
+    starts = len(open(starts_file).read())
+    self.assert_(2 <= starts <= 6, starts)
+
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file